@@ -27,7 +27,7 @@ from npyx.utils import npa, thresh, thresh_consec, smooth,\
 from npyx.inout import read_metadata, get_npix_sync, paq_read, list_files
 from npyx.gl import get_rec_len
 from npyx.spk_t import mean_firing_rate, get_common_good_sections
-from npyx.corr import crosscorr_cyrille, frac_pop_sync
+from npyx.corr import crosscorr_cyrille, frac_pop_sync, frac_pop_sync_population
 from npyx.merger import assert_multi, get_ds_table
 
 #%% Generate trials dataframe from either paqIO file or matlab datastructure
@@ -1339,7 +1339,8 @@ def get_processed_popsync(trains, events, psthb=10, window=[-1000,1000],
                           again=False, dp=None, U=None,
                           zscore=False, zscoretype='within',
                           convolve=False, gsd=1, method='gaussian',
-                          bsl_subtract=False, bsl_window=[-4000, 0], process_y=False):
+                          bsl_subtract=False, bsl_window=[-4000, 0], process_y=False,
+                          population_stream=False):
     '''
     Arguments:
         - trains: list/array in seconds, timestamps to align around events. Concatenate several units for population rate!
@@ -1353,6 +1354,8 @@ def get_processed_popsync(trains, events, psthb=10, window=[-1000,1000],
         - bsl_substract: whether to baseline substract the trace. Baseline is taken as the average of the baseline window bsl_window
         - bsl_window: [t1,t2], window on which the baseline is computed, in ms -> used for zscore and for baseline subtraction (i.e. zscoring without dividing by standard deviation)
         - process_y: whether to also process the raw trials x bins matrix y (returned raw by default)
+        - population_stream: bool, whether to compute population synchrony from a single merged stream of all trains
+                             (see psth_fraction_pop_sync)
     Returns:
         - x: 1D array tiling bins, in milliseconds
         - y: 2D array NtrialsxNbins, the unprocessed ifr (by default - can be processed if process_y is set to True)
@@ -1365,7 +1368,7 @@ def get_processed_popsync(trains, events, psthb=10, window=[-1000,1000],
     x = np.arange(window[0], window[1], psthb)
     y = psth_fraction_pop_sync(trains, events, psthb, window,
                                 events_tiling_frac, sync_win, fs, t_end,
-                                b, sd, th, again, dp, U)
+                                b, sd, th, again, dp, U, population_stream)
     assert not np.any(np.isnan(y.ravel())), 'WARNING nans found in aligned ifr!!'
     if x.shape[0]>y.shape[1]:
         x=x[:-1]
@@ -1373,7 +1376,7 @@ def get_processed_popsync(trains, events, psthb=10, window=[-1000,1000],
 
     y_bsl = psth_fraction_pop_sync(trains, events, psthb, bsl_window,
                                 events_tiling_frac, sync_win, fs, t_end,
-                                b, sd, th, again, dp, U)
+                                b, sd, th, again, dp, U, population_stream)
 
     y, y_p, y_p_var = process_2d_trials_array(y, y_bsl, zscore, zscoretype,
                       convolve, gsd, method,
@@ -1381,7 +1384,8 @@ def get_processed_popsync(trains, events, psthb=10, window=[-1000,1000],
 
     return x, y, y_p, y_p_var
 
-def psth_fraction_pop_sync(trains, events, psthb, psthw, events_tiling_frac=0.1, sync_win=2, fs=30000, t_end=None, b=1, sd=1000, th=0.02, again=False, dp=None, U=None):
+def psth_fraction_pop_sync(trains, events, psthb, psthw, events_tiling_frac=0.1, sync_win=2, fs=30000, t_end=None, b=1, sd=1000, th=0.02, again=False, dp=None, U=None,
+                           population_stream=False):
     '''
       Computes the population synchrony for a set of events.
         For instance, with pstw=[-100,100], psthb=10 and events_tiling_frac=0.1,
@@ -1401,6 +1405,8 @@ def psth_fraction_pop_sync(trains, events, psthb, psthw, events_tiling_frac=0.1,
     - again: bool, whether to recompute the firing periods of units in U (trains)
     - dp: string, datapath to dataset with units corresponding to trains - optional, to ensure fast loading of firing_periods
     - U: list, units matching trains
+    - population_stream: bool, whether to merge all trains into a single sorted stream
+      and count synchronous units around all peri-event time stamps in one pass (see npyx.corr.frac_pop_sync_population)
     '''
     assert assert_int(events[0]), 'events must be provided in samples!'
     for t in trains:
@@ -1411,15 +1417,22 @@ def psth_fraction_pop_sync(trains, events, psthb, psthw, events_tiling_frac=0.1,
     eventiles=(np.arange(psthw[0], psthw[1]+psthb*events_tiling_frac, psthb*events_tiling_frac)*fs/1000).astype(np.int64)
     peri_event_stamps=np.concatenate([events+dt for dt in eventiles])
 
-    # only consider spikes around events
-    for ti, t in enumerate(trains.copy()):
-        print(f'pre_masking: {len(trains[ti])} spikes.')
-        t_mask = (t*0).astype(bool)
-        for e in events:
-            t_mask = t_mask | ( (t>=e+(psthw[0]*fs/1000)) & (t<=e+(psthw[1]*fs/1000)) )
-        trains[ti] = t[t_mask]
-        print(f'post_masking: {len(trains[ti])} spikes.')
-    fps = frac_pop_sync(peri_event_stamps, trains, fs, t_end, sync_win, b, sd, th, again, dp, U)
+    if population_stream:
+        # peri-event stamps are queried against the merged stream of all trains
+        # (only spikes within sync_win of a stamp are ever visited, no need to mask trains)
+        fps = frac_pop_sync_population(trains, fs, t_end, sync_win,
+                                       firing_b=b, firing_sd=sd, firing_th=th,
+                                       again=again, dp=dp, U=U, t1=peri_event_stamps)[0]
+    else:
+        # only consider spikes around events
+        for ti, t in enumerate(trains.copy()):
+            print(f'pre_masking: {len(trains[ti])} spikes.')
+            t_mask = (t*0).astype(bool)
+            for e in events:
+                t_mask = t_mask | ( (t>=e+(psthw[0]*fs/1000)) & (t<=e+(psthw[1]*fs/1000)) )
+            trains[ti] = t[t_mask]
+            print(f'post_masking: {len(trains[ti])} spikes.')
+        fps = frac_pop_sync(peri_event_stamps, trains, fs, t_end, sync_win, b, sd, th, again, dp, U)
 
     # Now reshape the pop synchrony trial-wise and
     # downsample it (rolling average + downsampling) from psthb*events_tiling_frac to psthb resolution
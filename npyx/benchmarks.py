@@ -0,0 +1,265 @@
+"""
+Benchmarks of npyx optimizations against their former implementations.
+
+Not imported with npyx: run them explicitly, e.g.
+    from npyx.benchmarks import benchmark_fast_acg3d
+    benchmark_fast_acg3d()
+"""
+
+import numpy as np
+
+from npyx.gl import get_units
+from npyx.testing import prefix, red_prefix, suffix
+
+def benchmark_fast_acg3d(n_units=20, n_spikes=20000, win_size=200, bin_size=1, seed=0):
+    """
+    Benchmarks npyx.c4.acg_augmentations.fast_acg3d_batch against
+    the former implementation (fast_acg3d_reference: firing rate smoothed over the whole recording with ffts,
+    one list comprehension of spike train slices per firing rate quantile) on synthetic spike trains,
+    and compares their outputs.
+
+    fast_acg3d_batch smoothes the firing rate at spike times only, with exact sums rather than ffts:
+    firing rate bins differ by rounding errors, which can move spikes lying on a quantile edge to the next bin.
+
+    Arguments:
+    - n_units: int, number of synthetic trains (batch size)
+    - n_spikes: int, number of spikes per train
+    - win_size, bin_size: float, acg window and bin size (ms)
+    - seed: int, random seed
+
+    Returns:
+    - dict, throughput of the former and new implementations (acgs per second),
+      maximum relative difference of firing rate bins and fraction of identical 3D acgs
+    """
+    import time
+    from npyx.c4.acg_augmentations import fast_acg3d_batch
+
+    rng = np.random.default_rng(seed)
+    trains = [np.cumsum(rng.integers(30, 6000, n_spikes)) for _ in range(n_units)]
+    fast_acg3d_batch(trains[:1], win_size, bin_size) # numba compilation
+
+    t = time.perf_counter()
+    ref = [fast_acg3d_reference(train, win_size, bin_size) for train in trains]
+    t_ref = time.perf_counter() - t
+    t = time.perf_counter()
+    bins, acgs = fast_acg3d_batch(trains, win_size, bin_size)
+    t_new = time.perf_counter() - t
+
+    bins_diff = max(np.max(np.abs(r[0] - b) / np.abs(r[0])) for r, b in zip(ref, bins))
+    identical = np.mean([np.array_equal(r[1], a) for r, a in zip(ref, acgs)])
+    results = {'reference_acgs_per_s': n_units / t_ref,
+               'batch_acgs_per_s': n_units / t_new,
+               'firing_rate_bins_rel_diff': bins_diff,
+               'identical_acgs_fraction': identical}
+    print((f"{prefix}fast_acg3d: {results['reference_acgs_per_s']:.1f} acgs/s (reference) vs "
+           f"{results['batch_acgs_per_s']:.1f} acgs/s (batch), x{t_ref/t_new:.1f} speedup.{suffix}"))
+    print((f"{prefix}firing rate bins relative difference: {bins_diff:.1e}, "
+           f"identical 3D acgs: {identical*100:.0f}%.{suffix}"))
+    return results
+
+def fast_acg3d_reference(spike_times, win_size, bin_size, fs=30000, num_firing_rate_bins=10, smooth=250):
+    """
+    Former implementation of npyx.c4.acg_augmentations.fast_acg3d
+    (one list comprehension of spike train slices per firing rate quantile).
+    """
+    from scipy.signal import fftconvolve
+
+    bin_size = np.clip(bin_size, 1000 * 1.0 / fs, 1e8)
+    win_size = np.clip(win_size, 1e-2, 1e8)
+    winsize_bins = 2 * int(0.5 * win_size * 1.0 / bin_size) + 1
+    time_axis = np.linspace(-win_size / 2, win_size / 2, num=winsize_bins)
+    times = np.zeros(num_firing_rate_bins, dtype=np.int64)
+
+    samples_per_bin = int(np.ceil(fs / (1000 / bin_size)))
+    spike_times = np.floor(spike_times / samples_per_bin).astype(np.int64)
+    max_indices = int(np.ceil(spike_times[-1] + 1))
+    spiketrain = np.zeros(max_indices, dtype=bool)
+    spiketrain[spike_times] = True
+
+    intervals = np.searchsorted(spike_times, np.arange(max_indices))
+    firing_rate = 1 / ((bin_size / 1000.0) * (spike_times[intervals] - spike_times[intervals - 1]))
+    firing_rate = np.nan_to_num(firing_rate)
+    if type(smooth) in [int, float] and smooth > 0:
+        kernel_size = int(np.ceil(smooth / bin_size))
+        half_kernel_size = kernel_size // 2
+        kernel = np.ones(kernel_size) / kernel_size
+        padded_firing_rate = np.pad(firing_rate, pad_width=kernel_size, mode="edge")
+        firing_rate = fftconvolve(padded_firing_rate, kernel, mode="valid")[half_kernel_size:-half_kernel_size]
+
+    quantile_bins = np.linspace(0, 1, num_firing_rate_bins + 3)[1:-1]
+    firing_rate_bins = np.quantile(firing_rate[spike_times], quantile_bins)
+    bin_number = np.searchsorted(firing_rate_bins, firing_rate[spike_times])
+    bin_number[bin_number == 0] = 1
+    bin_number[bin_number == len(firing_rate_bins)] = len(firing_rate_bins) - 1
+
+    spike_counts = np.zeros((num_firing_rate_bins, len(time_axis)))
+    for b in range(num_firing_rate_bins):
+        bin_spikes = spike_times[bin_number == b + 1]
+        start = bin_spikes + np.ceil(time_axis[0] / bin_size)
+        stop = start + len(time_axis)
+        mask = (start >= 0) & (stop < len(spiketrain)) & (bin_spikes >= spike_times[0]) & (bin_spikes < spike_times[-1])
+        masked_start = start[mask].astype(int)
+        masked_stop = stop[mask].astype(int)
+        spike_counts[b, :] = np.sum([spiketrain[masked_start[i] : masked_stop[i]] for i in range(len(masked_start))], axis=0)
+        times[b] += np.sum(mask)
+
+    acg_3d = np.nan_to_num(spike_counts / (np.ones((len(time_axis), num_firing_rate_bins)) * times).T)
+    acg_3d[:, acg_3d.shape[1] // 2] = 0
+    return firing_rate_bins, acg_3d
+
+def benchmark_pruned_ccg_stack(dp, units=None, max_distance=200, cbin=0.5, cwin=100):
+    """
+    Benchmarks the spatially pruned ccg stack (ccgs of pairs of units closer than max_distance only,
+    see npyx.corr.get_candidate_pairs) against the all-to-all ccg stack used by ccg_sig_stack and gen_sfc,
+    and checks that the ccgs of candidate pairs are identical in both stacks.
+
+    Arguments:
+    - dp: str, datapath
+    - units: list/array of units (if None, all good units)
+    - max_distance: float, maximum distance between peak channels of pairs (um)
+    - cbin, cwin: float, ccg bin and window size (ms)
+
+    Returns:
+    - dict, number of ccgs and computation time of both stacks, and whether candidate ccgs are identical
+    """
+    import time
+    from npyx.corr import ccg_stack, get_candidate_pairs
+
+    units = get_units(dp, quality='good') if units is None else np.asarray(units)
+    pairs, _ = get_candidate_pairs(dp, units, max_distance=max_distance) # peak channels, outside of timing
+    ccg_stack(dp, units[:2], units[1::-1], cbin, cwin) # numba compilation
+
+    t = time.perf_counter()
+    stack, _ = ccg_stack(dp, units, units, cbin, cwin, all_to_all=True, again=True)
+    t_all = time.perf_counter() - t
+    t = time.perf_counter()
+    pairs, _ = get_candidate_pairs(dp, units, max_distance=max_distance)
+    pruned_stack, _ = ccg_stack(dp, pairs[:, 0], pairs[:, 1], cbin, cwin, again=True)
+    t_pruned = time.perf_counter() - t
+
+    i_src, i_trg = [np.nonzero(pairs[:, k][:, None] == units[None, :])[1] for k in [0, 1]]
+    identical = np.array_equal(stack[i_src, i_trg], pruned_stack)
+    results = {'all_to_all_ccgs': len(units) * (len(units) - 1) // 2,
+               'pruned_ccgs': len(pairs),
+               'all_to_all_s': t_all,
+               'pruned_s': t_pruned,
+               'identical': identical}
+    print((f"{prefix}ccg stack of {len(units)} units: {results['all_to_all_ccgs']} ccgs in {t_all:.2f}s (all-to-all) vs "
+           f"{results['pruned_ccgs']} ccgs within {max_distance}um in {t_pruned:.2f}s (pruned), "
+           f"x{t_all/t_pruned:.1f} speedup.{suffix}"))
+    if not identical:
+        print(f"{red_prefix}pruned ccgs differ from all-to-all ccgs!{suffix}")
+    return results
+
+def benchmark_read_snippets(fname=None, file_size_gb=50, n_spikes=10000, t_waveforms=82, n_channels=385,
+                            burst_fraction=0.5, seed=0):
+    """
+    Benchmarks npyx.inout.read_snippets (coalesced gather used by get_waveforms)
+    against the former one seek+read per waveform loop (read_snippets_reference),
+    and checks that their outputs are identical.
+
+    Arguments:
+    - fname: str, path to an int16 binary file of n_channels channels.
+             If None, a sparse synthetic file of file_size_gb is created in a temporary directory
+             (reads of sparse files do not hit the disk: this measures the cost of reads, not the disk speed).
+    - file_size_gb: float, size of the synthetic file (GB)
+    - n_spikes: int, number of waveforms to read
+    - t_waveforms: int, number of samples per waveform
+    - n_channels: int, number of channels of the binary file
+    - burst_fraction: float, fraction of waveforms drawn in bursts (consecutive spikes a few ms apart)
+    - seed: int, random seed
+
+    Returns:
+    - dict, throughput of the former and new implementations (spikes per second) and whether outputs are identical
+    """
+    import os, time, tempfile
+    from npyx.inout import read_snippets
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if fname is None:
+            fname = os.path.join(tmp_dir, 'synthetic.ap.bin')
+            with open(fname, 'wb') as f:
+                f.truncate(int(file_size_gb*2**30)//(n_channels*2)*(n_channels*2))
+        n_samples_file = os.path.getsize(fname)//(n_channels*2)
+
+        rng = np.random.default_rng(seed)
+        n_bursty = int(n_spikes*burst_fraction)
+        t_isolated = rng.integers(0, n_samples_file-t_waveforms, n_spikes-n_bursty)
+        t_bursts = rng.integers(0, n_samples_file-t_waveforms-3000, max(n_bursty//10, 1))
+        t_bursty = (t_bursts[:, None] + np.cumsum(rng.integers(30, 300, (len(t_bursts), 10)), axis=1)).ravel()[:n_bursty]
+        t_starts = np.sort(np.append(t_isolated, t_bursty))
+
+        t = time.perf_counter()
+        ref = read_snippets_reference(fname, t_starts, t_waveforms, n_channels)
+        t_ref = time.perf_counter() - t
+        t = time.perf_counter()
+        new = read_snippets(fname, t_starts, t_waveforms, n_channels)
+        t_new = time.perf_counter() - t
+        identical = np.array_equal(ref, new)
+
+    results = {'reference_spikes_per_s': n_spikes / t_ref,
+               'gather_spikes_per_s': n_spikes / t_new,
+               'identical': identical}
+    print((f"{prefix}read_snippets: {results['reference_spikes_per_s']:.0f} spikes/s (seek+read loop) vs "
+           f"{results['gather_spikes_per_s']:.0f} spikes/s (coalesced gather), x{t_ref/t_new:.1f} speedup.{suffix}"))
+    if not identical:
+        print(f"{red_prefix}read_snippets output differs from reference!{suffix}")
+    return results
+
+def read_snippets_reference(fname, t_starts, t_waveforms, n_channels, dtype='int16'):
+    """
+    Former waveforms reading loop of npyx.spk_wvf.get_waveforms (one seek and read per waveform).
+    """
+    dtype = np.dtype(dtype)
+    snippets = np.zeros((len(t_starts), t_waveforms, n_channels), dtype=dtype)
+    with open(fname, "rb") as f:
+        for i, t1 in enumerate(t_starts):
+            f.seek(int(t1)*n_channels*dtype.itemsize, 0)
+            wave = f.read(n_channels*t_waveforms*dtype.itemsize)
+            snippets[i] = np.frombuffer(wave, dtype=dtype).reshape((t_waveforms, n_channels))
+    return snippets
+
+def benchmark_shift_match(n_waves=2000, n_samples=82, n_channels=16, max_jitter=4, seed=0):
+    """
+    Benchmarks npyx.spk_wvf.shift_match (crosscorrelations of all waveforms with the template computed at once with ffts)
+    against its sequential path (dynamic_template=True, see shift_match_dynamic: one crosscorrelation per waveform),
+    on jittered noisy synthetic waveforms.
+
+    The sequential path also updates its template with every aligned waveform (which drifts, and turns into nans
+    after the first discarded waveform), so outputs are not expected to be identical:
+    the number of waveforms kept (shifted by at most max_shift_allowed) is reported for both.
+
+    Arguments:
+    - n_waves: int, number of waveforms (batch averages in wvf_dsmatch)
+    - n_samples, n_channels: int, waveforms shape
+    - max_jitter: int, maximum shift of synthetic waveforms (samples)
+    - seed: int, random seed
+
+    Returns:
+    - dict, computation time and number of kept waveforms of both paths
+    """
+    import time
+    from npyx.spk_wvf import shift_match
+
+    rng = np.random.default_rng(seed)
+    template = np.sin(np.linspace(0, 6, n_samples))[:, None] * rng.normal(size=(1, n_channels))
+    waves = np.stack([np.roll(template, j, 0) for j in rng.integers(-max_jitter, max_jitter+1, n_waves)])
+    waves = (waves + rng.normal(scale=0.3, size=waves.shape)).astype(np.float32)
+    alignment_channel = n_channels//2
+
+    t = time.perf_counter()
+    sequential = shift_match(waves, alignment_channel, dynamic_template=True)
+    t_seq = time.perf_counter() - t
+    t = time.perf_counter()
+    batched = shift_match(waves, alignment_channel)
+    t_new = time.perf_counter() - t
+
+    results = {'sequential_s': t_seq,
+               'batched_s': t_new,
+               'sequential_kept': len(sequential),
+               'batched_kept': len(batched)}
+    print((f"{prefix}shift matching of {n_waves} waveforms: {t_seq:.3f}s (one xcorr per waveform) vs "
+           f"{t_new:.3f}s (batched ffts), x{t_seq/t_new:.1f} speedup.{suffix}"))
+    print((f"{prefix}waveforms kept: {len(sequential)} (sequential, dynamic template) vs "
+           f"{len(batched)} (batched).{suffix}"))
+    return results
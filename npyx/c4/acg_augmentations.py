@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.signal import fftconvolve
+from numba import njit, prange
 
 import npyx
 
@@ -13,10 +13,31 @@ def fast_acg3d(
     smooth=250,
     cut=None,
 ):
-    if cut is not None:
-        cut = min(cut, len(spike_times))
-        spike_times = spike_times[:cut]
+    firing_rate_bins, acg_3d = fast_acg3d_batch(
+        [spike_times], win_size, bin_size, fs, num_firing_rate_bins, smooth, cut
+    )
+    return firing_rate_bins[0], acg_3d[0]
 
+
+def fast_acg3d_batch(
+    spike_times_list,
+    win_size,
+    bin_size,
+    fs=30000,
+    num_firing_rate_bins=10,
+    smooth=250,
+    cut=None,
+):
+    """
+    Computes the 3D acgs of a batch of spike trains (see fast_acg3d).
+
+    Spikes are labelled with their firing rate quantile once, and all acgs are then
+    accumulated by a single compiled sweep over the sorted trains (parallelised across units).
+
+    Returns:
+    - firing_rate_bins: (n_units, num_firing_rate_bins + 1) array
+    - acg_3d: (n_units, num_firing_rate_bins, n_time_bins) array
+    """
     assert fs > 0.0
     bin_size = np.clip(bin_size, 1000 * 1.0 / fs, 1e8)  # in milliseconds
     win_size = np.clip(win_size, 1e-2, 1e8)  # in milliseconds
@@ -24,79 +45,158 @@ def fast_acg3d(
     assert winsize_bins >= 1
     assert winsize_bins % 2 == 1
     time_axis = np.linspace(-win_size / 2, win_size / 2, num=winsize_bins)
-    spike_counts = np.zeros(
-        (num_firing_rate_bins, len(time_axis))
-    )  # Counts number of occurences of spikes in a given bin in time axis
-    times = np.zeros(num_firing_rate_bins, dtype=np.int64)  # total occurence
+    window_offset = int(np.ceil(time_axis[0] / bin_size))
 
     # Samples per bin
     samples_per_bin = int(np.ceil(fs / (1000 / bin_size)))
 
+    binned_times, firing_rate_bins, bin_numbers = [], [], []
+    for spike_times in spike_times_list:
+        if cut is not None:
+            spike_times = spike_times[: min(cut, len(spike_times))]
+        times, bins, numbers = firing_rate_bin_numbers(
+            spike_times, bin_size, samples_per_bin, num_firing_rate_bins, smooth
+        )
+        binned_times.append(times)
+        firing_rate_bins.append(bins)
+        bin_numbers.append(numbers)
+
+    unit_offsets = np.cumsum([0] + [len(times) for times in binned_times]).astype(np.int64)
+    spike_counts, times = acg3d_counts_numba(
+        np.concatenate(binned_times),
+        np.concatenate(bin_numbers).astype(np.int64),
+        unit_offsets,
+        window_offset,
+        len(time_axis),
+        num_firing_rate_bins,
+    )
+
+    acg_3d = spike_counts / times[:, :, None]
+    # Divison by zero cases will return nans, so we fix this
+    acg_3d = np.nan_to_num(acg_3d)
+    # remove bin 0, which will always be 1
+    acg_3d[:, :, acg_3d.shape[2] // 2] = 0
+
+    return np.stack(firing_rate_bins), acg_3d
+
+
+def firing_rate_bin_numbers(spike_times, bin_size, samples_per_bin, num_firing_rate_bins, smooth):
+    """
+    Bins a spike train (in samples) at bin_size and labels every spike with
+    the (1-indexed) quantile bin of the firing rate at its time.
+
+    Returns:
+    - spike_times: binned spike times
+    - firing_rate_bins: (num_firing_rate_bins + 1,) array, firing rate quantiles
+    - current_firing_rate_bin_number: firing rate bin of every spike, in [1, num_firing_rate_bins]
+    """
     # Convert times_1 and times_2 (which are in units of fs to units of bin_size)
     spike_times = np.floor(spike_times / samples_per_bin).astype(np.int64)
-
-    # Convert times_1 into a binary spike train
     max_indices = int(np.ceil(max(spike_times[-1], spike_times[-1]) + 1))
-    spiketrain = np.zeros(max_indices, dtype=bool)
-    spiketrain[spike_times] = True
 
     bin_size_seconds = bin_size / 1000.0
-    intervals = np.searchsorted(spike_times, np.arange(max_indices))
-    firing_rate = 1 / ((bin_size_seconds) * (spike_times[intervals] - spike_times[intervals - 1]))
-    firing_rate = np.nan_to_num(firing_rate)
+    # the firing rate is piecewise constant: at every time bin, the inverse of the ISI
+    # ending at the first spike at or after this bin (np.searchsorted(spike_times, np.arange(max_indices)))
+    with np.errstate(divide="ignore"):
+        isi_rates = np.nan_to_num(1 / ((bin_size_seconds) * (spike_times - np.roll(spike_times, 1))))
 
-    # Smooth the firing rate with a convolution if requested
+    # Smooth the firing rate with a boxcar if requested (edge-padded, like a 'valid' convolution
+    # of the firing rate padded with its edge values), evaluated at spike times only
     if type(smooth) in [int, float] and smooth > 0:
         kernel_size = int(np.ceil(smooth / bin_size))
-        half_kernel_size = kernel_size // 2
-        kernel = np.ones(kernel_size) / kernel_size
-
-        # Pad the input firing rate array
-        padded_firing_rate = np.pad(firing_rate, pad_width=kernel_size, mode="edge")
-
-        # Convolve the padded firing rate with the kernel, use cupy if available as this is an expensive operation
-        smoothed_firing_rate = fftconvolve(padded_firing_rate, kernel, mode="valid")
-
-        # Trim the edges of the smoothed firing rate array to remove the padded values
-        trimmed_smoothed_firing_rate = smoothed_firing_rate[half_kernel_size:-half_kernel_size]
-
-        firing_rate = trimmed_smoothed_firing_rate
+        current_firing_rate = boxcar_spikes_firing_rate_numba(spike_times, isi_rates, max_indices, kernel_size)
+    else:
+        current_firing_rate = isi_rates[np.searchsorted(spike_times, spike_times)]
 
     # Get firing rate quantiles
     quantile_bins = np.linspace(0, 1, num_firing_rate_bins + 3)[1:-1]
-    firing_rate_bins = np.quantile(firing_rate[spike_times], quantile_bins)
+    firing_rate_bins = np.quantile(current_firing_rate, quantile_bins)
 
     # Find the bin number for each spike based on its firing rate
-    current_firing_rate = firing_rate[spike_times]
     current_firing_rate_bin_number = np.searchsorted(firing_rate_bins, current_firing_rate)
     current_firing_rate_bin_number[current_firing_rate_bin_number == 0] = 1
     current_firing_rate_bin_number[current_firing_rate_bin_number == len(firing_rate_bins)] = len(firing_rate_bins) - 1
 
-    # Calculate spike counts for each firing rate bin
-    bin_indices = np.arange(num_firing_rate_bins)
-    spike_counts = np.zeros((num_firing_rate_bins, len(time_axis)))
-    for bin_number in bin_indices:
-        bin_spikes = spike_times[current_firing_rate_bin_number == bin_number + 1]
-        start = bin_spikes + np.ceil(time_axis[0] / bin_size)
-        stop = start + len(time_axis)
-        mask = (start >= 0) & (stop < len(spiketrain)) & (bin_spikes >= spike_times[0]) & (bin_spikes < spike_times[-1])
-        masked_start = start[mask].astype(int)
-        masked_stop = stop[mask].astype(int)
-
-        spike_counts[bin_number, :] = np.sum(
-            [spiketrain[masked_start[i] : masked_stop[i]] for i in range(len(masked_start))],
-            axis=0,
-        )
+    return spike_times, firing_rate_bins, current_firing_rate_bin_number
 
-        times[bin_number] += np.sum(mask)
 
-    acg_3d = spike_counts / (np.ones((len(time_axis), num_firing_rate_bins)) * times).T
-    # Divison by zero cases will return nans, so we fix this
-    acg_3d = np.nan_to_num(acg_3d)
-    # remove bin 0, which will always be 1
-    acg_3d[:, acg_3d.shape[1] // 2] = 0
+@njit(cache=True)
+def boxcar_spikes_firing_rate_numba(spike_times, isi_rates, n_indices, kernel_size):
+    """
+    Firing rate at every spike, smoothed with a boxcar of kernel_size bins
+    over the window [t - (kernel_size - kernel_size//2), t + kernel_size//2 - 1] of every spike t.
 
-    return firing_rate_bins, acg_3d
+    - spike_times: sorted binned spike times
+    - isi_rates: firing rate between every spike and the previous one
+                 (the rate of the time bins in ]spike_times[i-1], spike_times[i]])
+    - n_indices: number of time bins of the firing rate, padded with its edge values beyond
+
+    Windows are summed segment by segment, so that no firing rate array as long as the recording is built.
+    """
+    half_kernel_size = kernel_size // 2
+    n = spike_times.shape[0]
+    first_rate = isi_rates[0]
+    last_rate = isi_rates[np.searchsorted(spike_times, spike_times[n - 1])]
+    out = np.empty(n)
+    for i in range(n):
+        a = spike_times[i] - (kernel_size - half_kernel_size)
+        b = spike_times[i] + half_kernel_size - 1
+        # edge padding
+        total = max(0, min(b, -1) - a + 1) * first_rate + max(0, b - max(a, n_indices) + 1) * last_rate
+        lo, hi = max(a, 0), min(b, n_indices - 1)
+        j = np.searchsorted(spike_times, lo)
+        while lo <= hi:
+            # bins ]spike_times[j-1], spike_times[j]] have the rate of spike j
+            stop = min(spike_times[j], hi)
+            total += (stop - lo + 1) * isi_rates[j]
+            lo = stop + 1
+            while j < n and spike_times[j] < lo:
+                j += 1
+        out[i] = total / kernel_size
+    return out
+
+
+@njit(cache=True, parallel=True)
+def acg3d_counts_numba(spike_times, bin_numbers, unit_offsets, window_offset, n_time_bins, num_firing_rate_bins):
+    """
+    Counts, for every unit and firing rate bin, the (unique) binned spike times
+    falling in the window [t + window_offset, t + window_offset + n_time_bins) of its spikes t.
+    Only spikes whose window lies entirely within the train are used.
+
+    - spike_times: concatenated sorted binned spike times of all units
+    - bin_numbers: firing rate bin (in [1, num_firing_rate_bins]) of every spike
+    - unit_offsets: (n_units + 1,) array, boundaries of units in spike_times
+
+    Returns:
+    - spike_counts: (n_units, num_firing_rate_bins, n_time_bins) array
+    - times: (n_units, num_firing_rate_bins) array, number of spikes used per firing rate bin
+    """
+    n_units = len(unit_offsets) - 1
+    spike_counts = np.zeros((n_units, num_firing_rate_bins, n_time_bins))
+    times = np.zeros((n_units, num_firing_rate_bins), dtype=np.int64)
+    for u in prange(n_units):
+        first, last = unit_offsets[u], unit_offsets[u + 1]
+        if last == first:
+            continue
+        t_first, t_last = spike_times[first], spike_times[last - 1]
+        lo = first
+        for i in range(first, last):
+            start = spike_times[i] + window_offset
+            stop = start + n_time_bins
+            if start < 0 or stop > t_last or spike_times[i] >= t_last:
+                continue
+            b = bin_numbers[i] - 1
+            times[u, b] += 1
+            # windows start in increasing order, so the left cursor only moves forward
+            while spike_times[lo] < start:
+                lo += 1
+            j = lo
+            while j < last and spike_times[j] < stop:
+                # duplicated binned times are only counted once
+                if j == first or spike_times[j] != spike_times[j - 1]:
+                    spike_counts[u, b, spike_times[j] - start] += 1
+                j += 1
+    return spike_counts, times
 
 
 class SubselectPeriod(object):
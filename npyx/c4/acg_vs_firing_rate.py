@@ -9,12 +9,12 @@ import pandas as pd
 import seaborn as sns
 from joblib import Parallel, delayed
 from scipy.optimize import OptimizeWarning
-from scipy.signal import fftconvolve
 from tqdm.auto import tqdm
 
 import npyx.corr as corr
 from npyx.spk_t import duplicates_mask
 
+from .acg_augmentations import fast_acg3d
 from .dataset_init import (
     extract_and_check,
     extract_and_merge_datasets,
@@ -32,117 +32,6 @@ class ArgsNamespace:
         self.__dict__.update(kwargs)
 
 
-def fast_acg3d(
-    spike_times,
-    win_size,
-    bin_size,
-    fs=30000,
-    num_firing_rate_bins=10,
-    smooth=250,
-    cut=None,
-):
-    if cut is not None:
-        cut = min(cut, len(spike_times))
-        spike_times = spike_times[:cut]
-
-    assert fs > 0.0
-    bin_size = np.clip(bin_size, 1000 * 1.0 / fs, 1e8)  # in milliseconds
-    win_size = np.clip(win_size, 1e-2, 1e8)  # in milliseconds
-    winsize_bins = 2 * int(0.5 * win_size * 1.0 / bin_size) + 1  # Both in millisecond
-    assert winsize_bins >= 1
-    assert winsize_bins % 2 == 1
-    time_axis = np.linspace(-win_size / 2, win_size / 2, num=winsize_bins)
-    spike_counts = np.zeros(
-        (num_firing_rate_bins, len(time_axis))
-    )  # Counts number of occurences of spikes in a given bin in time axis
-    times = np.zeros(num_firing_rate_bins, dtype=np.int64)  # total occurence
-
-    # Samples per bin
-    samples_per_bin = int(np.ceil(fs / (1000 / bin_size)))
-
-    # Convert times_1 and times_2 (which are in units of fs to units of bin_size)
-    spike_times = np.floor(spike_times / samples_per_bin).astype(np.int64)
-
-    # Convert times_1 into a binary spike train
-    max_indices = int(np.ceil(max(spike_times[-1], spike_times[-1]) + 1))
-    spiketrain = np.zeros(max_indices, dtype=bool)
-    spiketrain[spike_times] = True
-
-    bin_size_seconds = bin_size / 1000.0
-    intervals = np.searchsorted(spike_times, np.arange(max_indices))
-    firing_rate = 1 / (
-        (bin_size_seconds) * (spike_times[intervals] - spike_times[intervals - 1])
-    )
-    firing_rate = np.nan_to_num(firing_rate)
-
-    # Smooth the firing rate with a convolution if requested
-    if type(smooth) in [int, float] and smooth > 0:
-        kernel_size = int(np.ceil(smooth / bin_size))
-        half_kernel_size = kernel_size // 2
-        kernel = np.ones(kernel_size) / kernel_size
-
-        # Pad the input firing rate array
-        padded_firing_rate = np.pad(firing_rate, pad_width=kernel_size, mode="edge")
-
-        # Convolve the padded firing rate with the kernel, use cupy if available as this is an expensive operation
-        smoothed_firing_rate = fftconvolve(padded_firing_rate, kernel, mode="valid")
-
-        # Trim the edges of the smoothed firing rate array to remove the padded values
-        trimmed_smoothed_firing_rate = smoothed_firing_rate[
-            half_kernel_size:-half_kernel_size
-        ]
-
-        firing_rate = trimmed_smoothed_firing_rate
-
-    # Get firing rate quantiles
-    quantile_bins = np.linspace(0, 1, num_firing_rate_bins + 3)[1:-1]
-    firing_rate_bins = np.quantile(firing_rate[spike_times], quantile_bins)
-
-    # Find the bin number for each spike based on its firing rate
-    current_firing_rate = firing_rate[spike_times]
-    current_firing_rate_bin_number = np.searchsorted(
-        firing_rate_bins, current_firing_rate
-    )
-    current_firing_rate_bin_number[current_firing_rate_bin_number == 0] = 1
-    current_firing_rate_bin_number[
-        current_firing_rate_bin_number == len(firing_rate_bins)
-    ] = (len(firing_rate_bins) - 1)
-
-    # Calculate spike counts for each firing rate bin
-    bin_indices = np.arange(num_firing_rate_bins)
-    spike_counts = np.zeros((num_firing_rate_bins, len(time_axis)))
-    for bin_number in bin_indices:
-        bin_spikes = spike_times[current_firing_rate_bin_number == bin_number + 1]
-        start = bin_spikes + np.ceil(time_axis[0] / bin_size)
-        stop = start + len(time_axis)
-        mask = (
-            (start >= 0)
-            & (stop < len(spiketrain))
-            & (bin_spikes >= spike_times[0])
-            & (bin_spikes < spike_times[-1])
-        )
-        masked_start = start[mask].astype(int)
-        masked_stop = stop[mask].astype(int)
-
-        spike_counts[bin_number, :] = np.sum(
-            [
-                spiketrain[masked_start[i] : masked_stop[i]]
-                for i in range(len(masked_start))
-            ],
-            axis=0,
-        )
-
-        times[bin_number] += np.sum(mask)
-
-    acg_3d = spike_counts / (np.ones((len(time_axis), num_firing_rate_bins)) * times).T
-    # Divison by zero cases will return nans, so we fix this
-    acg_3d = np.nan_to_num(acg_3d)
-    # remove bin 0, which will always be 1
-    acg_3d[:, acg_3d.shape[1] // 2] = 0
-
-    return firing_rate_bins, acg_3d
-
-
 def delete_spikes(spikes, deletion_prob=0.1):
     mask = np.random.rand(spikes.shape[0]) > deletion_prob
     return spikes[mask]
@@ -330,21 +219,40 @@ def main(
     # acgs_3d = np.stack(acgs_3d, axis=0)
 
     num_cores = get_n_cores(len(spikes_list))
-    with redirect_stdout_fd(open(os.devnull, "w")):
-        acgs_3d = Parallel(n_jobs=num_cores)(
-            delayed(aux_compute_acgs)(
-                spikes, WIN_SIZE, BIN_SIZE, dataset_class._sampling_rate, args.fast, i
-            )
-            for i, spikes in tqdm(
-                enumerate(spikes_list),
-                total=len(spikes_list),
-                desc="Computing 3D ACGs",
-                position=0,
-                leave=False,
+    log_acgs = None
+    if args.fast:
+        with redirect_stdout_fd(open(os.devnull, "w")):
+            acgs_3d = Parallel(n_jobs=num_cores)(
+                delayed(aux_compute_acgs)(
+                    spikes, WIN_SIZE, BIN_SIZE, dataset_class._sampling_rate, args.fast, i
+                )
+                for i, spikes in tqdm(
+                    enumerate(spikes_list),
+                    total=len(spikes_list),
+                    desc="Computing 3D ACGs",
+                    position=0,
+                    leave=False,
+                )
             )
-        )
 
-    acgs_3d = np.stack([acg for acg in acgs_3d if acg is not None], axis=0)
+        acgs_3d = np.stack([acg for acg in acgs_3d if acg is not None], axis=0)
+    else:
+        # whole population at once, trains shared with workers through a single memmap
+        acgs_3d, _, _, log_acgs, _ = corr.acg_3D_population(
+            None,
+            np.arange(len(spikes_list)),
+            BIN_SIZE,
+            WIN_SIZE,
+            normalize="Probability",
+            trains=spikes_list,
+            fs=dataset_class._sampling_rate,
+            n_jobs=num_cores,
+            cache_results=False,
+        )
+        # units whose 3D acg failed are skipped, like in aux_compute_acgs
+        computed = ~np.isnan(acgs_3d).any(axis=(1, 2))
+        acgs_3d = acgs_3d[computed].reshape(computed.sum(), -1)
+        log_acgs = log_acgs[computed].reshape(computed.sum(), -1)
 
     if not os.path.exists(os.path.join(args.data_path, args.name)):
         os.mkdir(os.path.join(args.data_path, args.name))
@@ -354,13 +262,14 @@ def main(
     ) as f:
         np.save(f, acgs_3d)
 
-    log_acgs = []
     if args.log:
-        for acg in acgs_3d:
-            acg = acg.reshape(10, -1)
-            acg, _ = corr.convert_acg_log(acg, BIN_SIZE, WIN_SIZE)
-            log_acgs.append(acg.ravel())
-        log_acgs = np.stack(log_acgs, axis=0)
+        if log_acgs is None:
+            log_acgs = []
+            for acg in acgs_3d:
+                acg = acg.reshape(10, -1)
+                acg, _ = corr.convert_acg_log(acg, BIN_SIZE, WIN_SIZE)
+                log_acgs.append(acg.ravel())
+            log_acgs = np.stack(log_acgs, axis=0)
         with open(
             os.path.join(args.data_path, args.name, f"{prefix}acgs_3d{suffix}.npy"),
             "wb",
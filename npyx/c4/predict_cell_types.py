@@ -28,7 +28,7 @@ from tqdm.auto import tqdm
 import npyx.corr as corr
 import npyx.datasets as datasets
 from npyx.gl import get_units, load_units_qualities
-from npyx.spk_t import trn, trn_filtered
+from npyx.spk_t import trn, trn_filtered, trn_many
 from npyx.spk_wvf import wvf_dsmatch
 
 ale = ast.literal_eval
@@ -140,14 +140,15 @@ def prepare_dataset_from_binary(dp, units, again=False, fp_threshold=0.05, fn_th
     waveforms = []
     acgs_3d = []
     bad_units = []
-    for u in tqdm(
-        units,
+    n_spikes = [len(t) for t in trn_many(dp, units)]
+    for u, n in tqdm(
+        zip(units, n_spikes),
         desc="Preparing waveforms and ACGs for classification",
         position=0,
         leave=False,
+        total=len(units),
     ):
-        t = trn(dp, u)
-        if len(t) < 100:
+        if n < 100:
             bad_units.append(u)
             continue
         # We set period_m to None to use the whole recording
@@ -308,20 +309,29 @@ def prepare_dataset_from_binary_parallel(
     acgs_3d = []
     bad_units = []
 
+    # units with too few spikes are flagged before dispatching jobs
+    n_spikes = [len(t) for t in trn_many(dp, units)]
+    units_m = np.array(n_spikes) >= 100
+
     num_cores = get_n_cores(len(units))
 
     with redirect_stdout_fd(open(os.devnull, "w")):
         dataset_results = Parallel(n_jobs=num_cores, prefer="processes")(
             delayed(aux_prepare_dataset)(dp, u, again, fp_threshold, fn_threshold, peak_sign)
-            for u in tqdm(units, desc="Preparing waveforms and ACGs for classification")
+            for u in tqdm(np.array(units)[units_m], desc="Preparing waveforms and ACGs for classification")
         )
+    dataset_results = iter(dataset_results)
 
     for i in range(len(units)):
-        if dataset_results[i][0] is True:
+        if not units_m[i]:
+            bad_units.append(units[i])
+            continue
+        dataset_result = next(dataset_results)
+        if dataset_result[0] is True:
             bad_units.append(units[i])
         else:
-            waveforms.append(dataset_results[i][1])
-            acgs_3d.append(dataset_results[i][2])
+            waveforms.append(dataset_result[1])
+            acgs_3d.append(dataset_result[2])
 
     if bad_units:
         print(f"Units {str(bad_units)[1:-1]} were skipped because they had too few good spikes.")
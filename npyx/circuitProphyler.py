@@ -23,6 +23,7 @@ from npyx.inout import read_metadata, chan_map
 from npyx.spk_wvf import get_depthSort_peakChans, get_peak_chan
 from npyx.corr import gen_sfc
 from npyx.merger import assert_multi, get_ds_table, merge_datasets
+from npyx.gl import DatasetHandle
 
 import networkx as nx
 
@@ -857,7 +858,13 @@ def ask_syncchan(ons):
     return syncchan
 
 
-class Dataset:
+class Dataset(DatasetHandle):
+    '''
+    Neuropixels dataset - also a npyx.gl.DatasetHandle,
+    so metadata, units, channel maps and memmaps are cached as long as the Dataset exists
+    (the handle is closed with it, or with Dataset.close())
+    and the Dataset instance can be passed to any npyx function as dp.
+    '''
 
     def __repr__(self):
         return 'Neuropixels dataset at {}.'.format(self.dp)
@@ -872,8 +879,8 @@ class Dataset:
             raise ValueError('''datapath should be an existing kilosort path:
                     'path/to/kilosort/output1'.''')
 
-        self.dp = Path(datapath)
-        self.meta=read_metadata(self.dp)
+        DatasetHandle.__init__(self, datapath, owned=True)
+        self.meta=self.read_metadata()
         self.probe_version=self.meta['probe_version']
         self.ds_i=dataset_index
         self.name=self.dp.name if dataset_name is None else dataset_name
@@ -892,11 +899,11 @@ class Dataset:
             else:
                 raise "Local channel map comprises channels not found in expected channels given matafile probe type."
 
-    def get_units(self):
-        return npyx.gl.get_units(self.dp)
+    def get_units(self, quality='all', chan_range=None):
+        return npyx.gl.get_units(self, quality, chan_range)
 
     def get_good_units(self):
-        return npyx.gl.get_units(self.dp, quality='good')
+        return npyx.gl.get_units(self, quality='good')
 
     def get_peak_channels(self, use_template=True):
         self.peak_channels = get_depthSort_peakChans(self.dp, use_template=use_template)# {mainChans[i,0]:mainChans[i,1] for i in range(mainChans.shape[0])}
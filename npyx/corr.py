@@ -7,6 +7,7 @@ import os
 import os.path as op; opj=op.join
 from pathlib import Path
 import hashlib
+import tempfile
 import psutil
 
 import warnings
@@ -25,9 +26,10 @@ import pandas as pd
 from collections import Counter
 
 from scipy.interpolate import interp1d
+from scipy.sparse import coo_matrix, csr_matrix
 from tqdm.auto import tqdm
 
-from npyx.utils import npa, sign, thresh_consec, zscore, split, get_bins, \
+from npyx.utils import npa, sign, thresh_consec, thresh_consec_rows, zscore, split, get_bins, \
                     _as_array, _unique, _index_of, any_n_consec, \
                     assert_int, assert_float, assert_iterable, smooth,\
                     docstring_decorator, npyx_cacher
@@ -35,10 +37,10 @@ from npyx.utils import npa, sign, thresh_consec, zscore, split, get_bins, \
 import matplotlib.pyplot as plt
 
 from npyx.inout import read_metadata
-from npyx.gl import get_units, get_npyx_memory
-from npyx.spk_t import trn, trnb, binarize, firing_periods,\
+from npyx.gl import get_units, get_npyx_memory, get_rec_len, check_periods
+from npyx.spk_t import trn, trn_many, trnb, trnb_sparse, binarize, binarize_sparse, firing_periods,\
                         isi, mfr, train_quality
-from npyx.merger import get_source_dp_u, assert_same_dataset, assert_multi
+from npyx.merger import get_source_dp_u, assert_same_dataset, assert_multi, get_ds_ids, get_ds_table
 
 import scipy.signal as sgnl
 from npyx.stats import pdf_normal, pdf_poisson, cdf_poisson, fractile_normal
@@ -48,9 +50,9 @@ def make_phy_like_spikeClustersTimes(dp, U, periods='all', verbose=False, trains
     - trains: list of spike trains, in samples.'''
     trains_dic={}
     if trains is None:
-        for iu, u in enumerate(U):
-            # Even lists of strings can be dealt with as integers by being replaced by their indices
-            trains_dic[iu]=trn(dp, u, sav=True, periods=periods, verbose=verbose, enforced_rp=enforced_rp) # trains in samples
+        # Even lists of strings can be dealt with as integers by being replaced by their indices
+        for iu, t in enumerate(trn_many(dp, U, periods=periods, enforced_rp=enforced_rp)):
+            trains_dic[iu]=t # trains in samples
     else:
         #assert len(trains)>1
         assert type(trains) in [list, np.ndarray]
@@ -73,7 +75,7 @@ def make_matrix_2xNevents(dic):
     m = np.empty((2, 0))
     for k, v in dic.items():
         m = np.concatenate((m, np.vstack((v, np.full(v.shape, k)))), axis=1)
-    sortedIdx = np.argsort(m[0,:])
+    sortedIdx = np.argsort(m[0,:], kind='stable')
     rows = np.array([[0], [1]])
     m = m[rows, sortedIdx]
 
@@ -106,7 +108,7 @@ def crosscorrelate_cyrille(dp, bin_size, win_size, U, fs=30000, symmetrize=True,
 
 @npyx_cacher
 def crosscorr_cyrille(times, clusters, win_size, bin_size, fs=30000, symmetrize=True,
-                      log_window_end=None, n_log_bins=10):
+                      log_window_end=None, n_log_bins=10, parallel=False):
     '''
     Computes crosscorrelation histograms between all pairs of neuron spike trains.
 
@@ -132,6 +134,9 @@ def crosscorr_cyrille(times, clusters, win_size, bin_size, fs=30000, symmetrize=
         between 0 and `log_window_end`.
     n_log_bins : int, optional
         Number of logarithmic bins to use if `log_window_end` is provided. Default is 10.
+    parallel : bool, optional
+        Whether to split the spikes in time blocks processed on parallel threads
+        (one histogram per block, summed afterwards). Default is False.
 
     Returns:
     --------
@@ -164,73 +169,34 @@ def crosscorr_cyrille(times, clusters, win_size, bin_size, fs=30000, symmetrize=
         assert samples_per_bin >= 1 # Cannot be smaller than a sample time
 
         correlograms = np.zeros((n_units, n_units, winsize_bins // 2 + 1), dtype=np.int32)
+        log_bins = np.zeros(0, dtype=np.float64) # no log bins
 
     else:
         log_bins = get_log_bins_samples(log_window_end, n_log_bins, fs)
         assert np.all(log_bins>=1), "log bins can only be superior to 1 (positive half of CCG window)"
         correlograms = np.zeros((n_units, n_units, len(log_bins)), dtype=np.int32)
-
-    # Iterate over spikes
-    # starting from the smallest time differences (the neighbouring spike, shift=1)
-    # working the way up until no neighbouring spike
-    # is close enough to to be included in the CCG window
-    # (stops when mask is only False because of mask[:-shift][spike_diff_b > (winsize_bins // 2)] = False)
-    shift = 1
-    mask = np.ones_like(phy_ss, dtype=bool)
-    while mask[:-shift].any():
-
-        # Compute delta_Ts between each spike and the closest spike in the past
-        # (so delta_Ts are always positive integers)
-        # no need to do the same looking in the future
-        # as these would be the same delta_Ts, but negative
-        phy_ss = _as_array(phy_ss)
-        spike_diff = phy_ss[shift:] - phy_ss[:-shift]
-        # convert delta from samples to number of CCG bins
-        # and naturally 'bin' by using integer division (floats rounded down to int)
-        # if bins are linear, simple division.
-        # if bins are log or anything else, no other option but to compare to bin edges
-        # (conveniently, can be computed analytically if bins are linear)
-        if log_window_end is None:
-            spike_diff_b = spike_diff // samples_per_bin
-        else:
-            bin_position = spike_diff<log_bins[:,None]
-            outside_of_win = ~np.any(bin_position, axis=0)
-            spike_diff_b = np.argmax(bin_position, axis=0)-1
-            # on log scale 0s (same time) do not have a bin.
-            # we artificially put them in the smallest bin.
-            spike_diff_b[spike_diff_b==-1] = 0 
-
-        # Mask out spikes whose the closest spike in the past
-        # is further than the correlogram half window.
-        # This works because shift starts from the lowest possible delta_t (1 sample)
-        # and because spikes are sorted
-        # so spikes with no close spike for shift = 1 will never have a close spike for future shifts
-        if log_window_end is None:
-            mask[:-shift][spike_diff_b > (winsize_bins // 2)] = False
-        else:
-            # (because using argmax, cannot be larger than window edge)
-            mask[:-shift][outside_of_win] = False
-        m = mask[:-shift].copy()
-
-        # Extract delta_Ts within half CCG window
-        delta_t_bins_filtered = spike_diff_b[m]
-
-        # Find units indices matching the delta_ts
-        spike_clusters_i = _index_of(spike_clusters, units)
-        end_units_i=spike_clusters_i[:-shift][m]
-        start_units_i=spike_clusters_i[+shift:][m]
-        indices = np.ravel_multi_index((end_units_i, start_units_i, delta_t_bins_filtered), correlograms.shape)
-        indices = _as_array(indices)
-
-        # Count histogram of delta_Ts for this set of neighbours (shift), binwise
-        # bbins becomes a 3D array, Nunits x Nunits x Nbins
-        bbins = np.bincount(indices) # would turn [0,5,2,2,3]ms into [1,0,2,1,0,1]
-
-        # Increment the matching spikes in the correlograms array.
-        arr = _as_array(correlograms.ravel()) # Alias -> modif of arr will apply to correlograms
-        arr[:len(bbins)] += bbins # increments the NunitsxNunits histograms at the same time
-
-        shift += 1
+        samples_per_bin, winsize_bins = 1, 1 # unused with log bins
+
+    # Single sorted sweep: for each spike, iterate over the following spikes
+    # until the closest spike in the past is further than the correlogram half window
+    # (spikes are sorted, so no spike further in the future can be close enough)
+    # and increment the n_units x n_units x n_bins histograms directly.
+    # Delta_Ts are always positive integers: no need to do the same looking in the past
+    # as these would be the same delta_Ts, but negative.
+    phy_ss = _as_array(phy_ss).astype(np.int64)
+    spike_clusters_i = _index_of(spike_clusters, units).astype(np.int64)
+    n_blocks = 1
+    if parallel:
+        # one histogram per block of spikes (time block), summed afterwards
+        max_block_memory = psutil.virtual_memory().available / 4
+        n_blocks = int(np.clip(max_block_memory // correlograms.nbytes, 1, num_cores))
+        n_blocks = min(n_blocks, max(1, len(phy_ss)//1000))
+    if n_blocks == 1:
+        ccg_sweep_numba(phy_ss, spike_clusters_i, correlograms,
+                        0, len(phy_ss), samples_per_bin, winsize_bins // 2, log_bins)
+    else:
+        correlograms[:] = ccg_sweep_blocks_numba(phy_ss, spike_clusters_i, correlograms.shape,
+                                                 n_blocks, samples_per_bin, winsize_bins // 2, log_bins)
 
     # Remove ACG peaks (perfectly correlated with themselves)
     correlograms[np.arange(n_units),
@@ -255,12 +221,91 @@ def crosscorr_cyrille(times, clusters, win_size, bin_size, fs=30000, symmetrize=
     return correlograms
 
 
+@njit(cache=True, nogil=True)
+def ccg_sweep_numba(times, clusters_i, correlograms, i_start, i_end,
+                    samples_per_bin, half_winsize_bins, log_bins):
+    """
+    Increments correlograms[clusters_i[i], clusters_i[j], bin(times[j]-times[i])]
+    for every spike i in [i_start, i_end[ and every following spike j within the half window.
+
+    - times: (n_spikes,) int64 array, sorted spike times (samples)
+    - clusters_i: (n_spikes,) int64 array, indices of spikes units in correlograms
+    - correlograms: (n_units, n_units, n_bins) int32 array, incremented in place
+    - samples_per_bin: int, linear bin size (samples)
+    - half_winsize_bins: int, last linear bin
+    - log_bins: float array, logarithmic bins edges in samples (empty if linear bins),
+                as returned by get_log_bins_samples. Bins are assigned with a log transform,
+                equivalent to np.searchsorted(log_bins, delta_T, side='right')-1.
+                0 delta_Ts are artificially put in the smallest log bin.
+    """
+    n = times.shape[0]
+    log = log_bins.shape[0] > 0
+    if log:
+        log_end = log_bins[-1]
+        n_log_edges = log_bins.shape[0]
+        # log bins edges are log-spaced between 1 and log_end:
+        # direct log transform, then exact correction against the edges (float rounding)
+        log_scale = (n_log_edges - 1) / np.log(log_end) if log_end > 1 else 0.
+    for i in range(i_start, i_end):
+        t_i = times[i]
+        c_i = clusters_i[i]
+        if c_i < 0:
+            continue
+        for j in range(i + 1, n):
+            spike_diff = times[j] - t_i
+            if log:
+                if spike_diff >= log_end:
+                    break
+                if spike_diff <= 1:
+                    b = 0
+                else:
+                    b = min(int(np.log(spike_diff) * log_scale), n_log_edges - 2)
+                    while b + 1 < n_log_edges and log_bins[b + 1] <= spike_diff:
+                        b += 1
+                    while b > 0 and log_bins[b] > spike_diff:
+                        b -= 1
+            else:
+                b = spike_diff // samples_per_bin
+                if b > half_winsize_bins:
+                    break
+            c_j = clusters_i[j]
+            if c_j >= 0:
+                correlograms[c_i, c_j, b] += 1
+
+@njit(cache=True, parallel=True)
+def ccg_sweep_blocks_numba(times, clusters_i, shape, n_blocks,
+                           samples_per_bin, half_winsize_bins, log_bins):
+    """
+    ccg_sweep_numba ran on n_blocks blocks of spikes on parallel threads,
+    each block incrementing its own histogram (no race condition).
+    """
+    n = times.shape[0]
+    block_bounds = np.linspace(0, n, n_blocks + 1).astype(np.int64)
+    block_correlograms = np.zeros((n_blocks, shape[0], shape[1], shape[2]), dtype=np.int32)
+    for k in prange(n_blocks):
+        ccg_sweep_numba(times, clusters_i, block_correlograms[k],
+                        block_bounds[k], block_bounds[k + 1],
+                        samples_per_bin, half_winsize_bins, log_bins)
+    correlograms = np.zeros((shape[0], shape[1], shape[2]), dtype=np.int32)
+    for k in range(n_blocks):
+        correlograms += block_correlograms[k]
+    return correlograms
+
+_log_bins_memory = {}
+
 def get_log_bins_samples(log_window_end, n_log_bins, fs):
-    "log_window_end in ms, fs is sampling rate - output in samples."
-    log_window_end = log_window_end * fs/1000 # convert to samples
+    """
+    log_window_end in ms, fs is sampling rate - output in samples.
+    Edges are cached per (fs, log_window_end, n_log_bins), and returned read-only.
+    """
     assert assert_int(n_log_bins), "n_log_bins must be an integer!"
-    log_bins = np.logspace(np.log10(1),np.log10(log_window_end), n_log_bins+1)
-    return log_bins
+    key = (float(fs), float(log_window_end), int(n_log_bins))
+    if key not in _log_bins_memory:
+        log_window_end = log_window_end * fs/1000 # convert to samples
+        log_bins = np.logspace(np.log10(1),np.log10(log_window_end), n_log_bins+1)
+        log_bins.flags.writeable = False
+        _log_bins_memory[key] = log_bins
+    return _log_bins_memory[key]
 
 
 def ccg(dp, U, bin_size, win_size, fs=30000, normalize='Hertz',
@@ -474,10 +519,10 @@ def ccg_2d_numba(t1, t2, binsize, windowsize):
     -----------
     t1 : numpy.ndarray
         The time series, represented as an array of spike times.
-        SORTED, in SAMPLES (non negative integers).
+        SORTED, in SAMPLES (int64).
     t2 : numpy.ndarray
         The second time series, represented as an array of spike times.
-        SORTED, in SAMPLES (non negative integers).
+        SORTED, in SAMPLES (int64).
     binsize : int
         The size of each bin in the crosscorrelogram.
     windowsize : int
@@ -490,6 +535,9 @@ def ccg_2d_numba(t1, t2, binsize, windowsize):
 
     Notes:
     -------
+    Every spike of t1 finds the start of its window in t2 by binary search,
+    so that spikes are processed independently on parallel threads.
+
     C.sum(0) is equivalent to crosscorr_cyrille(...)[0, 1, :] for values after 0,
     and slightly different for values before 0. That is because crosscorr_cyrille uses
     array[i, j, half:] = array[j, i, :half], and triggering t1>t2 and t2>t1 is not strictly equivalent
@@ -499,29 +547,102 @@ def ccg_2d_numba(t1, t2, binsize, windowsize):
     half_window = windowsize // 2
     C = np.zeros((len(t1), n_bins), dtype=np.int64)
 
-    left_cursor = 0
     for i in nb.prange(len(t1)):
+        win_left = t1[i] - half_window
+        j = np.searchsorted(t2, win_left)
+        while j < len(t2):
+            b = (t2[j] - win_left) // binsize
+            if b >= n_bins:
+                break
+            C[i, b] += 1
+            j += 1
 
-        t = t1[i]
-        
-        win_left = t - half_window
-        win_right = t + half_window + binsize
+    return C
 
-        while left_cursor < len(t2) and t2[left_cursor] < win_left:
-            left_cursor += 1
+@nb.njit(parallel=True, fastmath=True)
+def ccg_2d_sparse_numba(t1, t2, binsize, windowsize):
+    """
+    Sparse equivalent of ccg_2d_numba: returns the non-zero values of the (len(t1), n_bins) crosscorrelogram
+    as COO triplets (rows, bins, counts), sorted by row and bin.
 
-        right_cursor = left_cursor
-        while right_cursor < len(t2) and t2[right_cursor] < win_right:
-            right_cursor += 1
-        
-        t2_stamps_in_window = t2[left_cursor:right_cursor]
-        hist = np.bincount((t2_stamps_in_window - win_left) // binsize, minlength=n_bins)
-        C[i] = hist
-        
+    A first parallel pass counts the non-zero bins of every spike of t1,
+    a second one fills the triplets at the offsets of every spike (no race condition).
+    """
+    n_bins = 2 * int(.5 * windowsize / binsize) + 1
+    half_window = windowsize // 2
+    n = len(t1)
+    starts = np.zeros(n, dtype=np.int64)
+    nnz = np.zeros(n, dtype=np.int64)
+
+    for i in nb.prange(n):
+        win_left = t1[i] - half_window
+        j = np.searchsorted(t2, win_left)
+        starts[i] = j
+        last_b = -1
+        while j < len(t2):
+            b = (t2[j] - win_left) // binsize
+            if b >= n_bins:
+                break
+            if b != last_b: # t2 is sorted: bins are visited in order
+                nnz[i] += 1
+                last_b = b
+            j += 1
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(nnz)
+    rows = np.empty(offsets[-1], dtype=np.int64)
+    bins = np.empty(offsets[-1], dtype=np.int64)
+    counts = np.zeros(offsets[-1], dtype=np.int64)
+
+    for i in nb.prange(n):
+        win_left = t1[i] - half_window
+        j = starts[i]
+        k = offsets[i] - 1
+        last_b = -1
+        while j < len(t2):
+            b = (t2[j] - win_left) // binsize
+            if b >= n_bins:
+                break
+            if b != last_b:
+                k += 1
+                rows[k] = i
+                bins[k] = b
+                last_b = b
+            counts[k] += 1
+            j += 1
+
+    return rows, bins, counts
+
+@nb.njit(parallel=True, fastmath=True)
+def ccg_2d_sum_numba(t1, t2, binsize, windowsize, n_blocks):
+    """
+    Per-bin sum of ccg_2d_numba (i.e. ccg_2d_numba(...).sum(0)) without the (len(t1), n_bins) matrix:
+    t1 is split in n_blocks blocks ran on parallel threads, each incrementing its own histogram.
+    """
+    n_bins = 2 * int(.5 * windowsize / binsize) + 1
+    half_window = windowsize // 2
+    n = len(t1)
+    block_bounds = np.linspace(0, n, n_blocks + 1).astype(np.int64)
+    block_C = np.zeros((n_blocks, n_bins), dtype=np.int64)
+
+    for k in nb.prange(n_blocks):
+        for i in range(block_bounds[k], block_bounds[k + 1]):
+            win_left = t1[i] - half_window
+            j = np.searchsorted(t2, win_left)
+            while j < len(t2):
+                b = (t2[j] - win_left) // binsize
+                if b >= n_bins:
+                    break
+                block_C[k, b] += 1
+                j += 1
+
+    C = np.zeros(n_bins, dtype=np.int64)
+    for k in range(n_blocks):
+        C += block_C[k]
     return C
 
 @npyx_cacher
-def ccg_2d(t1, t2, binsize, windowsize,
+def ccg_2d(t1, t2, binsize, windowsize, output='dense',
            again=False, cache_results=True, cache_path=None):
     """
     Compute the (n_events, n_bins) crosscorrelogram between two time series.
@@ -536,11 +657,15 @@ def ccg_2d(t1, t2, binsize, windowsize,
         The size of each bin in the PSTH - in SAMPLES.
     windowsize : int
         The size of the window around each spike in t1 to consider - in SAMPLES.
+    output : str
+        'dense' (numpy array), 'sparse' (scipy.sparse.coo_matrix of the same shape,
+        for high rate units) or 'sum' (per-bin sum across t1 spikes, without computing the matrix).
 
     Returns:
     --------
-    numpy.ndarray
-        The PSTH between t1 and t2, with shape (len(t1), n_bins).
+    numpy.ndarray or scipy.sparse.coo_matrix
+        The PSTH between t1 and t2, with shape (len(t1), n_bins) (rows matching sorted t1),
+        or (n_bins,) if output is 'sum'.
 
     Notes:
     -------
@@ -549,6 +674,7 @@ def ccg_2d(t1, t2, binsize, windowsize,
     array[i, j, half:] = array[j, i, :half], and triggering t1>t2 and t2>t1 is not strictly equivalent
     because of bin edge effects (and also, it seems like the symmetrization from cyrille shifts the bins slightly, not a big deal).
     """
+    assert output in ['dense', 'sparse', 'sum'], "output must be either 'dense', 'sparse' or 'sum'!"
 
     # Make sure the time series are sorted
     t1 = np.sort(t1)
@@ -575,6 +701,19 @@ def ccg_2d(t1, t2, binsize, windowsize,
     assert isinstance(binsize, int), "binsize should be an integer!"
     assert isinstance(windowsize, int), "windowsize should be an integer!"
 
+    # signed integers, as windows can start before 0
+    t1 = t1.astype(np.int64)
+    t2 = t2.astype(np.int64)
+
+    if output == 'sparse':
+        rows, bins, counts = ccg_2d_sparse_numba(t1, t2, binsize, windowsize)
+        n_bins = 2 * int(.5 * windowsize / binsize) + 1
+        return coo_matrix((counts, (rows, bins)), shape=(len(t1), n_bins))
+
+    if output == 'sum':
+        n_blocks = int(min(nb.get_num_threads(), max(1, len(t1)//1000)))
+        return ccg_2d_sum_numba(t1, t2, binsize, windowsize, n_blocks)
+
     return ccg_2d_numba(t1,
                         t2,
                         binsize,
@@ -827,6 +966,116 @@ def ccg_3D(dp, U, cbin, cwin, normalize='Hertz',
 
     return ccg_3d, bins_t, bins_f
 
+def acg_3D_population(dp, U, cbin, cwin, normalize='Hertz', periods='all',
+                      trains=None, enforced_rp=0, fs=None, num_firing_rate_bins=10, smooth=250,
+                      n_log_bins=100, start_log_ms=0.8, smooth_sd=1,
+                      n_jobs=None, again=False, cache_results=True):
+    """
+    Computes the 3D acgs of a whole population of units at once.
+
+    All trains are loaded once and written to a single memory-mapped file,
+    from which a pool of worker processes reads the train of every unit
+    (no train is shipped to workers). 3D acgs are cached unit by unit (see acg_3D_train),
+    so that only new units are computed when the population changes.
+
+    Arguments:
+    - dp: str, datapath (can be None if trains and fs are provided - results are then cached globally)
+    - U: list/array of units
+    - cbin, cwin: float, acg bin and window size, in milliseconds.
+    - normalize: 'Probability' or 'Hertz'
+    - periods: 'all' or [[t1,t2], [t3,t4]...] (seconds)
+    - trains: optional list of spike trains of units U, in SAMPLES
+    - enforced_rp: float, enforced refractory period (ms)
+    - fs: sampling frequency, in Hertz. Read from dp metadata if None.
+    - num_firing_rate_bins, smooth: see crosscorr_vs_firing_rate
+    - n_log_bins, start_log_ms, smooth_sd: see convert_acg_log
+    - n_jobs: int, number of worker processes. Defaults to the number of cpu cores.
+    - again: bool, whether to recompute 3D acgs rather than loading them from cache.
+    - cache_results: bool, whether to cache 3D acgs.
+
+    Returns:
+    - acgs_3d: (n_units, num_firing_rate_bins, n_bins) array, 3D acgs of units U
+               (0 for units without spikes, NaN for units skipped because their 3D acg raised an IndexError)
+    - bins_t: (n_bins,) array, time bins (ms)
+    - bins_f: (n_units, num_firing_rate_bins) array, firing rate bins of every unit
+    - acgs_3d_log: (n_units, num_firing_rate_bins, n_log_bins) array, 3D acgs on a log time scale
+    - t_log: (n_log_bins,) array, log time bins (ms)
+    """
+    assert normalize in ['Probability', 'Hertz']
+    U=npa(U).ravel()
+    if trains is None:
+        trains=trn_many(dp, U, periods=periods, enforced_rp=enforced_rp)
+    assert len(trains)==len(U), 'You must feed as many trains as units!'
+    if fs is None:
+        assert dp is not None, 'You must provide fs if you do not provide dp!'
+        fs=read_metadata(get_source_dp_u(dp, U[0])[0])['highpass']['sampling_rate']
+    if n_jobs is None: n_jobs=num_cores
+
+    N=npa([len(t) for t in trains]).astype(np.int64)
+    offsets=np.concatenate([[0], np.cumsum(N)])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # single file shared by all workers
+        trains_path=Path(tmp_dir)/'trains.npy'
+        np.save(trains_path, np.concatenate([np.asarray(t) for t in trains]+[np.zeros(0)]).astype(np.int64))
+        dp_cache=None if dp is None else Path(dp)
+        units_i=np.nonzero(N>0)[0]
+        results=Parallel(n_jobs=min(n_jobs, max(len(units_i), 1)))(
+            delayed(acg_3D_population_worker)(trains_path, offsets[i], offsets[i+1], dp_cache,
+                                              cbin, cwin, fs, normalize, num_firing_rate_bins, smooth,
+                                              again, cache_results)
+            for i in tqdm(units_i, desc=f'Computing 3D acgs over {n_jobs} cores'))
+
+    # same time axis as crosscorr_vs_firing_rate
+    cbin_clipped=np.clip(cbin, 1000*1./fs, 1e8)
+    winsize_bins=2*int(.5*np.clip(cwin, 1e-2, 1e8)*1./cbin_clipped)+1
+    bins_t=(np.arange(winsize_bins)-winsize_bins//2)*cbin_clipped
+    acgs_3d=np.zeros((len(U), num_firing_rate_bins, winsize_bins))
+    bins_f=np.full((len(U), num_firing_rate_bins), np.nan)
+    for i, res in zip(units_i, results):
+        if res is None:
+            print(f"Error with unit {U[i]}: 3D acg could not be computed. Skipping (filled with NaNs).")
+            acgs_3d[i]=np.nan
+            continue
+        acgs_3d[i], bins_f[i]=res
+
+    # log conversion of all acgs at once
+    acgs_3d_log, t_log=convert_acg_log(acgs_3d.reshape(-1, acgs_3d.shape[2]), cbin, cwin,
+                                       n_log_bins, start_log_ms, smooth_sd)
+    acgs_3d_log=acgs_3d_log.reshape(len(U), num_firing_rate_bins, -1)
+
+    return acgs_3d, bins_t, bins_f, acgs_3d_log, t_log
+
+def acg_3D_population_worker(trains_path, start, end, dp, cbin, cwin, fs, normalize,
+                             num_firing_rate_bins, smooth, again, cache_results):
+    """
+    Reads a unit train from the memory-mapped population trains and computes its 3D acg (see acg_3D_population).
+    Returns None if crosscorr_vs_firing_rate raises an IndexError, so that the unit is skipped.
+    """
+    train=np.array(np.load(trains_path, mmap_mode='r')[start:end])
+    try:
+        return acg_3D_train(dp, train, cbin, cwin, fs, normalize, num_firing_rate_bins, smooth,
+                            again=again, cache_results=cache_results)
+    except IndexError:
+        return None
+
+@npyx_cacher
+def acg_3D_train(dp, train, cbin, cwin, fs=30000, normalize='Hertz',
+                 num_firing_rate_bins=10, smooth=250,
+                 again=False, cache_results=True, cache_path=None):
+    """
+    3D acg of a single spike train (in samples), cached at dp/.NeuroPyxels
+    (or globally if dp is None).
+
+    Returns:
+    - acg_3d: (num_firing_rate_bins, n_bins) array
+    - bins_f: (num_firing_rate_bins,) array, firing rate bins
+    """
+    bins_f, acg_3d = crosscorr_vs_firing_rate(train, train, cwin, cbin, fs,
+                                              num_firing_rate_bins, smooth)
+    if normalize == 'Hertz':
+        acg_3d = acg_3d / (cbin/1000)
+    return acg_3d, bins_f
+
 def crosscorr_vs_firing_rate(times_1, times_2, win_size, bin_size,
                              fs=30000, num_firing_rate_bins=10, smooth=250,
                              use_spikes_around_times1_for_deciles=True,
@@ -871,8 +1120,6 @@ def crosscorr_vs_firing_rate(times_1, times_2, win_size, bin_size,
 
     if firing_rate_bins is not None:
         num_firing_rate_bins = len(firing_rate_bins)
-    spike_counts = np.zeros((num_firing_rate_bins, len(time_axis))) # Counts number of occurences of spikes in a given bin in time axis
-    times = np.zeros(num_firing_rate_bins, dtype=np.int64) # total occurence 
 
     # Samples per bin
     samples_per_bin = int(np.ceil(fs / (1000 / bin_size)))
@@ -881,58 +1128,55 @@ def crosscorr_vs_firing_rate(times_1, times_2, win_size, bin_size,
     times_1 = np.floor(times_1 / samples_per_bin).astype(np.int64)
     times_2 = np.floor(times_2 / samples_per_bin).astype(np.int64)
 
-    # Convert times_1 into a binary spike train
+    # Everything is computed from sorted spike times (no array as long as the recording):
+    # length of the equivalent binary spike train
     max_indices = int(np.ceil(max(times_1[-1], times_2[-1]) + 1))
-    spiketrain = np.zeros(max_indices, dtype=bool)
-    spiketrain[times_2] = True
-
-    # Convert neuron_2 spikes to firing rate using the inverse ISI method
-    firing_rate = np.zeros(max_indices)
-    for i in range(1, len(times_2)-1):
-        start = 0 if i == 0 else (times_2[i-1] + (times_2[i] - times_2[i-1])//2)
-        stop = max_indices if i == len(times_2) - 1 else (times_2[i] + (times_2[i+1] - times_2[i])//2)
-        current_firing_rate = 1.0 / ((stop - start) * (bin_size / 1000))
-        firing_rate[start:stop] = current_firing_rate
-            
-    # Smooth the firing rate using numpy convolution function if requested
-    if (type(smooth) == int or type(smooth) == float) and smooth > 0:
-        kernel_size = int(np.ceil(smooth / bin_size))
-        half_kernel_size = kernel_size // 2
-        kernel = np.ones(kernel_size) / kernel_size
-        smoothed_firing_rate = np.convolve(firing_rate, kernel, mode='same')
-
-        # Correct manually for possible artefacts at the edges
-        for i in range(kernel_size):
-            start = max(0, i - half_kernel_size)
-            stop = min(len(firing_rate), i + half_kernel_size)
-            smoothed_firing_rate[i] = np.mean(firing_rate[start:stop])
-        for i in range(len(firing_rate) - kernel_size, len(firing_rate)):
-            start = max(0, i - half_kernel_size)
-            stop = min(len(firing_rate), i + half_kernel_size)
 
-            smoothed_firing_rate[i] = np.mean(firing_rate[start:stop])
-        firing_rate = smoothed_firing_rate
+    # Firing rate of neuron_2 using the inverse ISI method:
+    # piecewise constant between the midpoints of consecutive ISIs
+    # (first and last spikes excluded, 0 before and after)
+    if len(times_2) > 2:
+        fr_starts = times_2[:-2] + (times_2[1:-1] - times_2[:-2])//2
+        fr_stops = times_2[1:-1] + (times_2[2:] - times_2[1:-1])//2
+    else:
+        fr_starts, fr_stops = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    with np.errstate(divide='ignore'):
+        fr_values = 1.0 / ((fr_stops - fr_starts) * (bin_size / 1000))
+
+    # Firing rate at the spikes of neuron 1,
+    # smoothed with a boxcar kernel if requested
+    smoothed = (type(smooth) == int or type(smooth) == float) and smooth > 0
+    kernel_size = int(np.ceil(smooth / bin_size)) if smoothed else 1
+    positions = np.unique(times_1)
+    firing_rate_1 = inverse_isi_firing_rate(positions, fr_starts, fr_stops, fr_values,
+                                            max_indices, kernel_size, smoothed)
+    firing_rate_1 = firing_rate_1[np.searchsorted(positions, times_1)]
 
     # Get firing rate quantiles
     if firing_rate_bins is None:
         quantile_bins = np.linspace(0, 1, num_firing_rate_bins + 2)[1:-1]
         if use_spikes_around_times1_for_deciles:
-            firing_rate_bins = np.quantile(firing_rate[times_1], quantile_bins)
+            firing_rate_bins = np.quantile(firing_rate_1, quantile_bins)
         else:
-            firing_rate_bins = np.quantile(firing_rate, quantile_bins)
-    for (i, spike_index) in enumerate(times_1):
-        start = spike_index + int(np.ceil(time_axis[0] / bin_size))
-        stop = start + len(time_axis)
-        if (start < 0) or (stop >= len(spiketrain)) or spike_index < times_2[0] or spike_index >= times_2[-1]:
-            continue # Skip these spikes to avoid edge artifacts
-        current_firing_rate = firing_rate[spike_index] # Firing of neuron 2 at neuron 1's spike index
-        current_firing_rate_bin_number = np.argmax(firing_rate_bins >= current_firing_rate)
-        if current_firing_rate_bin_number == 0 and current_firing_rate > firing_rate_bins[0]:
-            current_firing_rate_bin_number = len(firing_rate_bins) - 1
-        spike_counts[current_firing_rate_bin_number, :] += spiketrain[start:stop]
-        times[current_firing_rate_bin_number] += 1
+            # quantiles of the firing rate over the whole recording, evaluated chunk by chunk
+            firing_rate_bins = firing_rate_quantiles(fr_starts, fr_stops, fr_values,
+                                                     max_indices, kernel_size, smoothed, quantile_bins)
+
+    # Firing rate bin of every spike of neuron 1
+    fr_bins = np.asarray(firing_rate_bins)
+    bin_numbers = np.argmax(fr_bins[None, :] >= firing_rate_1[:, None], axis=1)
+    bin_numbers[(bin_numbers == 0) & (firing_rate_1 > fr_bins[0])] = len(fr_bins) - 1
+
+    # Skip spikes close to the edges to avoid edge artifacts
+    start_offset = int(np.ceil(time_axis[0] / bin_size))
+    starts = times_1 + start_offset
+    valid = (starts >= 0) & (starts + len(time_axis) < max_indices) &\
+            (times_1 >= times_2[0]) & (times_1 < times_2[-1])
+
+    # neuron 2 spikes in the window of every spike of neuron 1 (spikes in the same bin count once)
+    spike_counts, times = ccg_vs_fr_counts_numba(starts, np.unique(times_2), bin_numbers, valid,
+                                                 len(time_axis), num_firing_rate_bins)
 
-    
     ccg_3d = spike_counts / (np.ones((len(time_axis), num_firing_rate_bins)) * times).T
     # Divison by zero cases will return nans, so we fix this
     ccg_3d = np.nan_to_num(ccg_3d)
@@ -942,6 +1186,150 @@ def crosscorr_vs_firing_rate(times_1, times_2, win_size, bin_size,
 
     return firing_rate_bins, ccg_3d
 
+def inverse_isi_firing_rate(positions, fr_starts, fr_stops, fr_values, n_indices, kernel_size, smoothed):
+    """
+    Value at positions (sorted, unique) of a piecewise constant firing rate (fr_values between fr_starts and fr_stops,
+    sorted and contiguous; 0 elsewhere, over n_indices bins), optionally smoothed by a centered boxcar
+    of kernel_size bins: equal to np.convolve(firing_rate, kernel, mode='same')[positions],
+    with means over the available bins near the edges.
+
+    The firing rate is only rebuilt over stretches of positions closer than kernel_size bins
+    (of at most 1e6 bins), and smoothed with np.convolve so that values are identical.
+    """
+    if not smoothed:
+        return piecewise_constant_windows_numba(positions, positions + 1, fr_starts, fr_stops, fr_values)[0]
+
+    half_kernel_size = kernel_size // 2
+    kernel = np.ones(kernel_size) / kernel_size
+    out = np.empty(len(positions))
+
+    # within kernel_size bins of the edges: mean over the available bins
+    edge = (positions < kernel_size) | (positions >= n_indices - kernel_size)
+    i_edge = np.nonzero(edge)[0]
+    lefts = np.maximum(0, positions[i_edge] - half_kernel_size)
+    rights = np.maximum(lefts, np.minimum(n_indices, positions[i_edge] + half_kernel_size))
+    values, offsets = piecewise_constant_windows_numba(lefts, rights, fr_starts, fr_stops, fr_values)
+    for m, i in enumerate(i_edge):
+        window = values[offsets[m]:offsets[m+1]]
+        out[i] = np.mean(window) if len(window) > 0 else np.nan
+
+    # elsewhere: convolution over stretches of close positions
+    i_center = np.nonzero(~edge)[0]
+    p = positions[i_center]
+    chunk_size = int(1e6)
+    new_stretch = (np.diff(p) > kernel_size) | (np.diff(p // chunk_size) != 0)
+    stretches = np.concatenate([[0], np.nonzero(new_stretch)[0] + 1, [len(p)]]) if len(p) > 0 else [0]
+    for s0, s1 in zip(stretches[:-1], stretches[1:]):
+        left = p[s0] - half_kernel_size
+        right = p[s1-1] + (kernel_size - 1)//2 + 1
+        values, _ = piecewise_constant_windows_numba(np.array([left]), np.array([right]),
+                                                     fr_starts, fr_stops, fr_values)
+        out[i_center[s0:s1]] = np.convolve(values, kernel, mode='valid')[p[s0:s1] - p[s0]]
+    return out
+
+@njit(cache=True)
+def piecewise_constant_windows_numba(lefts, rights, fr_starts, fr_stops, fr_values):
+    """
+    Values of a piecewise constant function (fr_values between fr_starts and fr_stops,
+    sorted and contiguous; 0 elsewhere) over the windows [lefts[m], rights[m][,
+    concatenated (window m is values[offsets[m]:offsets[m+1]]).
+    """
+    n = lefts.shape[0]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    for m in range(n):
+        offsets[m + 1] = offsets[m] + (rights[m] - lefts[m])
+    values = np.zeros(offsets[n])
+    for m in range(n):
+        a, b = lefts[m], rights[m]
+        k = max(np.searchsorted(fr_starts, a, side='right') - 1, 0)
+        while k < fr_starts.shape[0] and fr_starts[k] < b:
+            lo, hi = max(a, fr_starts[k]), min(b, fr_stops[k])
+            for q in range(lo, hi):
+                values[offsets[m] + q - a] = fr_values[k]
+            k += 1
+    return values, offsets
+
+def firing_rate_quantiles(fr_starts, fr_stops, fr_values, n_indices, kernel_size, smoothed, quantiles,
+                          chunk_size=int(1e6), n_hist_bins=2**16):
+    """
+    Quantiles (linear interpolation, like np.quantile) of the firing rate
+    of inverse_isi_firing_rate over all n_indices bins of the recording.
+
+    The firing rate is evaluated chunk by chunk in three passes (range, histogram, values of the histogram bins
+    holding the required order statistics), so that memory does not scale with the recording length.
+    """
+    chunks = [(c0, min(c0 + chunk_size, n_indices)) for c0 in range(0, n_indices, chunk_size)]
+    def rates(c0, c1):
+        return inverse_isi_firing_rate(np.arange(c0, c1, dtype=np.int64), fr_starts, fr_stops, fr_values,
+                                       n_indices, kernel_size, smoothed)
+
+    # order statistics required by the quantiles (see np.quantile)
+    virtual_indexes = np.asarray(quantiles, dtype=np.float64) * (n_indices - 1)
+    above_bounds = virtual_indexes >= n_indices - 1
+    previous_indexes = np.floor(virtual_indexes).astype(np.int64)
+    next_indexes = previous_indexes + 1
+    previous_indexes[above_bounds] = next_indexes[above_bounds] = n_indices - 1
+    ranks = np.unique(np.concatenate((previous_indexes, next_indexes)))
+
+    # pass 1: range of values
+    lo, hi = np.inf, -np.inf
+    for c0, c1 in chunks:
+        r = rates(c0, c1)
+        if np.any(np.isnan(r)):
+            return np.full(len(quantiles), np.nan)
+        lo, hi = min(lo, r.min()), max(hi, r.max())
+
+    if lo == hi:
+        order_stats = np.full(len(ranks), lo)
+    else:
+        def hist_bins(r):
+            return np.minimum(((r - lo) / (hi - lo) * n_hist_bins).astype(np.int64), n_hist_bins - 1)
+        # pass 2: histogram of values
+        counts = np.zeros(n_hist_bins, dtype=np.int64)
+        for c0, c1 in chunks:
+            counts += np.bincount(hist_bins(rates(c0, c1)), minlength=n_hist_bins)
+        cum_counts = np.cumsum(counts)
+        ranks_bins = np.searchsorted(cum_counts, ranks, side='right')
+        needed_bins = np.unique(ranks_bins)
+        # pass 3: values of the histogram bins holding the order statistics
+        values = []
+        for c0, c1 in chunks:
+            r = rates(c0, c1)
+            values.append(r[np.isin(hist_bins(r), needed_bins)])
+        values = np.sort(np.concatenate(values))
+        # rank of the first value of every needed histogram bin among sorted values
+        first_ranks = cum_counts[needed_bins] - counts[needed_bins]
+        values_offsets = np.concatenate(([0], np.cumsum(counts[needed_bins])[:-1]))
+        b = np.searchsorted(needed_bins, ranks_bins)
+        order_stats = values[values_offsets[b] + ranks - first_ranks[b]]
+
+    # linear interpolation (see numpy's _lerp)
+    previous_values = order_stats[np.searchsorted(ranks, previous_indexes)]
+    next_values = order_stats[np.searchsorted(ranks, next_indexes)]
+    gamma = virtual_indexes - np.where(above_bounds, -1, previous_indexes)
+    diff = next_values - previous_values
+    return np.where(gamma >= 0.5, next_values - diff * (1 - gamma), previous_values + diff * gamma)
+
+@njit(cache=True)
+def ccg_vs_fr_counts_numba(starts, times_2, bin_numbers, valid, n_time_bins, n_fr_bins):
+    """
+    For every valid spike of neuron 1, increments spike_counts[bin_numbers[i]]
+    with the spikes of neuron 2 (sorted, unique) between starts[i] and starts[i]+n_time_bins.
+    """
+    spike_counts = np.zeros((n_fr_bins, n_time_bins))
+    times = np.zeros(n_fr_bins, dtype=np.int64)
+    for i in range(starts.shape[0]):
+        if not valid[i]:
+            continue
+        start = starts[i]
+        b = bin_numbers[i]
+        j = np.searchsorted(times_2, start)
+        while j < times_2.shape[0] and times_2[j] < start + n_time_bins:
+            spike_counts[b, times_2[j] - start] += 1
+            j += 1
+        times[b] += 1
+    return spike_counts, times
+
 def ccg_vs_fr(times_1, times_2, win_size, bin_size, fs=30000, num_firing_rate_bins=10, smooth=250):
     """
     Computes a "three dimensional" cross-correlogram that shows firing regularity when the neuron is
@@ -1068,7 +1456,9 @@ def convert_acg_log(lin_acg, cbin, cwin, n_log_bins=100,
     assert cbin <= cwin, "cbin must be smaller than cwin"
     assert n_log_bins>1, "n_log_bins must be strictly larger than 1"
 
-    original_bins = np.arange(-cwin//2, cwin//2+cbin, cbin)
+    # same time axis as crosscorr_vs_firing_rate (also valid for odd cwin)
+    winsize_bins = 2 * int(.5 * cwin *1./ cbin) + 1
+    original_bins = (np.arange(winsize_bins) - winsize_bins//2) * cbin
     lin_acg = lin_acg.T # (n_freqs, n_bins) to (n_bins, n_freqs) if 2D
     assert original_bins.shape[0] == lin_acg.shape[0],\
         ("Mismatch between the expected acg array shape given cbin and cwin and the provided acg array"
@@ -1146,7 +1536,8 @@ def get_ccgstack_fullname(name=None, cbin=0.2, cwin=80,
 
 
 def ccg_stack(dp, U_src=[], U_trg=[], cbin=0.2, cwin=80, normalize='Counts',
-                all_to_all=False, name=None, sav=True, again=False, periods='all', parallel=True):
+                all_to_all=False, name=None, sav=True, again=False, periods='all', parallel=True,
+                out_of_core=False):
     '''
     Routine generating a stack of correlograms for faster subsequent analysis,
     between all U_src and U_trg units.
@@ -1169,6 +1560,9 @@ def ccg_stack(dp, U_src=[], U_trg=[], cbin=0.2, cwin=80, normalize='Counts',
         - again:     bool, whether to recompute the stack even if it already exists in cache.
         - periods:   list of tuples, periods to compute ccgs from. | Default: all
         - parallel:  bool, whether to compute ccgs on parallel cpu cores. | Default: True
+        - out_of_core: bool, whether to write the stack block by block in a memory-mapped .npy file
+                       in routines memory rather than holding it in RAM (for very large populations).
+                       The stack is then returned (and reloaded) as a read-only memmap. A name must be provided.
     Returns:
         - sigstack: np array, ccg stack containing the ccgs, of shape (U_src=U_trg, cwin//cbin+1,) if all_to_all=False or else (U_src, U_trg, cwin//cbin+1,)
         - sigustack: np array, matching unit pairs for each ccg, of shape (U_src=U_trg,) if all_to_all=False or else (U_src, U_trg,)
@@ -1179,7 +1573,7 @@ def ccg_stack(dp, U_src=[], U_trg=[], cbin=0.2, cwin=80, normalize='Counts',
     if name is not None:
         fn, fnu = get_ccgstack_fullname(name=name, cbin=cbin, cwin=cwin, normalize=normalize, periods=periods)
         if op.exists(dpnm/fn) and not again:
-            stack=np.load(dpnm/fn)
+            stack=np.load(dpnm/fn, mmap_mode='r' if out_of_core else None)
             ustack=np.load(dpnm/fnu)
             if all_to_all:
                 assert stack.ndim==3
@@ -1190,64 +1584,704 @@ def ccg_stack(dp, U_src=[], U_trg=[], cbin=0.2, cwin=80, normalize='Counts',
             if Nu==0: return npa([]),npa([])
 
     assert len(U_src)>0 and len(U_trg)>0, 'You need to provide at least one source and one target unit!'
+    if out_of_core:
+        assert name is not None, 'You need to provide a name to compute an out of core ccg stack!'
     bins=get_bins(cwin, cbin)
+    symmetric = all_to_all and len(U_src)==len(U_trg) and np.all(npa(U_src)==npa(U_trg))
     if all_to_all:
         ustack=npa(zeros=(len(U_src), len(U_trg), 2)).astype(npa(U_src).dtype)
-        stack=npa(zeros=(len(U_src), len(U_trg), len(bins))).astype(float)
+        ustack[:, :, 0]=npa(U_src)[:, None]
+        ustack[:, :, 1]=npa(U_trg)[None, :]
+        stack_shape=(len(U_src), len(U_trg), len(bins))
+    else:
+        assert len(U_src)==len(U_trg), 'You need to feed in the same number N of source and target units to compute N ccgs!'
+        assert not np.any(npa(U_src)==npa(U_trg)), 'Looks like you requested to compute a CCG between a unit and itself - check U_src and U_trg.'
+        ustack=npa(zeros=(len(U_src), 2))
+        ustack[:, 0], ustack[:, 1] = U_src, U_trg
+        stack_shape=(len(U_src), len(bins))
+    if out_of_core:
+        # written to a temporary file, renamed once complete
+        # (so that an interrupted computation is never reloaded)
+        fn_tmp=fn.replace('.npy', '_tmp.npy')
+        stack=np.lib.format.open_memmap(dpnm/fn_tmp, mode='w+', dtype=np.float64, shape=stack_shape)
+    else:
+        stack=np.zeros(stack_shape)
+
+    if assert_multi(dp):
+        # merged datasets: ccg() reads trains of units from the same source dataset
+        # from this source dataset, so ccgs are computed pair by pair
+        stack=ccg_stack_pairwise(dp, U_src, U_trg, stack, cbin, cwin, normalize, all_to_all, periods, parallel)
+    elif not all_to_all:
+        # only the requested pairs are computed
+        stack=ccg_stack_pairs(dp, U_src, U_trg, stack, cbin, cwin, normalize, periods)
+    else:
+        stack=ccg_stack_population(dp, U_src, U_trg, stack, cbin, cwin, normalize, all_to_all, periods, parallel)
+
+    # (only the upper half is computed - ccgs of the lower half are flipped, normalized as the upper half)
+    # row by row, not to load the whole stack in memory if out of core
+    if symmetric:
+        for i1 in range(len(U_src)-1):
+            stack[i1+1:, i1, :]=stack[i1, i1+1:, ::-1]
+
+    if out_of_core:
+        stack.flush()
+        del stack
+        os.replace(dpnm/fn_tmp, dpnm/fn)
+        np.save(dpnm/fnu, ustack)
+        return np.load(dpnm/fn, mmap_mode='r'), ustack
+
+    if sav and name is not None:
+        np.save(dpnm/fn, stack)
+        np.save(dpnm/fnu, ustack)
+
+    return stack, ustack
+
+def iter_stack_blocks(stack, block_size=None):
+    '''
+    Iterates over blocks of rows of a (possibly memory-mapped) ccg stack,
+    loading one block at a time in memory.
+    Arguments:
+        - stack: (N, ...) array or memmap, ccg stack (see ccg_stack)
+        - block_size: int, number of rows per block.
+                      If None, set to use at most an eighth of the available memory.
+    Yields:
+        - i: int, index of the first row of the block
+        - block: np array, stack[i:i+block_size]
+    '''
+    if block_size is None:
+        row_bytes=max(stack[:1].nbytes, 1)
+        block_size=int(np.clip(psutil.virtual_memory().available/8//row_bytes, 1, max(len(stack), 1)))
+    for i in range(0, len(stack), block_size):
+        yield i, np.asarray(stack[i:i+block_size])
+
+def ccg_stack_population(dp, U_src, U_trg, stack, cbin, cwin, normalize='Counts',
+                         all_to_all=False, periods='all', parallel=True, fs=30000):
+    """
+    Fills the ccg stack (see ccg_stack) from population ccgs (ccg_population)
+    computed on blocks of units small enough to fit in memory.
+    """
+    U_src, U_trg = npa(U_src), npa(U_trg)
+    U_all=np.unique(np.append(U_src, U_trg))
+    trains=dict(zip(U_all, trn_many(dp, U_all, periods=periods)))
+
+    # split units in blocks such that a population ccg of 2 blocks fits in memory
+    # (int32 counts, float64 normalized ccgs and temporary copies ~ 32 bytes per bin)
+    n_bins=len(get_bins(cwin, cbin))
+    max_memory=psutil.virtual_memory().available/4
+    block_size=int(np.clip(np.sqrt(max_memory/(32*n_bins))/2, 2, len(U_all)))
+    blocks=np.array_split(U_all, int(np.ceil(len(U_all)/block_size)))
+    block_ids=dict(zip(U_all, np.concatenate([[b]*len(blk) for b, blk in enumerate(blocks)])))
+    b_src=npa([block_ids[u] for u in U_src])
+    b_trg=npa([block_ids[u] for u in U_trg])
+
+    for b1 in range(len(blocks)):
+        for b2 in range(b1, len(blocks)):
+            U_blk=np.unique(np.append(blocks[b1], blocks[b2]))
+            if all_to_all:
+                m=((b_src[:, None]==b1)&(b_trg[None, :]==b2))|((b_src[:, None]==b2)&(b_trg[None, :]==b1))
+                i1, i2=np.nonzero(m)
+                u1, u2=U_src[i1], U_trg[i2]
+            else:
+                m=((b_src==b1)&(b_trg==b2))|((b_src==b2)&(b_trg==b1))
+                i1=np.nonzero(m)[0]
+                u1, u2=U_src[i1], U_trg[i1]
+            if len(i1)==0: continue
+            C=ccg_population(dp, U_blk, cbin, cwin, fs, normalize, periods,
+                             trains=[trains[u] for u in U_blk], parallel=parallel)
+            p1, p2=np.searchsorted(U_blk, u1), np.searchsorted(U_blk, u2)
+            if all_to_all:
+                stack[i1, i2, :]=C[p1, p2, :]
+            else:
+                stack[i1, :]=C[p1, p2, :]
+
+    return stack
+
+def ccg_stack_pairs(dp, U_src, U_trg, stack, cbin, cwin, normalize='Counts',
+                    periods='all', fs=30000):
+    """
+    Fills the ccg stack (see ccg_stack) with the ccgs of pairs U_src[i], U_trg[i] (ccg_pairs),
+    computed and written block of pairs by block of pairs
+    (so that a memory-mapped stack is never held in memory at once).
+    """
+    U_src, U_trg = npa(U_src), npa(U_trg)
+    U_all=np.unique(np.append(U_src, U_trg))
+    trains=dict(zip(U_all, trn_many(dp, U_all, periods=periods)))
+    pairs=np.column_stack((U_src, U_trg))
+
+    # blocks of pairs such that their ccgs fit in memory
+    # (int64 counts, float64 normalized ccgs and temporary copies ~ 32 bytes per bin)
+    n_bins=stack.shape[1]
+    block_size=int(np.clip(psutil.virtual_memory().available/8//(32*n_bins), 1, max(len(pairs), 1)))
+    for i in range(0, len(pairs), block_size):
+        stack[i:i+block_size]=ccg_pairs(dp, pairs[i:i+block_size], cbin, cwin, fs, normalize,
+                                        periods, trains=trains)
+
+    return stack
+
+def ccg_population(dp, U, bin_size, win_size, fs=30000, normalize='Hertz',
+                   periods='all', trains=None, enforced_rp=0, parallel=False):
+    """
+    Computes all crosscorrelograms between units U at once,
+    from a single pass over their concatenated spike trains.
+
+    Arguments:
+     - dp: str, datapath
+     - U: list/array of units
+     - bin_size, win_size: float, crosscorrelograms bin and window size, in milliseconds.
+     - fs: sampling frequency, in Hertz.
+     - normalize: 'Counts', 'Hertz', 'Pearson' or 'zscore' (see ccg)
+     - periods: 'all' or [[t1,t2], [t3,t4]...] (seconds)
+     - trains: optional list of spike trains of units U, in SAMPLES
+     - enforced_rp: float, enforced refractory period (ms)
+     - parallel: bool, see crosscorr_cyrille
+
+    Returns:
+     - C: (len(U), len(U), n_bins) array, C[i,j] is equal to ccg(dp, [U[i], U[j]], ...)[0,1]
+          (C[i,i] to acg(dp, U[i], ...)). Ccgs are normalized by the spike count of their trigger unit (row).
+    """
+    assert normalize in ['Counts', 'Hertz', 'Pearson', 'zscore'], \
+        "WARNING ccg_population() 'normalize' argument should be a string in ['Counts', 'Hertz', 'Pearson', 'zscore']."
+    U=npa(U).ravel()
+    bin_size = np.clip(bin_size, 1000*1./fs, 1e8)
+    if trains is None:
+        trains=trn_many(dp, U, periods=periods, enforced_rp=enforced_rp)
+    assert len(trains)==len(U), 'You must feed as many trains as units!'
+
+    # the spikes of units are concatenated in the order of U and stable-sorted,
+    # so that simultaneous spikes are ordered like in ccg()
+    N=npa([len(t) for t in trains]).astype(np.int64)
+    times=np.concatenate([np.asarray(t) for t in trains]).astype(np.int64)
+    clusters=np.repeat(np.arange(len(U)), N)
+    sorti=np.argsort(times, kind='stable')
+    C_present=crosscorr_cyrille(times[sorti], clusters[sorti], win_size, bin_size, fs, True,
+                                parallel=parallel, cache_results=False)
+
+    # units without any spike have empty ccgs
+    present=_unique(clusters)
+    C=np.zeros((len(U), len(U), C_present.shape[2]))
+    C[np.ix_(present, present)]=C_present
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalize == 'Hertz':
+            C=C*1./(N*bin_size*1./1000)[:, None, None]
+        elif normalize == 'Pearson':
+            C=C*1./np.sqrt(N[:, None]*N[None, :])[:, :, None]
+        elif normalize == 'zscore':
+            frac=4./5
+            n=C.shape[2]
+            edges=np.concatenate((C[..., :int(n*frac/2)], C[..., int(n*(1-frac/2)):]), axis=2)
+            mn, sd=np.mean(edges, axis=2), np.std(edges, axis=2)
+            sd[sd==0]=1
+            C=(C-mn[..., None])*1./sd[..., None]
+
+    return C
+
+def ccg_pairs(dp, pairs, bin_size, win_size, fs=30000, normalize='Counts',
+              periods='all', trains=None, enforced_rp=0):
+    """
+    Computes the crosscorrelograms of a list of unit pairs only,
+    rather than all crosscorrelograms between the units they involve (see ccg_population).
+    Each pair is computed from a sweep over the merged spike trains of its two units only,
+    pairs being distributed over parallel threads.
+
+    Arguments:
+     - dp: str, datapath (can be None if trains are provided)
+     - pairs: (n_pairs, 2) array of units
+     - bin_size, win_size: float, crosscorrelograms bin and window size, in milliseconds.
+     - fs: sampling frequency, in Hertz.
+     - normalize: 'Counts', 'Hertz', 'Pearson' or 'zscore' (see ccg)
+     - periods: 'all' or [[t1,t2], [t3,t4]...] (seconds)
+     - trains: optional dict {unit: train} of spike trains of units in pairs, in SAMPLES
+     - enforced_rp: float, enforced refractory period (ms)
+
+    Returns:
+     - C: (n_pairs, n_bins) array, C[i] is equal to ccg(dp, pairs[i], ...)[0,1].
+          Ccgs are normalized by the spike count of their trigger unit (pairs[i,0]).
+    """
+    assert normalize in ['Counts', 'Hertz', 'Pearson', 'zscore'], \
+        "WARNING ccg_pairs() 'normalize' argument should be a string in ['Counts', 'Hertz', 'Pearson', 'zscore']."
+    pairs=npa(pairs)
+    assert pairs.ndim==2 and pairs.shape[1]==2, 'pairs must be a (n_pairs, 2) array of units!'
+    U=np.unique(pairs)
+    if trains is None:
+        trains=dict(zip(U, trn_many(dp, U, periods=periods, enforced_rp=enforced_rp)))
+    assert np.all(np.isin(U, list(trains.keys()))), 'You must feed the trains of all units in pairs!'
+
+    bin_size = np.clip(bin_size, 1000*1./fs, 1e8)
+    win_size = np.clip(win_size, 1e-2, 1e8)
+    half_winsize_bins = int(.5 * win_size *1./ bin_size)
+    samples_per_bin = int(np.ceil(fs * bin_size*1./1000))
+
+    N=npa([len(trains[u]) for u in U]).astype(np.int64)
+    times=np.concatenate([np.asarray(trains[u]).ravel() for u in U]).astype(np.int64)
+    offsets=np.append(0, np.cumsum(N)).astype(np.int64)
+    pairs_i=np.searchsorted(U, pairs).astype(np.int64)
+    C=ccg_pairs_numba(times, offsets, pairs_i, samples_per_bin, half_winsize_bins).astype(np.float64)
+
+    N1, N2 = N[pairs_i[:, 0]], N[pairs_i[:, 1]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalize == 'Hertz':
+            C=C*1./(N1*bin_size*1./1000)[:, None]
+        elif normalize == 'Pearson':
+            C=C*1./np.sqrt(N1*N2)[:, None]
+        elif normalize == 'zscore':
+            frac=4./5
+            n=C.shape[1]
+            edges=np.concatenate((C[:, :int(n*frac/2)], C[:, int(n*(1-frac/2)):]), axis=1)
+            mn, sd=np.mean(edges, axis=1), np.std(edges, axis=1)
+            sd[sd==0]=1
+            C=(C-mn[:, None])*1./sd[:, None]
+
+    return C
+
+@njit(cache=True, parallel=True)
+def ccg_pairs_numba(times, offsets, pairs_i, samples_per_bin, half_winsize_bins):
+    """
+    Crosscorrelograms of pairs of units, each computed on its own thread
+    with ccg_sweep_numba over the merged (sorted) trains of its two units,
+    then symmetrized like in crosscorr_cyrille.
+
+    - times: (n_spikes,) int64 array, concatenated sorted trains of all units (samples)
+    - offsets: (n_units+1,) int64 array, boundaries of units trains in times
+    - pairs_i: (n_pairs, 2) int64 array, indices of pairs units (units sorted in ascending order)
+    - samples_per_bin: int, bin size (samples)
+    - half_winsize_bins: int, last bin of the positive half of the ccgs
+
+    Returns:
+     - ccgs: (n_pairs, 2*half_winsize_bins+1) int64 array
+    """
+    n_pairs = pairs_i.shape[0]
+    hw = half_winsize_bins
+    ccgs = np.zeros((n_pairs, 2 * hw + 1), dtype=np.int64)
+    no_log_bins = np.zeros(0, dtype=np.float64)
+    for p in prange(n_pairs):
+        t1 = times[offsets[pairs_i[p, 0]]:offsets[pairs_i[p, 0] + 1]]
+        t2 = times[offsets[pairs_i[p, 1]]:offsets[pairs_i[p, 1] + 1]]
+        n1, n2 = t1.shape[0], t2.shape[0]
+        # merge (simultaneous spikes ordered by unit index, like in ccg(),
+        # as the center bin of symmetrized ccgs is sensitive to the order of identical spikes)
+        first_wins = pairs_i[p, 0] < pairs_i[p, 1]
+        merged = np.empty(n1 + n2, dtype=np.int64)
+        clusters_i = np.empty(n1 + n2, dtype=np.int64)
+        i1, i2 = 0, 0
+        for k in range(n1 + n2):
+            if i2 >= n2 or (i1 < n1 and (t1[i1] < t2[i2] or (first_wins and t1[i1] == t2[i2]))):
+                merged[k] = t1[i1]
+                clusters_i[k] = 0
+                i1 += 1
+            else:
+                merged[k] = t2[i2]
+                clusters_i[k] = 1
+                i2 += 1
+        correlograms = np.zeros((2, 2, hw + 1), dtype=np.int32)
+        ccg_sweep_numba(merged, clusters_i, correlograms, 0, n1 + n2,
+                        samples_per_bin, hw, no_log_bins)
+        for b in range(1, hw + 1):
+            ccgs[p, hw - b] = correlograms[1, 0, b]
+            ccgs[p, hw + b] = correlograms[0, 1, b]
+        ccgs[p, hw] = max(correlograms[0, 1, 0], correlograms[1, 0, 0])
+    return ccgs
+
+def ccg_time_resolved(dp, U, bin_size, win_size, periods=None, window=None, step=None,
+                      fs=30000, normalize='Counts', trains=None, enforced_rp=0, parallel=False):
+    """
+    Computes all crosscorrelograms between units U in every period of time (e.g. behavioural epochs,
+    or sliding windows) at once, from a single pass over their concatenated spike trains.
+
+    Every pair of spikes is attributed to the period(s) of its reference (trigger) spike:
+    C[p,i,j] is the ccg of the spikes of U[i] fired during period p against all spikes of U[j].
+    (unlike ccg(..., periods=[period]), target spikes are not restricted to the period,
+     so that ccgs are not truncated at the edges of periods).
+
+    Arguments:
+     - dp: str, datapath
+     - U: list/array of units
+     - bin_size, win_size: float, crosscorrelograms bin and window size, in milliseconds.
+     - periods: [[t1,t2], [t3,t4]...] (seconds), periods of time (can overlap).
+                If None, sliding windows of width window and step step are used.
+     - window, step: float, width and step of sliding windows covering the recording (seconds).
+                     step defaults to window (contiguous windows).
+     - fs: sampling frequency, in Hertz.
+     - normalize: 'Counts', 'Hertz', 'Pearson' or 'zscore' (see ccg).
+                  Ccgs are normalized by the spike counts of units within each period.
+     - trains: optional list of spike trains of units U, in SAMPLES (dp can then be None)
+     - enforced_rp: float, enforced refractory period (ms)
+     - parallel: bool, whether to run the sweep over time blocks on parallel threads.
+
+    Returns:
+     - C: (n_periods, len(U), len(U), n_bins) array, time resolved crosscorrelograms.
+     - periods: (n_periods, 2) array, periods of time of C (seconds).
+    """
+    assert normalize in ['Counts', 'Hertz', 'Pearson', 'zscore'], \
+        "WARNING ccg_time_resolved() 'normalize' argument should be a string in ['Counts', 'Hertz', 'Pearson', 'zscore']."
+    U=npa(U).ravel()
+    if trains is None:
+        trains=trn_many(dp, U, enforced_rp=enforced_rp)
+    assert len(trains)==len(U), 'You must feed as many trains as units!'
+
+    if periods is None:
+        assert window is not None, 'You must provide either periods or a sliding window width!'
+        if step is None: step=window
+        if dp is not None:
+            rec_len=get_rec_len(dp)
+        else: # custom trains only
+            rec_len=max([t[-1] for t in trains if len(t)>0]+[0])/fs
+        starts=np.arange(0, max(rec_len-window, 0)+step*1e-6, step)
+        periods=np.vstack((starts, starts+window)).T
+    periods=check_periods(periods)
+    assert not isinstance(periods, str), "periods must be a list of periods of time, not 'all'!"
+    n_periods=len(periods)
+
+    # Parameter check (see crosscorr_cyrille)
+    assert fs > 0.
+    bin_size = np.clip(bin_size, 1000*1./fs, 1e8)
+    win_size = np.clip(win_size, 1e-2, 1e8)
+    winsize_bins = 2 * int(.5 * win_size *1./ bin_size) + 1
+    samples_per_bin = int(np.ceil(fs * bin_size*1./1000))
+    assert samples_per_bin >= 1
+
+    # concatenated and stable-sorted spikes of units (simultaneous spikes ordered like in ccg())
+    N_all=npa([len(t) for t in trains]).astype(np.int64)
+    times=np.concatenate([np.asarray(t) for t in trains]+[np.zeros(0)]).astype(np.int64)
+    clusters=np.repeat(np.arange(len(U)), N_all).astype(np.int64)
+    sorti=np.argsort(times, kind='stable')
+    times, clusters = times[sorti], clusters[sorti]
+
+    # periods of every spike, as ragged arrays (period_ids[period_offsets[i]:period_offsets[i+1]])
+    # (bounds included, like trn(..., periods))
+    lo=np.searchsorted(times, periods[:,0]*fs, side='left')
+    hi=np.searchsorted(times, periods[:,1]*fs, side='right')
+    n_in=hi-lo
+    spike_ids=np.concatenate([np.arange(l, h) for l, h in zip(lo, hi)]+[np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    period_ids=np.repeat(np.arange(n_periods), n_in).astype(np.int64)
+    sortp=np.argsort(spike_ids, kind='stable')
+    spike_ids, period_ids = spike_ids[sortp], period_ids[sortp]
+    period_offsets=np.zeros(len(times)+1, dtype=np.int64)
+    period_offsets[1:]=np.cumsum(np.bincount(spike_ids, minlength=len(times)))
+
+    # Single sorted sweep: pairs are counted once, in the periods of the earlier spike (positive half)
+    # and in the periods of the later spike (negative half, flipped below).
+    shape=(n_periods, len(U), len(U), winsize_bins // 2 + 1)
+    n_blocks = 1
+    if parallel:
+        max_block_memory = psutil.virtual_memory().available / 4
+        n_blocks = int(np.clip(max_block_memory // (2*4*np.prod(shape)), 1, num_cores))
+        n_blocks = min(n_blocks, max(1, len(times)//1000))
+    fwd, bwd = ccg_sweep_periods_blocks_numba(times, clusters, period_offsets, period_ids, shape,
+                                              n_blocks, samples_per_bin, winsize_bins // 2)
+
+    # Remove ACG peaks and symmetrize the central bin (see crosscorr_cyrille)
+    fwd[:, np.arange(len(U)), np.arange(len(U)), 0] = 0
+    bwd[:, np.arange(len(U)), np.arange(len(U)), 0] = 0
+    fwd[..., 0] = np.maximum(fwd[..., 0], bwd[..., 0])
+    C = np.concatenate((bwd[..., 1:][..., ::-1], fwd), axis=3).astype(np.float64)
+
+    # normalization by spike counts of units within each period
+    N=np.zeros((n_periods, len(U)))
+    np.add.at(N, (period_ids, clusters[spike_ids]), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalize == 'Hertz':
+            C=C*1./(N*bin_size*1./1000)[:, :, None, None]
+        elif normalize == 'Pearson':
+            C=C*1./np.sqrt(N[:, :, None]*N[:, None, :])[..., None]
+        elif normalize == 'zscore':
+            frac=4./5
+            n=C.shape[3]
+            edges=np.concatenate((C[..., :int(n*frac/2)], C[..., int(n*(1-frac/2)):]), axis=3)
+            mn, sd=np.mean(edges, axis=3), np.std(edges, axis=3)
+            sd[sd==0]=1
+            C=(C-mn[..., None])*1./sd[..., None]
+
+    return C, periods
+
+@njit(cache=True, nogil=True)
+def ccg_sweep_periods_numba(times, clusters_i, period_offsets, period_ids, fwd, bwd,
+                            i_start, i_end, samples_per_bin, half_winsize_bins):
+    """
+    Time resolved equivalent of ccg_sweep_numba (linear bins):
+    for every spike i in [i_start, i_end[ and every following spike j within the half window,
+    increments fwd[p, clusters_i[i], clusters_i[j], bin] for every period p of spike i
+    and bwd[p, clusters_i[j], clusters_i[i], bin] for every period p of spike j.
+
+    - period_offsets: (n_spikes+1,) int64 array, periods of spike i are period_ids[period_offsets[i]:period_offsets[i+1]]
+    - period_ids: int64 array, periods indices
+    - fwd, bwd: (n_periods, n_units, n_units, n_bins) int32 arrays, incremented in place
+    """
+    n = times.shape[0]
+    for i in range(i_start, i_end):
+        t_i = times[i]
+        c_i = clusters_i[i]
+        for j in range(i + 1, n):
+            b = (times[j] - t_i) // samples_per_bin
+            if b > half_winsize_bins:
+                break
+            c_j = clusters_i[j]
+            for m in range(period_offsets[i], period_offsets[i + 1]):
+                fwd[period_ids[m], c_i, c_j, b] += 1
+            for m in range(period_offsets[j], period_offsets[j + 1]):
+                bwd[period_ids[m], c_j, c_i, b] += 1
+
+@njit(cache=True, parallel=True)
+def ccg_sweep_periods_blocks_numba(times, clusters_i, period_offsets, period_ids, shape,
+                                   n_blocks, samples_per_bin, half_winsize_bins):
+    """
+    ccg_sweep_periods_numba ran on n_blocks blocks of spikes on parallel threads,
+    each block incrementing its own histograms (no race condition).
+    """
+    n = times.shape[0]
+    block_bounds = np.linspace(0, n, n_blocks + 1).astype(np.int64)
+    block_fwd = np.zeros((n_blocks, shape[0], shape[1], shape[2], shape[3]), dtype=np.int32)
+    block_bwd = np.zeros((n_blocks, shape[0], shape[1], shape[2], shape[3]), dtype=np.int32)
+    for k in prange(n_blocks):
+        ccg_sweep_periods_numba(times, clusters_i, period_offsets, period_ids,
+                                block_fwd[k], block_bwd[k], block_bounds[k], block_bounds[k + 1],
+                                samples_per_bin, half_winsize_bins)
+    fwd = np.zeros((shape[0], shape[1], shape[2], shape[3]), dtype=np.int32)
+    bwd = np.zeros((shape[0], shape[1], shape[2], shape[3]), dtype=np.int32)
+    for k in range(n_blocks):
+        fwd += block_fwd[k]
+        bwd += block_bwd[k]
+    return fwd, bwd
+
+@npyx_cacher
+def ccg_jitter_surrogates(dp, U, bin_size, win_size, jitter_window=25, n_surrogates=1000,
+                          alpha=0.05, seed=0, jitter_type='interval', fs=30000, normalize='Counts',
+                          periods='all', trains=None, enforced_rp=0,
+                          again=False, cache_results=True, cache_path=None):
+    """
+    Assesses the significance of all crosscorrelograms between units U
+    against spike-jittered surrogates (Fujisawa et al., 2008; Amarasingham et al., 2012).
+
+    All spikes are jittered at once for each surrogate, and surrogate ccgs are counted
+    by a compiled sorted sweep (see crosscorr_cyrille), ran in parallel across surrogates.
+    Surrogates are seeded (surrogate k with seed+k) and results cached, so that reruns are free.
+    Surrogates are counted in batches and only the lowest and highest values of every bin
+    required by the quantiles are kept, so that memory scales with alpha*n_surrogates rather than n_surrogates.
+
+    Arguments:
+     - dp: str, datapath
+     - U: list/array of units
+     - bin_size, win_size: float, crosscorrelograms bin and window size, in milliseconds.
+     - jitter_window: float, jitter window size, in milliseconds.
+     - n_surrogates: int, number of jittered surrogates.
+     - alpha: float, significance level of the bands (two-sided).
+     - seed: int, random seed of the first surrogate.
+     - jitter_type: 'interval' (spikes uniformly redrawn within fixed windows of size jitter_window,
+                    preserving spike counts in every window) or 'spike' (spikes uniformly jittered
+                    within jitter_window centered on themselves).
+     - fs: sampling frequency, in Hertz.
+     - normalize: 'Counts' or 'Hertz' (see ccg). Jittering preserves spike counts,
+                  so surrogates are normalized like the observed ccgs.
+     - periods: 'all' or [[t1,t2], [t3,t4]...] (seconds)
+     - trains: optional list of spike trains of units U, in SAMPLES
+     - enforced_rp: float, enforced refractory period (ms)
+     - again: bool, whether to recompute results rather than loading them from cache.
+     - cache_results: bool, whether to cache results at local_cache_memory.
+     - cache_path: None|str, where to cache results.
+                    If None, dp/.NeuroPyxels will be used.
+
+    Returns:
+     - C: (len(U), len(U), n_bins) array, observed crosscorrelograms (see ccg_population)
+     - pointwise_band: (2, len(U), len(U), n_bins) array, lower and upper alpha/2 pointwise
+                       quantiles of surrogate ccgs at every lag.
+     - global_band: (2, len(U), len(U), n_bins) array, lower and upper global bands (constant across lags):
+                    quantiles of the minimum and maximum of surrogate ccgs across lags,
+                    crossed by chance by a fraction alpha/2 of surrogates at any lag.
+    """
+    assert normalize in ['Counts', 'Hertz'], \
+        "WARNING ccg_jitter_surrogates() 'normalize' argument should be a string in ['Counts', 'Hertz']."
+    assert jitter_type in ['interval', 'spike'], "jitter_type must be either 'interval' or 'spike'!"
+    assert 0 < alpha < 1, "alpha must be between 0 and 1!"
+    U=npa(U).ravel()
+    if trains is None:
+        trains=trn_many(dp, U, periods=periods, enforced_rp=enforced_rp)
+    assert len(trains)==len(U), 'You must feed as many trains as units!'
+
+    # Parameter check (see crosscorr_cyrille)
+    bin_size = np.clip(bin_size, 1000*1./fs, 1e8)
+    win_size = np.clip(win_size, 1e-2, 1e8)
+    winsize_bins = 2 * int(.5 * win_size *1./ bin_size) + 1
+    samples_per_bin = int(np.ceil(fs * bin_size*1./1000))
+    jitter_samples = int(np.round(jitter_window*fs/1000))
+    assert jitter_samples >= 1, "jitter_window must be at least one sample long!"
+
+    N=npa([len(t) for t in trains]).astype(np.int64)
+    times=np.concatenate([np.asarray(t) for t in trains]+[np.zeros(0)]).astype(np.int64)
+    clusters=np.repeat(np.arange(len(U)), N).astype(np.int64)
+    sorti=np.argsort(times, kind='stable')
+    times, clusters = times[sorti], clusters[sorti]
+
+    C=ccg_population(dp, U, bin_size, win_size, fs, normalize, trains=trains)
+
+    # surrogates are counted in batches, only keeping the lowest and highest values
+    # of every ccg bin required by the quantiles (memory does not scale with n_surrogates)
+    q=np.array([alpha/2, 1-alpha/2])
+    n_low, n_high = order_stats_sizes(n_surrogates, q)
+    batch_size=min(max(n_low, n_high, 1), n_surrogates)
+    low, high, min_low, max_high = None, None, None, None
+    for k in range(0, n_surrogates, batch_size):
+        # half ccgs, symmetrized like in crosscorr_cyrille
+        S=ccg_jitter_surrogates_numba(times, clusters, len(U), min(batch_size, n_surrogates-k), jitter_samples,
+                                      seed+k, jitter_type=='interval', samples_per_bin, winsize_bins // 2)
+        S[:, np.arange(len(U)), np.arange(len(U)), 0] = 0
+        S[..., 0] = np.maximum(S[..., 0], np.transpose(S[..., 0], (0, 2, 1)))
+        # extrema across lags of full ccgs (negative lags are the transposed half ccgs)
+        S_min, S_max = S.min(axis=3), S.max(axis=3)
+        S_min=np.minimum(S_min, np.transpose(S_min, (0, 2, 1)))
+        S_max=np.maximum(S_max, np.transpose(S_max, (0, 2, 1)))
+        low, high = update_order_stats(low, high, S, n_low, n_high)
+        min_low, _ = update_order_stats(min_low, None, S_min, n_low, 0)
+        _, max_high = update_order_stats(None, max_high, S_max, 0, n_high)
+    del S
+
+    # full ccgs order statistics
+    low=np.concatenate((np.transpose(low[..., 1:][..., ::-1], (0, 2, 1, 3)), low), axis=3)
+    high=np.concatenate((np.transpose(high[..., 1:][..., ::-1], (0, 2, 1, 3)), high), axis=3)
+    scale=None
+    if normalize == 'Hertz':
+        scale=N*bin_size*1./1000
+
+    pointwise_band=np.zeros((2,)+low.shape[1:])
+    global_band=np.zeros_like(pointwise_band)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pointwise_band[0]=quantile_from_order_stats(low, high, n_surrogates, q[0], scale)
+        pointwise_band[1]=quantile_from_order_stats(low, high, n_surrogates, q[1], scale)
+        global_band[0]=quantile_from_order_stats(min_low, None, n_surrogates, q[0], scale)[..., None]
+        global_band[1]=quantile_from_order_stats(None, max_high, n_surrogates, q[1], scale)[..., None]
+
+    return C, pointwise_band, global_band
+
+def order_stats_sizes(n, q):
+    """
+    Number of lowest and highest values of n samples
+    required to compute their quantiles q (linear interpolation, like np.quantile).
+    """
+    virtual_indexes=np.asarray(q)*(n-1)
+    n_low=int(min(np.floor(virtual_indexes.min())+2, n))
+    n_high=int(min(n-np.floor(virtual_indexes.max()), n))
+    return n_low, n_high
+
+def update_order_stats(low, high, x, n_low, n_high):
+    """
+    Merges samples x (along axis 0) into the sorted n_low lowest and n_high highest samples seen so far.
+    low and high can be None at the first call.
+    """
+    if n_low>0:
+        low=x if low is None else np.concatenate((low, x), axis=0)
+        low=np.sort(low, axis=0)[:n_low]
+    if n_high>0:
+        high=x if high is None else np.concatenate((high, x), axis=0)
+        high=np.sort(high, axis=0)[-n_high:]
+    return low, high
+
+def order_stat(low, high, n, rank):
+    "Value of the sample of rank rank (out of n) along axis 0, from its lowest and highest samples."
+    if low is not None and rank < low.shape[0]:
+        return low[rank]
+    return high[rank-(n-high.shape[0])]
+
+def quantile_from_order_stats(low, high, n, q, scale=None):
+    """
+    Quantile q of n samples along axis 0, computed exactly like np.quantile(x, q, axis=0)
+    from their sorted lowest and highest samples (see order_stats_sizes).
+
+    - scale: optional (x.shape[1],) array, positive factor by which samples are divided
+             (along their axis 1) before interpolation.
+    """
+    virtual_index=np.float64(q)*(n-1)
+    prev_i=int(np.floor(virtual_index))
+    next_i=prev_i+1
+    if virtual_index >= n-1:
+        prev_i=next_i=n-1
+    a=order_stat(low, high, n, prev_i).astype(np.float64)
+    b=order_stat(low, high, n, next_i).astype(np.float64)
+    if scale is not None:
+        scale=scale.reshape((-1,)+(1,)*(a.ndim-1))
+        a, b = a/scale, b/scale
+    gamma=virtual_index-(prev_i if virtual_index < n-1 else -1)
+    diff_b_a=b-a
+    if gamma >= .5:
+        return b-diff_b_a*(1-gamma)
+    return a+diff_b_a*gamma
+
+@njit(cache=True, parallel=True)
+def ccg_jitter_surrogates_numba(times, clusters_i, n_units, n_surrogates, jitter_samples, seed,
+                                interval, samples_per_bin, half_winsize_bins):
+    """
+    Jitters all spikes and counts half crosscorrelograms (see ccg_sweep_numba)
+    of n_surrogates surrogates on parallel threads.
+
+    - times: (n_spikes,) int64 array, sorted spike times (samples)
+    - clusters_i: (n_spikes,) int64 array, indices of spikes units
+    - jitter_samples: int, jitter window (samples)
+    - seed: int, surrogate k is drawn with seed+k
+    - interval: bool, interval jitter (fixed windows) if True, else spike-centered jitter
+
+    Returns:
+    - (n_surrogates, n_units, n_units, half_winsize_bins+1) int32 array, half ccgs of surrogates
+    """
+    n = times.shape[0]
+    surrogates = np.zeros((n_surrogates, n_units, n_units, half_winsize_bins + 1), dtype=np.int32)
+    no_log_bins = np.zeros(0, dtype=np.float64)
+    for k in prange(n_surrogates):
+        np.random.seed(seed + k)
+        jittered = np.empty(n, dtype=np.int64)
+        for i in range(n):
+            if interval:
+                start = (times[i] // jitter_samples) * jitter_samples
+            else:
+                start = times[i] - jitter_samples // 2
+            jittered[i] = start + np.random.randint(0, jitter_samples)
+            # redraw spike-centered jitter falling before the recording start
+            # (rather than clipping it, which would pile spikes up at sample 0)
+            while jittered[i] < 0:
+                jittered[i] = start + np.random.randint(0, jitter_samples)
+        order = np.argsort(jittered, kind='mergesort')
+        ccg_sweep_numba(jittered[order], clusters_i[order], surrogates[k],
+                        0, n, samples_per_bin, half_winsize_bins, no_log_bins)
+    return surrogates
+
+def ccg_stack_pairwise(dp, U_src, U_trg, stack, cbin, cwin, normalize='Counts',
+                       all_to_all=False, periods='all', parallel=True):
+    """
+    Fills the ccg stack (see ccg_stack) by computing ccgs pair by pair with ccg().
+    """
+    if all_to_all:
         # Case where every CCG would be computed twice - it is worth it to half the time
-        if np.all(U_src==U_trg):
-            l=len(U_src)
-            ccg_inputs, ccg_ids = [], []
-            for i1, u1 in enumerate(U_src):
-                for i2, u2 in enumerate(U_trg):
-                    ustack[i1, i2, :]=[u1,u2]
-                    if i1==i2:
-                        ccg_ids.append([i1, u1, i2, u2])
-                        ccg_inputs.append((dp, [u1, u2], cbin, cwin, 30000, normalize, 1, 1, 0, periods, 0, None))
-                    elif i2>i1:
-                        ccg_ids.append([i1, u1, i2, u2])
-                        ccg_inputs.append((dp, [u1, u2], cbin, cwin, 30000, normalize, 1, 1, 0, periods, 0, None))
-
-            ccg_results = compute_ccgs_bulk(ccg_inputs, parallel)
-            
-            for ((i1, u1, i2, u2), CCG) in zip(ccg_ids,ccg_results):
-                if i1==i2:
+        symmetric = len(U_src)==len(U_trg) and np.all(npa(U_src)==npa(U_trg))
+        ccg_inputs, ccg_ids = [], []
+        for i1, u1 in enumerate(U_src):
+            for i2, u2 in enumerate(U_trg):
+                if symmetric and i2<i1: continue
+                ccg_ids.append([i1, u1, i2, u2])
+                ccg_inputs.append((dp, [u1, u2], cbin, cwin, 30000, normalize, 1, 1, 0, periods, 0, None))
+
+        for ccg_ids_chunk, ccg_results in compute_ccgs_bulk_chunks(ccg_ids, ccg_inputs, parallel):
+            for ((i1, u1, i2, u2), CCG) in zip(ccg_ids_chunk, ccg_results):
+                if symmetric and i1==i2:
                     stack[i1, i2, :]=CCG.squeeze()
-                elif i2>i1:
+                else:
                     stack[i1, i2, :]=CCG[0,1,:]
-                    stack[i2, i1, :]=stack[i1, i2, ::-1]
-        else:
-            ccg_inputs, ccg_ids = [], []
-            for i1, u1 in enumerate(U_src):
-                for i2, u2 in enumerate(U_trg):
-                    ustack[i1, i2, :]=[u1,u2]
-                    ccg_ids.append([i1, u1, i2, u2])
-                    ccg_inputs.append((dp, [u1, u2], cbin, cwin, 30000, normalize, 1, 1, 0, periods, 0, None))
-
-            ccg_results = compute_ccgs_bulk(ccg_inputs, parallel)
-            for ((i1, u1, i2, u2), CCG) in zip(ccg_ids,ccg_results):
-                stack[i1, i2, :]=CCG[0,1,:]
 
     else:
-        assert len(U_src)==len(U_trg), 'You need to feed in the same number N of source and target units to compute N ccgs!'
-        assert not np.any(U_src==U_trg), 'Looks like you requested to compute a CCG between a unit and itself - check U_src and U_trg.'
-        ustack=npa(zeros=(len(U_src), 2))
-        stack=npa(zeros=(len(U_src), len(bins)))
         ccg_inputs, ccg_ids = [], []
         for i, (u1, u2) in enumerate(zip(U_src, U_trg)):
-            ccg_ids.append([i, u1, u2])
+            ccg_ids.append(i)
             ccg_inputs.append((dp, [u1, u2], cbin, cwin, 30000, normalize, 1, 1, 0, periods, 0, None))
 
-        ccg_results = compute_ccgs_bulk(ccg_inputs, parallel)
-        for ((i, u1, u2), CCG) in zip(ccg_ids,ccg_results):
-            ustack[i, :]=[u1,u2]
-            stack[i, :]=CCG[0,1,:]
+        for ccg_ids_chunk, ccg_results in compute_ccgs_bulk_chunks(ccg_ids, ccg_inputs, parallel):
+            for (i, CCG) in zip(ccg_ids_chunk, ccg_results):
+                stack[i, :]=CCG[0,1,:]
 
-    if sav and name is not None:
-        np.save(dpnm/fn, stack)
-        np.save(dpnm/fnu, ustack)
+    return stack
 
-    return stack, ustack
+def compute_ccgs_bulk_chunks(ccg_ids, ccg_inputs, parallel=True, chunk_size=10000):
+    '''
+    Yields (ccg_ids, ccgs) chunks of compute_ccgs_bulk results,
+    so that all ccgs never need to be held in memory at the same time.
+    '''
+    for i in range(0, len(ccg_inputs), chunk_size):
+        yield ccg_ids[i:i+chunk_size], compute_ccgs_bulk(ccg_inputs[i:i+chunk_size], parallel)
 
 def compute_ccgs_bulk(ccg_inputs, parallel=True):
 
@@ -1279,6 +2313,83 @@ def get_ustack_i(U, ustack):
         ii[i]=npa(np.nonzero(np.all(mask, axis=ustack.ndim-1))).flatten()
     return ii.astype(np.int64)
 
+def get_candidate_pairs(dp, U_src, U_trg=None, max_distance=200, cross_probe=False, use_template=True):
+    '''
+    Finds the pairs of source and target units whose peak channels are closer than max_distance,
+    to restrict functional connectivity screening to pairs which can plausibly be connected
+    (rather than computing all U_src x U_trg ccgs).
+    Peak channels positions are queried with a KD-tree, probe by probe for merged datasets.
+    Arguments:
+        - dp: string, datapath
+        - U_src: list/array, source units
+        - U_trg: list/array, target units (if None, U_src)
+        - max_distance: float, maximum distance between peak channels of a pair (um)
+        - cross_probe: bool, whether to keep all pairs of units recorded on different probes
+                       (merged datasets only - their distance cannot be measured)
+        - use_template: bool, whether to use templates rather than raw data to find peak channels
+    Returns:
+        - pairs: (n_pairs, 2) array of (source, target) units.
+                 If U_src and U_trg are the same, every pair is returned once,
+                 oriented like the significant ccgs of ccg_sig_stack (source after target in U_src).
+        - distances: (n_pairs,) array, distance between peak channels of pairs (um) - nan across probes
+    '''
+    from scipy.spatial import cKDTree
+
+    U_src=npa(U_src).ravel()
+    U_trg=U_src.copy() if U_trg is None else npa(U_trg).ravel()
+    same_src_trg=len(U_src)==len(U_trg) and np.all(U_src==U_trg)
+    U=np.unique(np.append(U_src, U_trg))
+
+    # positions of peak channels (um), from the channel map of their source dataset
+    peak_chans=npyx.spk_wvf.get_depthSort_peakChans(dp, units=U, use_template=use_template)
+    peak_chans=peak_chans[np.argsort(peak_chans[:,0])]
+    assert np.all(peak_chans[:,0]==U), 'Could not find the peak channels of all units!'
+    multi=assert_multi(dp)
+    ds_ids=get_ds_ids(U) if multi else np.zeros(len(U), dtype=np.int64)
+    ds_table=get_ds_table(dp) if multi else None
+    positions=np.zeros((len(U), 2))
+    for ds_i in np.unique(ds_ids):
+        dp_ds=Path(ds_table.loc[ds_i, 'dp']) if multi else Path(dp)
+        channel_map=np.load(dp_ds/'channel_map.npy').ravel()
+        channel_positions=np.load(dp_ds/'channel_positions.npy')
+        m=ds_ids==ds_i
+        sorter=np.argsort(channel_map)
+        chan_i=np.searchsorted(channel_map, peak_chans[m,1].astype(np.int64), sorter=sorter)
+        chan_i=sorter[np.clip(chan_i, 0, len(channel_map)-1)]
+        assert np.all(channel_map[chan_i]==peak_chans[m,1]), f'Peak channels not found in channel map of {dp_ds}!'
+        positions[m]=channel_positions[chan_i]
+
+    # candidate pairs (indices of U), within probes then across probes
+    ii, jj, dd = [], [], []
+    for ds_i in np.unique(ds_ids):
+        ids=np.nonzero(ds_ids==ds_i)[0]
+        pairs_ds=cKDTree(positions[ids]).query_pairs(max_distance, output_type='ndarray')
+        ii.append(ids[pairs_ds[:,0]])
+        jj.append(ids[pairs_ds[:,1]])
+        dd.append(np.linalg.norm(positions[ids[pairs_ds[:,0]]]-positions[ids[pairs_ds[:,1]]], axis=1))
+    if cross_probe:
+        # probes of merged datasets are listed in their datasets table
+        probes=np.asarray(ds_table.loc[ds_ids, 'probe'], dtype=str) if multi else np.zeros(len(U))
+        i_x, j_x = np.nonzero(probes[:,None]!=probes[None,:])
+        m=i_x<j_x
+        ii.append(i_x[m])
+        jj.append(j_x[m])
+        dd.append(np.full(m.sum(), np.nan))
+    ii, jj, dd = np.concatenate(ii), np.concatenate(jj), np.concatenate(dd)
+
+    # orientation(s) of each pair matching source and target units
+    src_rank, trg_rank = np.full(len(U), -1), np.full(len(U), -1)
+    src_rank[np.searchsorted(U, U_src)]=np.arange(len(U_src))
+    trg_rank[np.searchsorted(U, U_trg)]=np.arange(len(U_trg))
+    i_s, i_t, dd = np.append(ii, jj), np.append(jj, ii), np.append(dd, dd)
+    m=(src_rank[i_s]>=0)&(trg_rank[i_t]>=0)
+    if same_src_trg:
+        m=m&(src_rank[i_s]>trg_rank[i_t])
+    order=np.lexsort((trg_rank[i_t[m]], src_rank[i_s[m]]))
+    pairs=np.column_stack((U[i_s[m]], U[i_t[m]]))[order]
+
+    return pairs, dd[m][order]
+
 #%% Assessment of significance of correlogram modulation
 
 def canUse_Nbins(a=0.05, w=100, b=0.2, n_bins=3):
@@ -1398,7 +2509,7 @@ def StarkAbeles2009_ccg_sig(CCG, W, WINTYPE='gauss', HF=None, CALCP=True, sgn=-1
 
     assert sgn in [1,-1]
 
-    assert sum(CCG<0) <= 0, 'CCG seems to contain negative integers!'
+    assert np.sum(CCG<0) <= 0, 'CCG seems to contain negative integers!'
 
     if CCG.ndim==1: CCG=CCG.reshape((1, CCG.shape[0]))
     m, n = CCG.shape
@@ -1421,8 +2532,8 @@ def StarkAbeles2009_ccg_sig(CCG, W, WINTYPE='gauss', HF=None, CALCP=True, sgn=-1
                          1: (local_gausskernel( W/2, 6 * W/2+2), W/2*3+0.5)}, # gaussian odd W
             winlist[1]: {0: (np.ones((1, W+1)), W/2), # rect even W
                          1: (np.ones((1, W)), np.ceil(W/2)-1)}, # rect odd W
-            winlist[2]:{0: (sgnl.triang(2*W+1), W), # triang even W
-                        1: (sgnl.triang(2*W-1), W-1)} # triang odd W
+            winlist[2]:{0: (sgnl.windows.triang(2*W+1), W), # triang even W
+                        1: (sgnl.windows.triang(2*W-1), W-1)} # triang odd W
             }
     win, cidx = conv_wins[WINTYPE][W%2]
 
@@ -1436,9 +2547,9 @@ def StarkAbeles2009_ccg_sig(CCG, W, WINTYPE='gauss', HF=None, CALCP=True, sgn=-1
 
     ## Compute p-value based on a Poisson ditribution with a continuity correction
     if CALCP:
-        pvals = npa(zeros=CCG.shape)
-        for i, (c, p) in enumerate(zip(CCG.flatten(),pred.flatten())):
-            pvals[i] = 1 - cdf_poisson(c-1, p) - pdf_poisson(c, p)*0.5; # excess, deterministic
+        c, p = CCG.flatten(), pred.flatten()
+        pvals = 1 - cdf_poisson(c-1, p) - pdf_poisson(c, p)*0.5 # excess, deterministic
+        pvals = pvals.reshape(CCG.shape)
     else:
         pvals = np.nan
 
@@ -1588,9 +2699,78 @@ def get_ccg_sig(CCG, cbin, cwin, p_th=0.02, n_consec_bins=3, sgn=0,
     return [get_cross_features(cross, cbin, cwin) for cross in crosses]
 
 
+def get_ccgs_sig(CCGs, cbin, cwin, p_th=0.02, n_consec_bins=3, sgn=0,
+                 fract_baseline=4./5, W_sd=10, test='Poisson_Stark',
+                 ret_features=True, only_max=True):
+    '''
+    Assesses the significance of many ccgs at once - batched equivalent of get_ccg_sig.
+    The predictors of all ccgs are computed with a single convolution along the bins axis,
+    p-values are computed at once and significant crosses are found with array operations.
+
+    Arguments:
+        - CCGs: 2d array (n_ccgs, n_bins), ccgs in Counts
+        - see get_ccg_sig for other arguments.
+
+    Returns:
+        - list of length n_ccgs, get_ccg_sig(CCGs[i], ...) for every ccg.
+    '''
+    assert test in ['Normal_Kopelowitz', 'Poisson_Stark']
+    assert sgn in [0,1,-1], "sgn should be either 0, 1 or -1!"
+    CCGs=np.asarray(CCGs)
+    assert CCGs.ndim==2, 'CCGs must be a 2d array (n_ccgs, n_bins)!'
+    assert 0<p_th<1, "p_th should be between 0 and 1!"
+    assert n_consec_bins>=1 and round(n_consec_bins)==n_consec_bins
+    signs=[s for s in [1,-1] if sgn in [0,s]]
+    crosses=[[] for _ in range(CCGs.shape[0])]
+    if CCGs.shape[0]==0:
+        return crosses
+
+    # values of all bins (in units of standard deviations from predictor),
+    # array thresholded and threshold for each sign
+    sig_arrays=[]
+    if test=='Normal_Kopelowitz':
+        if n_consec_bins in [2,3]:
+            assert canUse_Nbins(p_th, cwin, cbin, n_consec_bins)
+        n=CCGs.shape[1]
+        edges=np.concatenate((CCGs[:, :int(n*fract_baseline/2)], CCGs[:, int(n*(1-fract_baseline/2)):]), axis=1)
+        mn, sd = np.mean(edges, axis=1), np.std(edges, axis=1)
+        sd[sd==0]=1
+        CCGs_z=(CCGs-mn[:, None])*1./sd[:, None] # see zscore
+        for s in signs:
+            threshold=fractile_normal(1-p_th/2)*s
+            sig_arrays.append((CCGs_z, threshold, s, (CCGs_z-threshold)*s+threshold))
+    elif test=='Poisson_Stark':
+        assert np.all(CCGs==np.round(CCGs)), 'CCG should be in counts -> integers!'
+        W=int(W_sd/cbin) # convert W_sd from ms to samples
+        pred, pvals = StarkAbeles2009_ccg_sig(CCGs.T, W=2*W, WINTYPE='gauss', HF=None, CALCP=True, sgn=1)
+        pred, pvals = pred.T, pvals.T
+        poisson_zscore = (CCGs-pred)/np.sqrt(pred)
+        for s in signs:
+            # threshold crosses of p-values below p_th
+            sig_arrays.append((pvals if s==1 else 1-pvals, p_th, -1, poisson_zscore))
+
+    for (arr, th, s, values) in sig_arrays:
+        rows, starts, ends = thresh_consec_rows(arr, th, s, n_consec_bins)
+        for r, st, en in zip(rows, starts, ends):
+            ii=np.arange(st, en+1)
+            crosses[r].append(np.vstack([ii, values[r, ii]]))
+
+    for i, crs in enumerate(crosses):
+        if only_max and len(crs)>0:
+            cross=crs[0]
+            for c in crs[1:]:
+                if max(abs(c[1,:]))>max(abs(cross[1,:])): cross = c
+            crosses[i]=[cross]
+        if ret_features:
+            crosses[i]=[get_cross_features(cross, cbin, cwin) for cross in crosses[i]]
+
+    return crosses
+
+
 def ccg_sig_stack(dp, U_src, U_trg, cbin=0.5, cwin=100, name=None,
                   p_th=0.01, n_consec_bins=3, sgn=-1, fract_baseline=4./5, W_sd=10, test='Poisson_Stark',
-                  again=False, againCCG=False, ret_features=False, only_max=True, periods='all'):
+                  again=False, againCCG=False, ret_features=False, only_max=True, periods='all',
+                  out_of_core=False, max_distance=None, cross_probe=False, use_template_for_peakchan=True):
     '''
     Arguments:
         - dp: string, datapath to manually curated kilosort output
@@ -1610,6 +2790,14 @@ def ccg_sig_stack(dp, U_src, U_trg, cbin=0.5, cwin=100, name=None,
         - again: bool, whether to reassess significance of ccg stack rather than loading from memory if already computed in the past.
         - againCCG: bool, whether to recompute ccg stack rather than loading from memory if already computed in the past.
         - ret_features: bool, whether to return or not the features dataframe instead of the crosses indices and values.
+        - out_of_core: bool, whether to compute the all-to-all ccg stack out of core (see ccg_stack).
+                       In any case, the stack is streamed in blocks of rows to assess significance.
+        - max_distance: float, if provided, only ccgs of pairs of units whose peak channels
+                        are closer than max_distance (um) are computed and assessed (see get_candidate_pairs).
+        - cross_probe: bool, whether to also assess all pairs of units recorded on different probes
+                       if max_distance is provided (merged datasets only).
+        - use_template_for_peakchan: bool, whether to use templates rather than raw data to find peak channels
+                                     if max_distance is provided.
 
         Returns:
             if ret_features==False:
@@ -1629,6 +2817,8 @@ def ccg_sig_stack(dp, U_src, U_trg, cbin=0.5, cwin=100, name=None,
                   'n_triplets', 'n_bincrossing', 'bin_heights', 'entropy']
 
     # Directly load sig stack if was already computed
+    if name is not None and max_distance is not None:
+        name=f"{name}-{max_distance}um{'-xprobe' if cross_probe else ''}"
     if name is not None:
         # in signame, only parameters not fed to ccg_stack
         # (as others will already be added to the saved file name by ccg_stack)
@@ -1649,58 +2839,77 @@ def ccg_sig_stack(dp, U_src, U_trg, cbin=0.5, cwin=100, name=None,
             if op.exists(feat_path):
                 features=pd.read_csv(feat_path)
                 return sigstack, sigustack, features
-            features=pd.DataFrame(columns=feat_columns)
-            for i,c in enumerate(tqdm(sigstack, desc=f'Computing features of significant CCGs over {num_cores} cores')):
-                pks=get_ccg_sig(c, cbin, cwin, p_th, n_consec_bins, sgn,
-                                fract_baseline, W_sd, test, ret_features=ret_features, only_max=only_max)
+            features_rows=[]
+            sigs=get_ccgs_sig(sigstack, cbin, cwin, p_th, n_consec_bins, sgn,
+                              fract_baseline, W_sd, test, ret_features=ret_features, only_max=only_max)
+            for i,pks in enumerate(sigs):
                 for p in pks:
-                    new_row = pd.DataFrame([dict(zip(features.columns, np.append(sigustack[i, :], p)))])
-                    features = pd.concat([features, new_row], ignore_index=True)
-                    # features = features.append(dict(zip(features.columns,np.append(sigustack[i, :], p))), ignore_index=True)
+                    features_rows.append(np.append(sigustack[i, :], p))
+            features=pd.DataFrame(features_rows, columns=feat_columns) if features_rows else pd.DataFrame(columns=feat_columns)
             features.to_csv(feat_path, index=False)
             return sigstack, sigustack, features
 
     assert any(U_src)&any(U_trg)
-    if ret_features: features=pd.DataFrame(columns=feat_columns)
-
-    stack, ustack = ccg_stack(dp, U_src, U_trg, cbin, cwin, normalize='Counts', all_to_all=True, name=name, again=againCCG,
-                              periods=periods)
-    same_src_trg=np.all(U_src==U_trg) if len(U_src)==len(U_trg) else False
-    inco=False
-    if same_src_trg:
-        if len(np.unique(ustack))!=len(np.unique(U_src)): inco=True
-        else:
-            if not np.all(np.unique(ustack)==np.unique(U_src)): inco=True
-    if inco:
-        print((f'Incoherence detected between loaded ccg_stack ({len(np.unique(ustack))} units) '
-              f'and expected ccg_stack ({len(U_src)} units) - recomputing as if againCCG were True...'))
-        stack, ustack = ccg_stack(dp, U_src, U_trg, cbin, cwin, normalize='Counts', all_to_all=True, name=name, again=True,
-                                  periods=periods)
-
-    ccgsig_ids = []
-    ccgsig_args = []
-    for i in range(stack.shape[0]):
-        for j in range(stack.shape[1]):
-            if same_src_trg and i<=j: continue
-            CCG=stack[i, j, :]
-            ccgsig_ids.append((i,j))
-            ccgsig_args.append((CCG, cbin, cwin, p_th, n_consec_bins, sgn, fract_baseline, W_sd, test, ret_features, only_max))
-
-    ccgsig_results = Parallel(n_jobs=-2)(\
-        delayed(get_ccg_sig)(*ccgsig_args[i]) for i in tqdm(range(len(ccgsig_args)),
-        desc=f'Looking for significant CCGs over {num_cores} cores'))
+    features_rows=[]
 
     sigustack=[]
     sigstack=[]
-    for ((i,j), pks) in zip(ccgsig_ids, ccgsig_results):
-        if np.any(pks):
-            sigustack.append(ustack[i, j, :])
-            sigstack.append(stack[i, j, :])
-            if ret_features:
-                for p in pks:
-                    new_row = pd.DataFrame([dict(zip(features.columns,np.append(ustack[i, j, :], p)))])
-                    features = pd.concat([features, new_row], ignore_index=True)
-                    # features = features.append(dict(zip(features.columns,np.append(ustack[i, j, :], p))), ignore_index=True)
+    # both branches define the stack to stream and the ccgs and unit pairs of each of its blocks
+    stack=None
+    if max_distance is not None:
+        # spatially pruned screening: only ccgs of pairs of nearby units are computed
+        pairs, _ = get_candidate_pairs(dp, U_src, U_trg, max_distance, cross_probe, use_template_for_peakchan)
+        if len(pairs)>0:
+            stack, ustack = ccg_stack(dp, pairs[:,0], pairs[:,1], cbin, cwin, normalize='Counts', all_to_all=False,
+                                      name=name, again=againCCG, periods=periods, out_of_core=out_of_core)
+            if ustack.shape!=pairs.shape or not np.all(ustack==pairs):
+                print(('Incoherence detected between loaded ccg_stack and candidate pairs '
+                       '- recomputing as if againCCG were True...'))
+                stack, ustack = ccg_stack(dp, pairs[:,0], pairs[:,1], cbin, cwin, normalize='Counts', all_to_all=False,
+                                          name=name, again=True, periods=periods, out_of_core=out_of_core)
+
+        def block_ccgs(i0, stack_block):
+            return stack_block, pairs[i0:i0+stack_block.shape[0], :]
+    else:
+        stack, ustack = ccg_stack(dp, U_src, U_trg, cbin, cwin, normalize='Counts', all_to_all=True, name=name, again=againCCG,
+                                  periods=periods, out_of_core=out_of_core)
+        same_src_trg=np.all(U_src==U_trg) if len(U_src)==len(U_trg) else False
+        inco=False
+        if same_src_trg:
+            if len(np.unique(ustack))!=len(np.unique(U_src)): inco=True
+            else:
+                if not np.all(np.unique(ustack)==np.unique(U_src)): inco=True
+        if inco:
+            print((f'Incoherence detected between loaded ccg_stack ({len(np.unique(ustack))} units) '
+                  f'and expected ccg_stack ({len(U_src)} units) - recomputing as if againCCG were True...'))
+            stack, ustack = ccg_stack(dp, U_src, U_trg, cbin, cwin, normalize='Counts', all_to_all=True, name=name, again=True,
+                                      periods=periods, out_of_core=out_of_core)
+
+        def block_ccgs(i0, stack_block):
+            ii, jj = np.meshgrid(np.arange(i0, i0+stack_block.shape[0]), np.arange(stack.shape[1]), indexing='ij')
+            ii, jj = ii.ravel(), jj.ravel()
+            if same_src_trg:
+                m=ii>jj
+                ii, jj = ii[m], jj[m]
+            return stack_block[ii-i0, jj, :], ustack[ii, jj, :]
+
+    # stream over blocks of rows of the stack (only significant ccgs are kept in memory)
+    # (significance of all ccgs of a block is assessed at once, see get_ccgs_sig)
+    if stack is not None:
+        pbar=tqdm(total=stack.shape[0], desc='Looking for significant CCGs')
+        for i0, stack_block in iter_stack_blocks(stack):
+            ccgs, upairs = block_ccgs(i0, stack_block)
+            ccgsig_results = get_ccgs_sig(ccgs, cbin, cwin, p_th, n_consec_bins, sgn,
+                                          fract_baseline, W_sd, test, ret_features, only_max)
+            for (c, upair, pks) in zip(ccgs, upairs, ccgsig_results):
+                if np.any(pks):
+                    sigustack.append(upair)
+                    sigstack.append(c)
+                    if ret_features:
+                        for p in pks:
+                            features_rows.append(np.append(upair, p))
+            pbar.update(stack_block.shape[0])
+        pbar.close()
 
     if np.any(sigustack):
         sigustack=npa(sigustack)
@@ -1716,6 +2925,7 @@ def ccg_sig_stack(dp, U_src, U_trg, cbin=0.5, cwin=100, name=None,
         sigstack, sigustack = npa(zeros=(0, len(bins))), sigustack
 
     if ret_features:
+        features=pd.DataFrame(features_rows, columns=feat_columns) if features_rows else pd.DataFrame(columns=feat_columns)
         if name is not None:
             features.to_csv(feat_path, index=False)
         return sigstack, sigustack, features
@@ -1727,7 +2937,7 @@ def gen_sfc(dp, corr_type='connections', metric='amp_z', cbin=0.5, cwin=100,
             again=False, againCCG=False, drop_seq=['sign', 'time', 'max_amplitude'],
             pre_chanrange=None, post_chanrange=None, units=None,
             name=None, use_template_for_peakchan=True,
-            periods='all'):
+            periods='all', out_of_core=False, max_distance=None, cross_probe=False):
     '''
     Function generating a functional correlation dataframe sfc (Nsig x 2+8 features) and matrix sfcm (Nunits x Nunits)
     from a sorted Kilosort output at 'dp' containing 'N' good units
@@ -1769,6 +2979,12 @@ def gen_sfc(dp, corr_type='connections', metric='amp_z', cbin=0.5, cwin=100,
                 MANDATORY if you provide a list of units. | Default: None
         - use_template_for_peakchan: bool, whether to use templates rather than raw data to find peak channel | Default: True
         - periods: 'all' or [(float,float), (float,float), ...], list of time windows to consider to compute correlations
+        - out_of_core: bool, whether to compute the ccg stack out of core, and stream it to assess significance
+                       (see ccg_stack and ccg_sig_stack) - for very large populations.
+        - max_distance: float, if provided, only pairs of units whose peak channels are closer than max_distance (um)
+                        are tested (see get_candidate_pairs) - much faster than testing all pairs of large populations.
+        - cross_probe: bool, whether to also test all pairs of units recorded on different probes
+                       if max_distance is provided (merged datasets only).
 
     Returns:
         - sfc: Pandas dataframe of NsignificantUnits x
@@ -1822,7 +3038,8 @@ def gen_sfc(dp, corr_type='connections', metric='amp_z', cbin=0.5, cwin=100,
 
     sigstack, sigustack, sfc = ccg_sig_stack(dp, gu, gu, cbin, cwin, name,
                   p_th, n_consec_bins, sgn, fract_baseline, W_sd, test, again, againCCG, ret_features=True, only_max=only_max,
-                  periods=periods)
+                  periods=periods, out_of_core=out_of_core, max_distance=max_distance, cross_probe=cross_probe,
+                  use_template_for_peakchan=use_template_for_peakchan)
 
 
     sfc['t_ms_center'] = sfc.l_ms+(sfc.r_ms-sfc.l_ms)/2
@@ -1936,66 +3153,55 @@ def gen_sfc(dp, corr_type='connections', metric='amp_z', cbin=0.5, cwin=100,
 
 #%% Cross spike intervals distribution (is to ISI what CCG is to ACG)
 
-@njit(cache=True, parallel=False)
-def cisi_numba_para(spk1, spk2, available_memory):
-    spk1=np.sort(spk1).astype(np.float64)
-    spk2=np.sort(spk1).astype(np.float64)
-    memory_el=(0.01*available_memory)//spk1.itemsize
-    if memory_el<((len(spk1)*len(spk2))*0.1):
-        s=int(len(spk1)//((len(spk1)*len(spk2))//memory_el))
-        chunks=split(List(spk1), sample_size=s, return_last=True, overlap=0)
-    else:
-        s=len(spk1)
-        chunks=np.expand_dims(spk1, 0)
-    # the trick to make things fast is to only consider
-    # the relevant slice of spk2, which is possible assuming that spk1 and spk2 are sorted
-    isi_1to2=np.zeros(len(spk1))
-    n=chunks.shape[0]
-    for i in range(n):
-        chunk=chunks[i]
-        if i==n-1:chunk=chunk[~np.isnan(chunk)]
-
-        m1=np.array(list(spk2>=chunk[0])[1:]+[True]) # shift left to add spike right before
-        m2=np.array([True]+list(spk2<=chunk[-1])[:-1]) # shift right to add spike right after
-        chunk2=spk2[m1&m2]
-
-        a1=(chunk*np.ones((chunk2.shape[0], chunk.shape[0]))).T
-        a2=chunk2*np.ones((chunk.shape[0], chunk2.shape[0]))
-        d=np.abs(a1-a2)
-        for di in range(d.shape[0]):
-            isi_1to2[i*s+di]=np.min(d[di])
-
-    return isi_1to2
-
-
-@njit
-def cisi_numba(spk1, spk2, available_memory):
-    spk1=np.sort(spk1).astype(np.float64)
-    spk2=np.sort(spk1).astype(np.float64)
-    memory_el=(0.01*available_memory)//spk1.itemsize
-    if memory_el<((len(spk1)*len(spk2))*0.1):
-        s=int(len(spk1)//((len(spk1)*len(spk2))//memory_el))
-        chunks=split(List(spk1), sample_size=s, return_last=True, overlap=0)
-    else:
-        s=len(spk1)
-        chunks=np.expand_dims(spk1, 0)
-    # the trick to make things fast is to only consider
-    # the relevant slice of spk2, which is possible assuming that spk1 and spk2 are sorted
-    isi_1to2=np.zeros(len(spk1))
-    n=chunks.shape[0]
-    for i in prange(n):
-        chunk=chunks[i]
-        if i==n-1:chunk=chunk[~np.isnan(chunk)]
-
-        m1=np.array(list(spk2>=chunk[0])[1:]+[True]) # shift left to add spike right before
-        m2=np.array([True]+list(spk2<=chunk[-1])[:-1]) # shift right to add spike right after
-        chunk2=spk2[m1&m2]
-
-        d=np.abs(np.expand_dims(chunk,1)-chunk2)
-        for di in prange(d.shape[0]):
-            isi_1to2[i*s+di]=np.min(d[di])
+@njit(cache=True)
+def cisi_numba(spk1, spk2):
+    """
+    Single merge-style pass over sorted spk1 and spk2:
+    for every spk1 spike, finds the previous (<=) and next (>=) spk2 spike.
 
-    return isi_1to2
+    Returns:
+    - isi_prv, isi_nxt: (len(spk1),) arrays, intervals to the previous/next spk2 spike (NaN if none)
+    - id_prv, id_nxt: (len(spk1),) arrays, indices in spk2 of these spikes (-1 if none)
+                      (first index if the spk2 spike time is duplicated)
+    """
+    n1, n2 = len(spk1), len(spk2)
+    isi_prv = np.full(n1, np.nan)
+    isi_nxt = np.full(n1, np.nan)
+    id_prv = np.full(n1, -1, dtype=np.int64)
+    id_nxt = np.full(n1, -1, dtype=np.int64)
+    j = 0 # first spk2 spike >= current spk1 spike
+    run_start = -1 # first index of the value of spk2[j-1]
+    for i in range(n1):
+        t = spk1[i]
+        while j < n2 and spk2[j] < t:
+            if j == 0 or spk2[j] != spk2[j-1]:
+                run_start = j
+            j += 1
+        if j < n2:
+            isi_nxt[i] = spk2[j] - t
+            id_nxt[i] = j
+        if j < n2 and spk2[j] == t:
+            isi_prv[i] = 0
+            id_prv[i] = j
+        elif j > 0:
+            isi_prv[i] = t - spk2[j-1]
+            id_prv[i] = run_start
+    return isi_prv, isi_nxt, id_prv, id_nxt
+
+@njit(cache=True, parallel=True)
+def cisi_many_numba(spk1, spk2, offsets):
+    """
+    cisi_numba of spk1 against several sorted trains,
+    concatenated in spk2 with boundaries offsets (n_trains+1,). Parallelized across trains.
+    """
+    n_trains = len(offsets) - 1
+    isi_prv = np.zeros((n_trains, len(spk1)))
+    isi_nxt = np.zeros((n_trains, len(spk1)))
+    id_prv = np.zeros((n_trains, len(spk1)), dtype=np.int64)
+    id_nxt = np.zeros((n_trains, len(spk1)), dtype=np.int64)
+    for k in prange(n_trains):
+        isi_prv[k], isi_nxt[k], id_prv[k], id_nxt[k] = cisi_numba(spk1, spk2[offsets[k]:offsets[k+1]])
+    return isi_prv, isi_nxt, id_prv, id_nxt
 
 # @njit
 # def next_cisi(spk1, spk2, direction=1):
@@ -2112,31 +3318,6 @@ def cisi_numba(spk1, spk2, available_memory):
 
 #     return cisi
 
-def cisi_chunk(i, chunk, n, spk2, direction, s):
-
-    if i==n-1:
-        chunk = chunk[~np.isnan(chunk)]
-
-    m1     = np.append((spk2>=chunk[0])[1:], [True]) # shift left to add spike right before
-    m2     = np.append([True], (spk2<=chunk[-1])[:-1]) # shift right to add spike right after
-    chunk2 = spk2[m1&m2] # TRICK FOR SPEED: only compute the diff with the nearby spk2 spikes
-
-    d = (chunk[:, np.newaxis]-chunk2)
-    if direction==1:
-        d     *= -1
-        d[d<0] = np.nan
-    elif direction==-1:
-        d[d<0] = np.nan
-    elif direction==0:
-        d      = np.abs(d)
-
-    slc      = slice(i*s, i*s+d.shape[0])
-    mins     = np.nanmin(d, axis=1)
-    min_nans = np.isnan(mins) # = np.nanargmin(d, axis=1)
-    argmins  = np.nanargmin(d[~min_nans, :], axis=1) + np.nonzero(m1&m2)[0][0]
-
-    return slc, mins, argmins, min_nans
-
 @npyx_cacher
 def get_cisi(spk1, spk2, direction=0,
              again=False, return_spk2_id=False, parallel=False,
@@ -2147,117 +3328,69 @@ def get_cisi(spk1, spk2, direction=0,
     Arguments:
         - spk1: list/array, time series of spikes times (returned array will be in same units - recommend samples for speed)
         - spk2: list/array, time series of spike times (must be in same units as t1 - recommend samples for speed)
-        - direction: 1, -1 or 0, whether to return following or preceeding interval
+                or list of such time series (one vs many: rows of returned arrays match spk2 trains)
+        - direction: 1, -1, 0 or 'both', whether to return following or preceeding interval
                     or for 0, the smallest interval of either
                     (in this case not only consecutive 1,2 or 2,1 ISIs are considered but all spikes of 1)
-        - verbose: bool, whether to print rich information
+                    or for 'both', both preceeding and following intervals
         - return_spk2_id: bool, whether to return the id of the spk2 spike that correspond to each spk1's cisi
-        - parallel: bool, whether to split computation over cores or not
-                  (big overhead - only worth it if len(spk1) or len(spk2) >= 10^7 values
+        - parallel: bool, whether to process spk2 trains in parallel (only relevant if spk2 is a list of trains)
         - again: bool, whether to recompute results rather than loading them from cache.
         - cache_results: bool, whether to cache results at local_cache_memory.
         - cache_path: None|str, where to cache results.
                         If None, ~/.NeuroPyxels will be used (can be changed in npyx.CONFIG).
     Returns:
         - isi_1to2: shortest interspike intervals of spk1 to spk2 in same units as spk1 and spk2
+                    (NaN if no spk2 spike precedes/follows; tuple (preceeding, following) if direction is 'both')
         if return_spk2_id:
-            - spk2_id: id of the spk2 spike that correspond to each spk1's cisi
+            - spk2_id: id of the spk2 spike that correspond to each spk1's cisi (NaN if none)
     '''
 
-    assert direction in [1, 0, -1]
-    assert np.all(spk1 == np.sort(spk1)), "spk1 must be sorted!"
-    assert np.all(spk2 == np.sort(spk2)), "spk1 must be sorted!"
-    spk1 = spk1.astype(np.float64)
-    spk2 = spk2.astype(np.float64)
-
-    isi_1to2 = np.zeros(len(spk1), dtype=np.float64)
-    spk2_id = np.zeros(len(spk1), dtype=np.float64)
-
-    # Split in chunks for faster computing.
-    s = 500 # arbitrary
-    if s < len(spk1):
-        chunks = split(List(spk1), sample_size=s, return_last=True, overlap=0)
+    assert direction in [1, 0, -1, 'both']
+    one_vs_many = isinstance(spk2, (list, tuple))
+    spk1 = np.asarray(spk1, dtype=np.float64)
+    trains2 = [np.asarray(t, dtype=np.float64) for t in spk2] if one_vs_many else [np.asarray(spk2, dtype=np.float64)]
+    assert np.all(np.diff(spk1) >= 0), "spk1 must be sorted!"
+    for t in trains2:
+        assert np.all(np.diff(t) >= 0), "spk2 must be sorted!"
+
+    # single O(len(spk1)+len(spk2)) sweep per spk2 train
+    if parallel and len(trains2) > 1:
+        offsets = np.cumsum([0] + [len(t) for t in trains2]).astype(np.int64)
+        isi_prv, isi_nxt, id_prv, id_nxt = cisi_many_numba(spk1, np.concatenate(trains2), offsets)
     else:
-        s      = len(spk1)
-        chunks = spk1[np.newaxis,:]
-
-    # the trick to make things fast is to only consider
-    # the relevant slice of spk2, which is possible assuming that spk1 and spk2 are sorted
-    n = len(chunks)
-    cisi_chunk_inputs = [(i, chunk, n, spk2, direction, s) for i, chunk in enumerate(chunks)]
-    if parallel:
-        results = Parallel(n_jobs=num_cores)(\
-                    delayed(cisi_chunk)(*args) for args in cisi_chunk_inputs)
+        results = [cisi_numba(spk1, t) for t in trains2]
+        isi_prv, isi_nxt, id_prv, id_nxt = [np.array([r[i] for r in results]).reshape(len(trains2), len(spk1))
+                                            for i in range(4)]
+
+    id_prv = np.where(id_prv == -1, np.nan, id_prv)
+    id_nxt = np.where(id_nxt == -1, np.nan, id_nxt)
+    if direction == 1:
+        isi_1to2, spk2_id = isi_nxt, id_nxt
+    elif direction == -1:
+        isi_1to2, spk2_id = isi_prv, id_prv
+    elif direction == 0:
+        # closest spike, preceeding one if equidistant
+        nxt_m = (isi_nxt < isi_prv) | np.isnan(isi_prv)
+        isi_1to2 = np.where(nxt_m, isi_nxt, isi_prv)
+        spk2_id = np.where(nxt_m, id_nxt, id_prv)
     else:
-        results = [cisi_chunk(*args) for args in cisi_chunk_inputs]
-
-    for (slc, mins, argmins, min_nans) in results:
-        isi_1to2[slc]           = mins
-        spk2_id[slc][~min_nans] = argmins
-        spk2_id[slc][min_nans]  = np.nan
+        isi_1to2, spk2_id = (isi_prv, isi_nxt), (id_prv, id_nxt)
 
-    isi_1to2[isi_1to2==0] = 0 # remove -0 values
+    if not one_vs_many:
+        isi_1to2 = tuple(a[0] for a in isi_1to2) if direction == 'both' else isi_1to2[0]
+        spk2_id = tuple(a[0] for a in spk2_id) if direction == 'both' else spk2_id[0]
 
     if return_spk2_id:
         return isi_1to2, spk2_id
-    
-    return isi_1to2
 
-def par_process(i, chunk, spk2, n, direction):
-    # the trick to make things fast is to only consider
-    # the relevant slice of spk2, which is possible assuming that spk1 and spk2 are sorted
-    if i==n-1:chunk=chunk[~np.isnan(chunk)]
-    # start_spk2=np.nonzero(spk2<chunk[0])[0][-1:]
-    # if not np.any(start_spk2): start_spk2=np.array([0]) #  case when first spk2 is later than all chunk spikes
-    # end_spk2=np.nonzero(spk2>chunk[-1])[0][:1]+1
-    # if not np.any(end_spk2): chunk2=spk2[start_spk2[0]:] #  case when last spk2 is earlier than all chunk spikes
-    # else: chunk2=spk2[start_spk2[0]:end_spk2[0]]
-    m1=np.append((spk2>=chunk[0])[1:], [True]) # shift left to add spike right before
-    m2=np.append([True], (spk2<=chunk[-1])[:-1]) # shift right to add spike right after
-    chunk2=spk2[m1&m2]
-    d=(chunk[:, np.newaxis]-chunk2)
-    if direction==1:
-        d*=-1
-        d[d<0]=np.nan
-    elif direction==-1:
-        d[d<0]=np.nan
-    elif direction==0:
-        d=np.abs(d)
-    return np.nanmin(d, axis=1)
+    return isi_1to2
 
 def get_cisi_parprocess(spk1, spk2, direction=0, verbose=False):
     '''
-    Computes cross spike intervals i.e time differences between
-    every spike of spk1 and the following/preceeding spike of spk2.
-    Arguments:
-        - spk1: list/array of INTEGERS, time series
-        - spk2: list/array of INTEGERS, time series
-        - direction: 1, -1 or 0, whether to return following or preceeding interval
-                    or for 0, the smallest interval of either
-                    (in this case not only consecutive 1,2 or 2,1 ISIs are considered but all spikes of 1)
-    Returns:
-        - spk_1to2: spikes of spk1 directly followed/preceeded by a spike of spk2
-        - isi_1to2: corresponding interspike intervals
+    Legacy alias of get_cisi for unsorted trains (sorts them and does not cache results).
     '''
-    assert direction in [1, 0, -1]
-    spk1=np.sort(spk1).astype(np.float64)
-    spk2=np.sort(spk2).astype(np.float64)
-    # Chunks of 50% of available memory.
-    # Chunk size is overestimated because chunks.shape[1] is
-    # len(spk2[start_spk2:end_spk2[1]]) not len(spk2)
-    memory_el=(0.01*psutil.virtual_memory().available)//spk1.itemsize
-    if memory_el<((len(spk1)*len(spk2))*0.1):
-        s=int(len(spk1)//((len(spk1)*len(spk2))//memory_el))
-        chunks=split(List(spk1), sample_size=s, return_last=True, overlap=0)
-    else:
-        s=len(spk1)
-        chunks=spk1[np.newaxis,:]
-
-    n=chunks.shape[0]
-    inputs=[(i, chunk) for i, chunk in enumerate(chunks)]
-    results=Parallel(n_jobs=-2)(delayed(par_process)(inp[0], inp[1], spk2, n, direction) for inp in inputs)
-
-    return np.concatenate(results).ravel()
+    return get_cisi(np.sort(spk1), np.sort(spk2), direction, cache_results=False)
 
 #%% Pairwise correlations, synchrony, population coupling
 
@@ -2304,16 +3437,31 @@ def pearson_corr_trn(L, b, dp):
     # Outputs
     - C: pairwise correlations matrix, Ncells x Ncells
     '''
-    def bnr(t, b, rec_len):
-        return binarize(t, b, 30000, rec_len, False)
-    rec_len=np.load(dp+'/spike_times.npy')[-1]
-    tb1= bnr(L[0], b, rec_len)
-    M=npa(zeros=(len(L), len(tb1)))
-    M[0,:]=tb1
-    del tb1
-    for i, t in enumerate(L[1:]):
-        M[i+1,:] = bnr(t, b, rec_len)
-    return pearson_corr(M)
+    rec_len=np.load(dp+'/spike_times.npy').ravel()[-1]
+    M=binarize_sparse(L, b, 30000, rec_len)
+    return pearson_corr_sparse(M)
+
+def pearson_corr_sparse(M):
+    '''
+    Calculate the NxN matrix of pairwise Pearson’s correlation coefficients
+    from a sparse population matrix (see npyx.spk_t.trnb_sparse), without densifying it.
+    # Parameters
+    - M: sparse binned trains matrix, Ncells x Nbins
+    # Outputs
+    - C: pairwise correlations matrix, Ncells x Ncells
+    '''
+    # C[i,j] = <bi-mi, bj-mj> / sqrt(<bi-mi, bi-mi>*<bj-mj, bj-mj>)
+    # where <bi-mi, bj-mj>/Nbins = <bi, bj>/Nbins - mi*mj
+    # only requires the sparse dot products <bi, bj> and per-unit sums
+    M = csr_matrix(M, dtype=np.float64)
+    n_bins = M.shape[1]
+    m = np.asarray(M.sum(axis=1)).ravel()/n_bins
+    Mcov = (M @ M.T).toarray()/n_bins - np.outer(m, m) # M covariance: Mcov[i,j] = np.cov(M[i,:],M[j,:])
+
+    var = np.diag(Mcov)
+    C = Mcov/np.sqrt(np.outer(var, var)) # corrcoeff pears. is covariance/product of variances
+
+    return C if M.shape[0]>2 else C[0,1] # return corr matrix if more than 2 series, else only the corrcoeff
 
 def correlation_index(L, dt, dp):
     '''
@@ -2330,35 +3478,63 @@ def correlation_index(L, dt, dp):
     # Sanity checks
     assert type(L)==list
     assert len(L)>1
-    rec_len = np.load(dp+'/spike_times.npy')[-1]
+    rec_len = np.load(dp+'/spike_times.npy').ravel()[-1]
 
-    # Formula where <bi-mi, bj-mj> is the dot product of mean-substracted tiem series
-    # (essentially covariance of i and j)
-    # C[i,j] = (Nab[-dt,dt] * T) / (Na*Nb*2*dt)
-    # where Nab[-dt,dt] is the number of spikes A falling within -dt,dt windows around psikes B
-    C = npa(zeros=(len(L), len(L)))
-    for i1, t1 in enumerate(L):
-        Na=len(t1)
-        for i2, t2 in enumerate(L):
-            Nb=len(t2)
-            if i1==i2:
-                C[i1,i2]=0
-            elif i2<i1:
-                pass
-            else:
-                # all to all differences in one shot
-                Nab=0
-                if len(t1)<len(t2): # screen the spikes of the shortest spike train to earn time
-                    t=t1; tt=t2;
-                else:
-                    t=t2; tt=t1;
-                for spk_a in t:
-                    d_spka_allb = np.abs(tt-spk_a)
-                    Nab+=np.count_nonzero(d_spka_allb<=dt*30)
-                C[i1,i2]=C[i2,i1]=(Nab*rec_len)/(Na*Nb*2*dt)
+    # sparse matrix at the sampling resolution, including all spikes
+    M = binarize_sparse(L, 1000/30000, 30000, np.max([np.max(t) for t in L if len(t)>0])+2)
+    C = correlation_index_sparse(M, dt, 1000/30000, rec_len, fs=30000)
 
     return C if len(L)>2 else C[0,1] # return corr matrix if more than 2 series, else only the corrcoeff
 
+def correlation_index_sparse(M, dt, bin_size, rec_len, fs=30000):
+    '''
+    Calculate the NxN matrix of pairwise correlation indices from Wong, Meister and Shatz 1993
+    from a sparse population matrix (see npyx.spk_t.trnb_sparse), without densifying it.
+    Exact (w.r.t. spike times) if M is binned at the sampling resolution (bin_size=1000/fs).
+    # Parameters
+    - M: sparse binned trains matrix, Ncells x Nbins
+    - dt: synchronicity window, in ms
+    - bin_size: bin size of M, in ms
+    - rec_len: recording length, in samples
+    - fs: sampling rate, in Hz
+    # Outputs
+    - C: pairwise correlations indices, Ncells x Ncells
+    '''
+    # C[i,j] = (Nab[-dt,dt] * T) / (Na*Nb*2*dt)
+    # where Nab[-dt,dt] = Ma @ P @ Mb.T, with P[c1,c2] = 1 if bins c1 and c2 are less than dt apart
+    # (restricted to bins where at least one unit fired, P is sparse)
+    M = csr_matrix(M, dtype=np.float64)
+    bin_samples = int(np.ceil(fs*bin_size/1000))
+    n_lags = int((dt*fs/1000)//bin_samples)
+    N = np.asarray(M.sum(axis=1)).ravel()
+
+    # compress columns to occupied bins
+    occupied = np.unique(M.indices)
+    Mc = csr_matrix((M.data, np.searchsorted(occupied, M.indices), M.indptr), shape=(M.shape[0], len(occupied)))
+    Mc_csc, McT = Mc.tocsc(), Mc.T.tocsr()
+
+    # proximity matrix P, built by blocks of occupied bins to bound memory
+    lo = np.searchsorted(occupied, occupied - n_lags, side='left')
+    hi = np.searchsorted(occupied, occupied + n_lags, side='right')
+    n_neighbours = np.cumsum(hi - lo)
+    max_block_nnz = 5e7
+    block_edges = np.unique(np.concatenate([[0],
+                            np.searchsorted(n_neighbours, np.arange(max_block_nnz, n_neighbours[-1], max_block_nnz)),
+                            [len(occupied)]])) if len(occupied) > 0 else np.array([0])
+    Nab = np.zeros((M.shape[0], M.shape[0]))
+    for s, e in zip(block_edges[:-1], block_edges[1:]):
+        counts = hi[s:e] - lo[s:e]
+        rows = np.repeat(np.arange(e-s), counts)
+        cols = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo[s:e], counts)
+        P = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(e-s, len(occupied)))
+        Nab += (Mc_csc[:, s:e] @ (P @ McT)).toarray()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        C = (Nab*rec_len)/(np.outer(N, N)*2*dt)
+    C[np.diag_indices(M.shape[0])] = 0
+
+    return C
+
 def synchrony_regehr(CCG, cbin, sync_win=1, fract_baseline=2./5):
     '''
     - CCG: crosscorrelogram array, units does not matter. Should be long enough.
@@ -2607,6 +3783,160 @@ def frac_pop_sync(t1, trains, fs=30000, t_end=None,
             t1_cisi,
             enough_firing_m)
 
+def frac_pop_sync_population(trains, fs=30000, t_end=None,
+                             sync_win=0.5,
+                             firing_b=2, firing_sd=1000, firing_th=0.02,
+                             n_pop_firing_fraction_threshold=0.5,
+                             cisi_upper_threshold=0.1,
+                             again=False, dp=None, U=None, running_denominator=False,
+                             t1=None, use_firing_periods=True):
+    '''
+    Population-wide frac_pop_sync: all trains are merged once into a single sorted (time, unit) stream,
+    and a sliding window counts for every spike how many other units fired within sync_win/2 ms of it
+    (only counting units in one of their firing periods, see npyx.spk_t.firing_periods).
+    Equivalent to calling frac_pop_sync for every unit against all the others, in one pass.
+
+    Arguments:
+    - trains: list of np arrays in, in SAMPLES - MUST BE INTEGERS
+    - fs, t_end, sync_win, firing_b, firing_sd, firing_th, n_pop_firing_fraction_threshold,
+      cisi_upper_threshold, again, dp, U, running_denominator: see frac_pop_sync
+    - t1: optional np array of time stamps, in SAMPLES (e.g. peri-event time stamps).
+          If provided, synchrony is computed at t1 time stamps only, against all units in trains (as in frac_pop_sync).
+    - use_firing_periods: bool, whether to only count units during their firing periods
+                          (else units are considered to fire throughout the recording)
+
+    Returns:
+    - fracpop_sync: list of np arrays (one per unit, or a single array if t1 is provided),
+      fraction of other units firing within sync_win ms of every spike [0-1].
+    - N_pop_synchronized: same shape as fracpop_sync, number of other units firing within sync_win ms of every spike.
+    - N_pop_firing: same shape as fracpop_sync, number of other units in a firing period at every spike.
+    - enough_firing_m: same shape as fracpop_sync, boolean arrays indicating whether enough neurons were firing
+      to consider it meaningful to estimate population synchrony.
+    - fracpop_sync_unit: np array of shape (len(trains),) (or float if t1 is provided),
+      mean fraction of population synchrony over spikes during which enough neurons were firing.
+    '''
+    if U is None:
+        U=[None]*len(trains)
+    else:
+        assert len(U)==len(trains), 'You must feed as many trains as units!'
+        assert dp is not None, 'Need to provide datapath along with unit indices.'
+        t_end = np.load(Path(dp,'spike_times.npy')).ravel()[-1]
+    if t_end is None: t_end=np.max(np.concatenate(trains))
+    n_units = len(trains)
+
+    # Merged (time, unit) stream
+    units = np.concatenate([np.full(len(t), i, dtype=np.int64) for i, t in enumerate(trains)])
+    times = np.concatenate([np.asarray(t, dtype=np.int64) for t in trains])
+    stream_order = np.argsort(times, kind='stable')
+    times, units = times[stream_order], units[stream_order]
+
+    # Firing periods as start/end events
+    if use_firing_periods:
+        periods = [np.asarray(npyx.spk_t.firing_periods(t, fs, t_end, b=firing_b, sd=firing_sd, th=firing_th,
+                                                       again=again, dp=dp, u=u), dtype=np.int64).reshape(-1, 2)
+                   for u, t in zip(U, trains)]
+    else:
+        periods = [np.array([[0, max(t_end, np.max(times))]], dtype=np.int64) for t in trains]
+    period_units = np.concatenate([np.full(len(p), i, dtype=np.int64) for i, p in enumerate(periods)])
+    periods = np.concatenate(periods)
+    start_order, end_order = np.argsort(periods[:,0], kind='stable'), np.argsort(periods[:,1], kind='stable')
+
+    # a unit is synchronous if its closest spike is within sync_win/2
+    # (and closer than cisi_upper_threshold)
+    half_win = min(sync_win*fs/1000/2, cisi_upper_threshold*fs)
+
+    if t1 is None:
+        queries, query_units, n_others = times, units, n_units-1
+    else:
+        t1 = np.asarray(t1, dtype=np.int64)
+        query_order = np.argsort(t1, kind='stable')
+        queries, query_units, n_others = t1[query_order], np.full(len(t1), -1, dtype=np.int64), n_units
+    N_pop_synchronized, N_pop_firing = pop_sync_stream_numba(times, units, n_units,
+                                                             queries, query_units, half_win,
+                                                             periods[start_order, 0], period_units[start_order],
+                                                             periods[end_order, 1], period_units[end_order])
+
+    enough_firing_m = N_pop_firing >= n_pop_firing_fraction_threshold*n_others
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if not running_denominator:
+            fracpop_sync = N_pop_synchronized / n_others
+        else:
+            fracpop_sync = N_pop_synchronized / N_pop_firing
+
+    if t1 is not None:
+        # back to t1 order
+        reorder = np.empty_like(query_order)
+        reorder[query_order] = np.arange(len(query_order))
+        fracpop_sync, N_pop_synchronized, N_pop_firing, enough_firing_m = \
+            [a[reorder] for a in [fracpop_sync, N_pop_synchronized, N_pop_firing, enough_firing_m]]
+        return (fracpop_sync, N_pop_synchronized, N_pop_firing, enough_firing_m,
+                np.nanmean(fracpop_sync[enough_firing_m]) if np.any(enough_firing_m) else np.nan)
+
+    # back to per-unit spike trains
+    splits = np.cumsum([len(t) for t in trains])[:-1]
+    outputs = []
+    for a in [fracpop_sync, N_pop_synchronized, N_pop_firing, enough_firing_m]:
+        a_trains = np.empty_like(a)
+        a_trains[stream_order] = a
+        outputs.append(np.split(a_trains, splits))
+    fracpop_sync_unit = npa([np.nanmean(f[m]) if np.any(m) else np.nan for f, m in zip(outputs[0], outputs[3])])
+
+    return (*outputs, fracpop_sync_unit)
+
+@njit(cache=True)
+def pop_sync_stream_numba(times, units, n_units, queries, query_units, half_win,
+                          period_starts, period_start_units, period_ends, period_end_units):
+    """
+    Sliding window over the merged sorted (times, units) stream of a population:
+    for every sorted query time stamp q (from unit query_units, -1 if none), counts the units
+    other than the query unit with a spike within [q-half_win, q+half_win] and in a firing period at q,
+    and the units other than the query unit in a firing period at q.
+    Firing periods [start, end] are provided as start and end events, sorted by time.
+    """
+    n_q = len(queries)
+    n_sync = np.zeros(n_q, dtype=np.int64)
+    n_firing = np.zeros(n_q, dtype=np.int64)
+    in_window = np.zeros(n_units, dtype=np.int64) # n spikes of every unit in the window
+    in_period = np.zeros(n_units, dtype=np.int64) # n firing periods of every unit englobing q
+    n_active = 0 # units with spikes in the window and in a firing period
+    n_in_period = 0
+    left, right, ps, pe = 0, 0, 0, 0
+    for i in range(n_q):
+        q = queries[i]
+        # firing period events
+        while ps < len(period_starts) and period_starts[ps] <= q:
+            u = period_start_units[ps]
+            in_period[u] += 1
+            if in_period[u] == 1:
+                n_in_period += 1
+                if in_window[u] > 0: n_active += 1
+            ps += 1
+        while pe < len(period_ends) and period_ends[pe] < q:
+            u = period_end_units[pe]
+            in_period[u] -= 1
+            if in_period[u] == 0:
+                n_in_period -= 1
+                if in_window[u] > 0: n_active -= 1
+            pe += 1
+        # spikes entering and leaving the window
+        while right < len(times) and times[right] <= q + half_win:
+            u = units[right]
+            in_window[u] += 1
+            if in_window[u] == 1 and in_period[u] > 0: n_active += 1
+            right += 1
+        while left < right and times[left] < q - half_win:
+            u = units[left]
+            in_window[u] -= 1
+            if in_window[u] == 0 and in_period[u] > 0: n_active -= 1
+            left += 1
+        n_sync[i] = n_active
+        n_firing[i] = n_in_period
+        u = query_units[i]
+        if u >= 0 and in_period[u] > 0:
+            n_firing[i] -= 1
+            if in_window[u] > 0: n_sync[i] -= 1
+    return n_sync, n_firing
+
 @docstring_decorator(frac_pop_sync.__doc__)
 def fraction_pop_sync(dp, u1, U, sync_win=2,
                       firing_b=1, firing_sd=1000, firing_th=0.02,
@@ -2655,16 +3985,13 @@ def get_cm(dp, units, cbin=0.2, cwin=100, b=5, corrEvaluator='CCG', periods='all
     # Initialize empty arrays
 
     if corrEvaluator =='corrcoeff_MB':
-        Nbins_bms = len(trnb(dp, units[0], b)) # b in ms
-        trnbM = npa(zeros=(len(units), Nbins_bms))
+        trnbM = trnb_sparse(dp, units, b, periods=periods) # b in ms
     elif corrEvaluator == 'CCG':
         cmCCG=npa(empty=(len(units), len(units)))
 
     # Populate empty arrays
     for i1, u1 in enumerate(units):
-        if corrEvaluator =='corrcoeff_MB':
-            trnbM[i1,:]=trnb(dp, u1, b, periods=periods) # b in ms
-        elif corrEvaluator == 'CCG':
+        if corrEvaluator == 'CCG':
             for i2, u2 in enumerate(units):
                 if u1==u2:
                     cmCCG[i1, i2]=0
@@ -2676,7 +4003,7 @@ def get_cm(dp, units, cbin=0.2, cwin=100, b=5, corrEvaluator='CCG', periods='all
     if corrEvaluator == 'CCG':
         cm = cmCCG
     elif corrEvaluator == 'corrcoeff_MB':
-        cm = pearson_corr(trnbM)
+        cm = pearson_corr_sparse(trnbM)
 
     return cm
 
@@ -2832,12 +4159,132 @@ def spike_time_tiling_coefficient(spiketrain_1, spiketrain_2, L, dt, dp):
                     1 - PB * TA)
     return index
 
+@npyx_cacher
+def sttc_matrix(dp, U, dt=5, periods='all', enforced_rp=0,
+                again=False, cache_results=True, cache_path=None):
+    """
+    Computes the Spike Time Tiling Coefficient (STTC, Cutts & Eglen, 2014 - see spike_time_tiling_coefficient)
+    of all pairs of units U, from their spike trains in samples.
+
+    T_A (fraction of recording time within dt of a spike of A) is computed once per unit,
+    as the length of the union of [t-dt, t+dt] intervals intersected with periods,
+    and P_AB (fraction of spikes of A within dt of a spike of B) for every pair
+    with a sliding window over both trains, in parallel across pairs.
+
+    Arguments:
+    - dp: str, datapath
+    - U: list/array of units
+    - dt: float, synchronicity window, in milliseconds
+    - periods: 'all' or [[t1,t2], [t3,t4]...] (seconds), recording periods to consider
+    - enforced_rp: float, enforced refractory period (ms)
+    - again: bool, whether to recompute results rather than loading them from cache.
+    - cache_results: bool, whether to cache results at dp/.NeuroPyxels.
+    - cache_path: None|str, where to cache results.
+
+    Returns:
+    - sttc: (len(U), len(U)) symmetric array, STTC of all pairs of units (NaN if a train is empty)
+    """
+    U = npa(U).ravel()
+    periods = check_periods(periods)
+    fs = read_metadata(dp)['highpass']['sampling_rate']
+    if isinstance(periods, str):
+        periods_s = np.array([[0, get_rec_len(dp, unit='samples')]], dtype=np.float64)
+    else:
+        periods_s = np.sort(periods, axis=0)*fs
+    dt = dt*fs/1000 # conversion to samples
+
+    trains = trn_many(dp, U, periods=periods, enforced_rp=enforced_rp)
+    N = npa([len(t) for t in trains]).astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(N)]).astype(np.int64)
+    times = np.concatenate([np.asarray(t, dtype=np.float64) for t in trains]+[np.zeros(0)])
+
+    T = sttc_tiling_numba(times, offsets, dt, periods_s[:,0].copy(), periods_s[:,1].copy())
+    pairs_i, pairs_j = np.triu_indices(len(U), 1)
+    P_ij, P_ji = sttc_proportions_numba(times, offsets, pairs_i.astype(np.int64), pairs_j.astype(np.int64), dt)
+
+    PA, PB = P_ij/N[pairs_i], P_ji/N[pairs_j]
+    TA, TB = T[pairs_i], T[pairs_j]
+    # in cases where T and P are 1 (0/0 division),
+    # every spike of the train with P = 1 is within dt of the other train: partial index is 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index_a = np.where(PA*TB == 1, 1., (PA - TB)/(1 - PA*TB))
+        index_b = np.where(PB*TA == 1, 1., (PB - TA)/(1 - PB*TA))
+    index = 0.5*index_a + 0.5*index_b
+    index[(N[pairs_i] == 0) | (N[pairs_j] == 0)] = np.nan
+
+    sttc = np.zeros((len(U), len(U)))
+    sttc[pairs_i, pairs_j] = sttc[pairs_j, pairs_i] = index
+    sttc[np.diag_indices(len(U))] = np.where(N > 0, 1., np.nan)
+
+    return sttc
+
+@njit(cache=True, parallel=True)
+def sttc_tiling_numba(times, offsets, dt, period_starts, period_ends):
+    """
+    Fraction of the (sorted, non overlapping) periods covered by the union
+    of intervals [t-dt, t+dt] around the spikes of every train (T_A of the STTC).
+    times: concatenated sorted trains, delimited by offsets.
+    """
+    n_units = len(offsets) - 1
+    T = np.zeros(n_units)
+    total = np.sum(period_ends - period_starts)
+    for u in prange(n_units):
+        tiled = 0.
+        p = 0
+        i = offsets[u]
+        while i < offsets[u+1]:
+            # union of overlapping intervals
+            start, end = times[i] - dt, times[i] + dt
+            i += 1
+            while i < offsets[u+1] and times[i] - dt <= end:
+                end = times[i] + dt
+                i += 1
+            # intersection with periods
+            while p < len(period_ends) and period_ends[p] <= start:
+                p += 1
+            q = p
+            while q < len(period_starts) and period_starts[q] < end:
+                tiled += min(end, period_ends[q]) - max(start, period_starts[q])
+                q += 1
+        T[u] = tiled/total
+    return T
+
+@njit(cache=True, parallel=True)
+def sttc_proportions_numba(times, offsets, pairs_i, pairs_j, dt):
+    """
+    For every pair of trains (i, j), number of spikes of i within dt of a spike of j
+    and number of spikes of j within dt of a spike of i (sliding windows over both sorted trains).
+    times: concatenated sorted trains, delimited by offsets.
+    """
+    n_pairs = len(pairs_i)
+    P_ij = np.zeros(n_pairs)
+    P_ji = np.zeros(n_pairs)
+    for k in prange(n_pairs):
+        t1 = times[offsets[pairs_i[k]]:offsets[pairs_i[k]+1]]
+        t2 = times[offsets[pairs_j[k]]:offsets[pairs_j[k]+1]]
+        P_ij[k] = n_spikes_within_dt(t1, t2, dt)
+        P_ji[k] = n_spikes_within_dt(t2, t1, dt)
+    return P_ij, P_ji
+
+@njit(cache=True)
+def n_spikes_within_dt(t1, t2, dt):
+    "Number of spikes of sorted t1 with a spike of sorted t2 within [-dt, +dt]."
+    n = 0
+    j = 0
+    for i in range(len(t1)):
+        while j < len(t2) and t2[j] < t1[i] - dt:
+            j += 1
+        if j < len(t2) and t2[j] <= t1[i] + dt:
+            n += 1
+    return n
+
 #%% Power spectrum of autocorrelograms
 
 @npyx_cacher
 def PSDxy(dp, U, bin_size, window='hann', nperseg=4096,
           scaling='spectrum', fs=30000,
           ret=True, sav=True, verbose=False,
+          n_jobs=None, block_size=32, out_of_core=False, ret_triu=False,
           cache_results=True, cache_path=None):
     '''
     ********
@@ -2845,6 +4292,11 @@ def PSDxy(dp, U, bin_size, window='hann', nperseg=4096,
     computes Power Density Spectrum - float64, in V**2/Hertz
     ********
 
+    Equivalent to scipy.signal.csd for every pair of binarized trains (real part),
+    but the Welch segments of every unit are FFT'd only once, and cross spectra are then
+    computed as batched conjugate products of these FFTs averaged over segments
+    (by blocks of units, in parallel, upper triangle only).
+
     - dp (string): DataPath to the Neuropixels dataset.
     - u (list of ints): list of units indices
     - bin_size: size of bins of binarized trains, in milliseconds.
@@ -2855,57 +4307,80 @@ def PSDxy(dp, U, bin_size, window='hann', nperseg=4096,
     - ret (bool - default False): if True, train returned by the routine.
       if False, by definition of the routine, drawn to global namespace.
       - sav (bool - default True): if True, by definition of the routine, saves the file in dp/routinesMemory.
+    - n_jobs: int, number of threads computing blocks of pairs (defaults to the number of cpu cores)
+    - block_size: int, number of units per block of pairs
+    - out_of_core: bool, whether to store the segments FFTs of all units in a memory-mapped array
+                   (in dp/.NeuroPyxels) rather than in RAM - for long recordings of large populations.
+    - ret_triu: bool, whether to return the upper triangle only, as a (Npairs, nperseg/2+1) array
+                (pairs in the order of np.triu_indices(Nunits)) rather than the full (Nunits, Nunits, nperseg/2+1) array
 
       returns numpy array (Nunits, Nunits, nperseg/2+1)'''
     # Preformat
     dp=str(dp)
     U = [U] if type(U)!=list else U
-    sortedU=list(np.sort(np.array(U)))
-
-    # Search if the variable is already saved in dp/routinesMemory
-    # DEPRECATED - now caching with cachecache
-    # dpnm = get_npyx_memory(dp)
-
-    # if os.path.exists(Path(dpnm,'PSDxy{}_{}.npy'.format(sortedU, str(bin_size).replace('.','_')))):
-    #     if verbose: print("File PSDxy{}_{}.npy found in routines memory.".format(str(sortedU).replace(" ", ""), str(bin_size).replace('.','_')))
-    #     Pxy = np.load(Path(dpnm,'PSDxy{}_{}.npy'.format(sortedU, str(bin_size).replace('.','_'))))
-    #     Pxy = Pxy.astype(np.float64)
-
-    if verbose: print("File ccg_{}_{}.npy not found in routines memory.".format(str(sortedU).replace(" ", ""), str(bin_size).replace('.','_')))
-    Pxy = np.empty((len(sortedU), len(sortedU), int(nperseg/2)+1), dtype=np.float64)
-    for i, u1 in enumerate(sortedU):
-        trnb1 = trnb(dp, u1, bin_size)
-        for j, u2 in enumerate(sortedU):
-            trnb2 = trnb(dp, u2, bin_size)
-            (f, Pxy[i, j, :]) = sgnl.csd(trnb1, trnb2, fs=fs, window=window, nperseg=nperseg, scaling=scaling)
-    Pxy = Pxy.astype(np.float64)
-    
-    # DEPRECATED - now caching with cachecache
-    # Save it
-    # if sav:
-    #     np.save(Path(dpnm,'PSDxy{}_{}.npy'.format(str(sortedU).replace(" ", ""), str(bin_size).replace('.','_'))), Pxy)
-
-    # Back to the original order
-    sPxy = np.zeros(Pxy.shape)
-    sortedU=np.array(sortedU)
-    for i1, u1 in enumerate(U):
-        for i2, u2 in enumerate(U):
-            ii1, ii2 = np.nonzero(sortedU==u1)[0], np.nonzero(sortedU==u2)[0]
-            sPxy[i1,i2,:]=Pxy[ii1, ii2, :]
+    assert scaling in ['density', 'spectrum']
+    if n_jobs is None: n_jobs=num_cores
+
+    M = trnb_sparse(dp, U, bin_size)
+    n_units, n_bins = M.shape
+    assert n_bins >= nperseg, f'nperseg ({nperseg}) must be smaller than the binarized trains length ({n_bins})!'
+
+    # Welch segments (scipy.signal.csd defaults: noverlap=nperseg//2, constant detrending, onesided)
+    win = sgnl.get_window(window, nperseg)
+    step = nperseg - nperseg//2
+    n_segments = (n_bins - nperseg//2)//step
+    n_freqs = nperseg//2+1
+    scale = 1.0/(fs*(win*win).sum()) if scaling=='density' else 1.0/win.sum()**2
+
+    # Segments FFT of every unit, computed once
+    if verbose: print(f"Computing the segments FFTs of {n_units} units...")
+    if out_of_core:
+        tmp_dir = tempfile.TemporaryDirectory(dir=get_npyx_memory(dp))
+        F = np.lib.format.open_memmap(Path(tmp_dir.name, 'segments_fft.npy'), mode='w+',
+                                      dtype=np.complex128, shape=(n_units, n_freqs, n_segments))
+    else:
+        F = np.empty((n_units, n_freqs, n_segments), dtype=np.complex128)
+    for i in range(n_units):
+        x = M[i].toarray().ravel().astype(np.float64)
+        segments = np.lib.stride_tricks.sliding_window_view(x, nperseg)[::step][:n_segments]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+        F[i] = np.fft.rfft(segments*win, n=nperseg, axis=1).T
+
+    # Cross spectra of blocks of pairs, as batched conjugate products averaged over segments
+    onesided_factor = np.full(n_freqs, 2.)
+    onesided_factor[0] = 1
+    if nperseg%2==0: onesided_factor[-1] = 1
+    blocks = [np.arange(b, min(b+block_size, n_units)) for b in range(0, n_units, block_size)]
+    pairs_i, pairs_j = np.triu_indices(n_units)
+    pair_index = np.zeros((n_units, n_units), dtype=np.int64)
+    pair_index[pairs_i, pairs_j] = np.arange(len(pairs_i))
+    Pxy = np.zeros((len(pairs_i), n_freqs), dtype=np.float64)
+
+    def cross_spectra_block(bi, bj):
+        Fi, Fj = np.asarray(F[bi]).transpose(1,0,2), np.asarray(F[bj]).transpose(1,2,0)
+        P = np.real(np.matmul(np.conjugate(Fi), Fj)).transpose(1,2,0) # (len(bi), len(bj), n_freqs)
+        P *= scale*onesided_factor/n_segments
+        ii, jj = np.meshgrid(bi, bj, indexing='ij')
+        upper = ii<=jj
+        Pxy[pair_index[ii[upper], jj[upper]]] = P[upper]
+
+    block_pairs = [(bi, bj) for k, bi in enumerate(blocks) for bj in blocks[k:]]
+    Parallel(n_jobs=n_jobs, prefer='threads')(delayed(cross_spectra_block)(bi, bj) for bi, bj in block_pairs)
+    del F
+    if out_of_core: tmp_dir.cleanup()
+
+    f = np.fft.rfftfreq(nperseg, 1/fs)
+    if ret_triu:
+        return f, Pxy
+
+    # Full symmetric array (real parts of the cross spectra are symmetric)
+    sPxy = np.zeros((n_units, n_units, n_freqs), dtype=np.float64)
+    sPxy[pairs_i, pairs_j] = Pxy
+    sPxy[pairs_j, pairs_i] = Pxy
 
     # Either return or draw to global namespace
     if ret:
-        PXY=sPxy.copy()
-        del sPxy
-        f = np.linspace(0, 15000, int(nperseg/2)+1)
-        return f, PXY
-    else:
-        # fn_ = ''
-        # for i in range(len(U)):
-        #     fn_+='_'+str(U[i])
-        # if verbose: print("PSDxy{}_{} and f defined into global namespace.".format(fn_, str(bin_size).replace('.','_')))
-        # exec("PSDxy{}_{} = sPxy".format(fn_, str(bin_size).replace('.','_')), globals())
-        del sPxy
+        return f, sPxy
 
 
 #%% Circular imports
@@ -8,6 +8,7 @@ Dataset: Neuropixels dataset -> dp is phy directory (kilosort or spyking circus
 """
 import json
 import os
+import weakref
 from pathlib import Path
 
 import numpy as np
@@ -381,6 +382,8 @@ def load_units_qualities(dp, again=False):
         if (dp / f).exists():
             qualities = pd.read_csv(dp / f, sep='\s+')
             re_spikesorted = detect_new_spikesorting(dp)
+            if re_spikesorted:
+                clear_spike_index(dp)
             regenerate = True if (again or re_spikesorted) else False
             assert (
                 "cluster_id" in qualities.columns
@@ -455,9 +458,11 @@ def load_merged_units_qualities(dp_merged, ds_table=None):
     return qualities
 
 
-def get_units(dp, quality="all", chan_range=None, again=False):
-    assert quality in ["all", "good", "mua", "noise", "unsorted"]
-
+def load_dataset_qualities(dp, again=False):
+    """
+    Load unit qualities of a regular or merged dataset
+    (see load_units_qualities and load_merged_units_qualities).
+    """
     if assert_multi(dp):
         qualities = load_merged_units_qualities(dp)
         try:
@@ -473,6 +478,18 @@ def get_units(dp, quality="all", chan_range=None, again=False):
     else:
         qualities = load_units_qualities(dp, again=again)
 
+    return qualities
+
+
+def get_units(dp, quality="all", chan_range=None, again=False):
+    assert quality in ["all", "good", "mua", "noise", "unsorted"]
+
+    ds = get_dataset_handle(dp)
+    if ds is not None and not again:
+        qualities = ds.qualities()
+    else:
+        qualities = load_dataset_qualities(dp, again=again)
+
     if quality == "all":
         units = qualities["cluster_id"].values
     else:
@@ -496,6 +513,307 @@ def get_good_units(dp):
     return get_units(dp, quality="good")
 
 
+# in-process copy of the spike index, keyed by dataset path
+_spike_index_memory = {}
+
+
+def spike_clusters_stamp(dp):
+    "returns (modification time in ns, size in bytes) of dp/spike_clusters.npy"
+    st = os.stat(Path(dp) / "spike_clusters.npy")
+    return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+
+def clear_spike_index(dp):
+    """
+    Deletes the spike index of dataset dp (in memory and in dp/npyxMemory),
+    so that it gets rebuilt from spike_clusters.npy on next call of get_spike_index.
+    """
+    _spike_index_memory.pop(str(Path(dp)), None)
+    dpnm = get_npyx_memory(dp)
+    for f in ["order", "units", "offsets", "stamp"]:
+        fn = Path(dpnm, f"spike_index_{f}.npy")
+        if fn.exists():
+            try:
+                os.remove(fn)
+            except:
+                pass
+
+
+def get_spike_index(dp, again=False):
+    """
+    Loads (or builds) a CSR-like index of spike_clusters.npy,
+    to slice the spikes of any unit without scanning the whole recording.
+
+    The spikes of unit units[i] are order[offsets[i]:offsets[i+1]] (spike ids, sorted in time).
+    The index is saved in dp/npyxMemory alongside the modification time and size of spike_clusters.npy,
+    and is rebuilt whenever spike_clusters.npy changes (phy curation, new merger...)
+    or when detect_new_spikesorting reports a new spikesorting.
+
+    Arguments:
+        - dp: str, path to dataset (original or merged)
+        - again: bool, whether to rebuild the index from spike_clusters.npy
+
+    Returns:
+        - order: (n_spikes,) int64 array, stable argsort of spike_clusters.npy
+        - units: (n_units,) array, sorted units found in spike_clusters.npy
+        - offsets: (n_units+1,) int64 array, boundaries of each unit's spikes in order
+    """
+    dp = Path(dp)
+    # new spikesorting also clears the index (see load_units_qualities).
+    # For merged datasets, detect_new_spikesorting cannot be used directly,
+    # but merge_datasets rewrites spike_clusters.npy (hence changes its stamp).
+    stamp = spike_clusters_stamp(dp)
+
+    mem = _spike_index_memory.get(str(dp), None)
+    if not again and mem is not None and np.all(mem[0] == stamp):
+        return mem[1:]
+
+    dpnm = get_npyx_memory(dp)
+    fns = {f: Path(dpnm, f"spike_index_{f}.npy") for f in ["order", "units", "offsets", "stamp"]}
+    loaded = False
+    if not again and all(fn.exists() for fn in fns.values()):
+        try:
+            if np.all(np.load(fns["stamp"]) == stamp):
+                order = np.load(fns["order"], mmap_mode="r")
+                units = np.load(fns["units"])
+                offsets = np.load(fns["offsets"])
+                loaded = True
+        except:
+            pass
+
+    if not loaded:
+        spike_clusters = np.load(dp / "spike_clusters.npy").ravel()
+        order = np.argsort(spike_clusters, kind="stable").astype(np.int64)
+        units, starts = np.unique(spike_clusters[order], return_index=True)
+        offsets = np.append(starts, len(order)).astype(np.int64)
+        try:
+            if is_writable(dpnm):
+                for f, arr in zip(["order", "units", "offsets", "stamp"], [order, units, offsets, stamp]):
+                    np.save(fns[f], arr)
+        except:
+            pass
+
+    _spike_index_memory[str(dp)] = (stamp, order, units, offsets)
+
+    return order, units, offsets
+
+
+def get_unit_spike_ids(dp, unit, again=False):
+    """
+    Returns the spike ids (indices in spike_times.npy) of unit, sorted in time,
+    sliced from the spike index (see get_spike_index).
+    Returns an empty array if unit is not in spike_clusters.npy.
+    """
+    order, units, offsets = get_spike_index(dp, again)
+    i = np.searchsorted(units, unit)
+    if i >= len(units) or units[i] != unit:
+        return np.array([], dtype=np.int64)
+    return np.asarray(order[offsets[i] : offsets[i + 1]])
+
+
+# open dataset handles, keyed by absolute dataset path
+_open_datasets = {}
+# handles owned by another object (e.g. circuitProphyler.Dataset): only registered while it exists
+_owned_datasets = weakref.WeakValueDictionary()
+
+
+def _handle_key(dp):
+    return str(Path(dp).absolute())
+
+
+def get_dataset_handle(dp):
+    """
+    Returns the DatasetHandle opened at dp (dp can be a path or a handle), or None if no handle is open.
+    """
+    if dp is None:
+        return None
+    if isinstance(dp, DatasetHandle):
+        return dp
+    key = _handle_key(dp)
+    return _open_datasets.get(key, _owned_datasets.get(key, None))
+
+
+def open_dataset(dp):
+    "Returns the DatasetHandle opened at dp, opening it if necessary."
+    ds = get_dataset_handle(dp)
+    return DatasetHandle(dp) if ds is None else ds
+
+
+def close_dataset(dp):
+    "Closes the DatasetHandle opened at dp (drops its cached files and memmaps)."
+    ds = get_dataset_handle(dp)
+    if ds is not None:
+        ds.close()
+
+
+def get_memmap(dp, fname):
+    """
+    Returns a read-only memmap of the .npy file dp/fname,
+    kept alive by the DatasetHandle of dp if one is open.
+    """
+    ds = get_dataset_handle(dp)
+    if ds is not None:
+        return ds.memmap(fname)
+    return np.load(Path(dp, fname), mmap_mode="r")
+
+
+def files_stamp(files):
+    "returns a tuple of (file, modification time in ns, size in bytes) of existing files"
+    stamp = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            stamp.append((str(f), st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            pass
+    return tuple(stamp)
+
+
+class DatasetHandle:
+    """
+    Lightweight handle to a kilosort/phy directory, opened once per session.
+
+    It keeps the parsed metadata, unit qualities, channel maps and memmaps of the .npy arrays
+    in memory and returns them without reading the files again,
+    unless the modification time (or size) of the underlying files changed.
+
+    Every function taking a datapath dp also accepts a handle
+    (it behaves as an os.PathLike pointing to the dataset).
+    Moreover, once a handle is open, functions called with the plain path of this dataset
+    use the handle cache too (npyx.gl.close_dataset(dp) to stop).
+
+    Usage:
+    >>> dp = npyx.open_dataset('path/to/kilosort/output')
+    >>> t = npyx.trn(dp, 1) # metadata and units are only parsed once
+
+    or, to close the handle at the end of the block:
+    >>> with npyx.open_dataset('path/to/kilosort/output') as dp:
+    >>>     t = npyx.trn(dp, 1)
+
+    With owned=True, the handle is only registered as long as the object is referenced
+    (used by subclasses tied to the lifetime of an object, e.g. circuitProphyler.Dataset).
+    """
+
+    def __repr__(self):
+        return f"Handle of Neuropixels dataset at {self.dp}."
+
+    def __init__(self, dp, owned=False):
+        dp = Path(dp)
+        assert dp.exists(), f"Provided path {dp} does not exist!"
+        self.dp = dp
+        self._cache = {}
+        self._owned = owned
+        self._register(overwrite=True)
+
+    def _register(self, overwrite=False):
+        registry = _owned_datasets if self._owned else _open_datasets
+        if overwrite:
+            registry[_handle_key(self.dp)] = self
+        else:
+            registry.setdefault(_handle_key(self.dp), self)
+
+    def __fspath__(self):
+        return str(self.dp)
+
+    def __str__(self):
+        return str(self.dp)
+
+    def __truediv__(self, other):
+        return self.dp / other
+
+    def __eq__(self, other):
+        if isinstance(other, (DatasetHandle, str, Path)):
+            return _handle_key(self) == _handle_key(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(_handle_key(self))
+
+    def __getstate__(self):
+        # memmaps and cached files are not sent to other processes
+        state = self.__dict__.copy()
+        state["_cache"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._register()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._cache = {}
+        key = _handle_key(self.dp)
+        for registry in [_open_datasets, _owned_datasets]:
+            if registry.get(key, None) is self:
+                del registry[key]
+
+    def source_dps(self):
+        "dataset path(s) - source datasets paths for merged datasets"
+        if assert_multi(self.dp):
+            return self.cached("source_dps", [self.dp / "datasets_table.csv"],
+                               lambda: [self.dp] + [Path(dp) for dp in get_ds_table(self.dp)["dp"]])
+        return [self.dp]
+
+    def cached(self, key, files, compute):
+        """
+        Returns the cached value of key, unless the stamp of files changed
+        (in which case the value is recomputed with compute()).
+        """
+        stamp = files_stamp(files)
+        if key in self._cache and self._cache[key][0] == stamp:
+            return self._cache[key][1]
+        value = compute()
+        # the stamp is taken again as compute() can rewrite some files (e.g. cluster_group.tsv)
+        self._cache[key] = (files_stamp(files), value)
+        return value
+
+    def metadata_files(self):
+        """
+        Files read by read_metadata (.meta, .oebin, params.py, binary files and spike_times.npy
+        of the dataset or its source datasets), listed again at every call
+        so that added or removed files also invalidate the cached metadata.
+        """
+        files = [self.dp / "datasets_table.csv"] if assert_multi(self.dp) else []
+        for dp in self.source_dps():
+            files += [dp / f for f in os.listdir(dp)
+                      if f.endswith((".meta", ".oebin", ".bin")) or f in ["params.py", "spike_times.npy"]]
+            if (dp / "continuous").is_dir(): # openEphys binary files
+                files += sorted((dp / "continuous").glob("*/*.dat"))
+        return files
+
+    def read_metadata(self):
+        "Cached npyx.inout.read_metadata(dp) (do not edit returned dictionnary in place)."
+        return self.cached("metadata", self.metadata_files(), lambda: read_metadata(self.dp, use_handle=False))
+
+    def qualities(self):
+        "Cached units qualities table (see load_units_qualities)."
+        files = []
+        for dp in self.source_dps():
+            files += [dp / "cluster_group.tsv", dp / "spike_clusters.npy"]
+        return self.cached("qualities", files, lambda: load_dataset_qualities(self.dp))
+
+    def get_units(self, quality="all", chan_range=None):
+        return get_units(self, quality, chan_range)
+
+    def get_chan_map(self, y_orig="surface", probe_version=None):
+        "Cached npyx.inout.chan_map(dp, y_orig, probe_version)."
+        files = self.metadata_files() + [self.dp / "channel_map.npy", self.dp / "channel_positions.npy"]
+        cm = self.cached(
+            ("chan_map", y_orig, probe_version), files, lambda: chan_map(self.dp, y_orig, probe_version, use_handle=False)
+        )
+        return cm.copy()
+
+    def memmap(self, fname):
+        "Read-only memmap of .npy file dp/fname."
+        fn = self.dp / fname
+        return self.cached(("memmap", fname), [fn], lambda: np.load(fn, mmap_mode="r"))
+
+
 def check_periods(periods):
     err_mess = "periods can only be 'all' or a list of lists/tuples [[t1.1,t1.2], [t2.1,t2.2]...] in seconds!"
     if isinstance(periods, str):
@@ -622,6 +940,6 @@ def export_new_trains_to_phy(dp, spike_times, spike_ids, tsv_label,
     
 
 # circular imports
-from npyx.inout import read_metadata
+from npyx.inout import read_metadata, chan_map
 from npyx.merger import assert_multi, get_ds_table, merge_datasets
 from npyx.spk_wvf import get_depthSort_peakChans
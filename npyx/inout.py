@@ -10,6 +10,8 @@ Input/output utilitaries to deal with Neuropixels files.
 import os
 import shutil
 from ast import literal_eval as ale
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 from pathlib import Path
 
@@ -31,7 +33,7 @@ from npyx.utils import list_files, npa, read_pyfile, npyx_cacher, is_writable
 
 #%% Load metadata and channel map
 
-def read_metadata(dp):
+def read_metadata(dp, use_handle=True):
     f'''
     {metadata.__doc__}
 
@@ -40,8 +42,14 @@ def read_metadata(dp):
     the structure of meta is then 'probe1':meta_data_dataset1,
                                   'probe2':meta_data_dataset_2, ...
 
+    If a DatasetHandle is open at dp (npyx.gl.open_dataset), metadata are only parsed once
+    (unless use_handle is False or metadata files are modified).
     '''
     
+    ds = get_dataset_handle(dp) if use_handle else None
+    if ds is not None:
+        return ds.read_metadata()
+
     if assert_multi(dp):
         meta = {}
         for dpx, probe in get_ds_table(dp).loc[:,'dp':'probe'].values:
@@ -321,7 +329,7 @@ def metadata(dp):
     return meta
 
 
-def chan_map(dp=None, y_orig='surface', probe_version=None):
+def chan_map(dp=None, y_orig='surface', probe_version=None, use_handle=True):
     '''
     Returns probe channel map.
     Arguments:
@@ -332,12 +340,17 @@ def chan_map(dp=None, y_orig='surface', probe_version=None):
                         If 'local', will load channelmap from dp (only contains analyzed channels, not all channels)
                         If explicitely given, will return complete channelmap of electrode.
                         If None, will guess probe version from metadata and return complete channelmap.
+        - use_handle: bool, whether to use the cached channel map of the DatasetHandle open at dp if any.
     Returns:
         - chan_map: array of shape (N_electrodes, 3).
                     1st column is channel indices, 2nd x position, 3rd y position
     '''
 
     assert y_orig in ['surface', 'tip']
+    ds = get_dataset_handle(dp) if use_handle else None
+    if ds is not None:
+        return ds.get_chan_map(y_orig, probe_version)
+
     if probe_version is None:
         assert dp is not None, "You need to provide either a path or a probe version!"
         probe_version=read_metadata(dp)['probe_version']
@@ -656,7 +669,7 @@ def extract_rawChunk(dp, times, channels=np.arange(384),
                      whiten=0, med_sub=0, hpfilt=0, hpfiltf=300, filter_forward=True, filter_backward=True,
                      nRangeWhiten=None, nRangeMedSub=None, use_ks_w_matrix=True,
                      ignore_ks_chanfilt=True, center_chans_on_0=False, verbose=False, scale=True,
-                     again=False, cache_results=False, cache_path=None):
+                     again=False, cache_results=False, cache_path=None, queue_depth=1):
     '''Function to extract a chunk of raw data on a given range of channels on a given time window.
     Arguments:
     - dp: datapath to folder with binary path (files must ends in .bin, typically ap.bin)
@@ -684,6 +697,7 @@ def extract_rawChunk(dp, times, channels=np.arange(384),
     - cache_results: bool, whether to cache results at local_cache_memory.
     - cache_path: None|str, where to cache results.
                     If None, dp/.NeuroPyxels will be used.
+    - queue_depth: int, number of blocks of the chunk read concurrently (see iter_preads). Default 1: serial reads.
                     
     Returns:
     - rawChunk: numpy array of shape ((c2-c1), (t2-t1)*fs).
@@ -736,21 +750,13 @@ def extract_rawChunk(dp, times, channels=np.arange(384),
         return
 
     # Get chunk from binary file
-    with open(fname, 'rb') as f_src:
-        # each sample for each channel is encoded on 16 bits = 2 bytes: samples*Nchannels*2.
-        byte1 = int(t1*Nchans*bytes_per_sample)
-        byte2 = int(t2*Nchans*bytes_per_sample)
-        bytesRange = byte2-byte1
-
-        f_src.seek(byte1)
-
-        bData = f_src.read(bytesRange)
+    # each sample for each channel is encoded on 16 bits = 2 bytes: samples*Nchannels*2.
+    byte1 = int(t1*Nchans*bytes_per_sample)
+    rc = np.empty((int(t2-t1), Nchans), dtype=np.int16) # 16bits decoding
+    pread_array(fname, byte1, rc, queue_depth)
 
-    # Decode binary data
     # channels on axis 0, time on axis 1
-    assert len(bData)%2==0
-    rc = np.frombuffer(bData, dtype=np.int16) # 16bits decoding
-    rc = rc.reshape((int(t2-t1), Nchans)).T
+    rc = rc.T
     rc = rc[:-1,:] # remove sync channel
 
     # Median subtraction = CAR
@@ -893,6 +899,161 @@ def read_custom_binary(fn, Nchans, dtype='int16'):
     
     return memmap_f
 
+def read_snippets(fname, t_starts, n_samples, n_channels, dtype='int16', channels=None,
+                  max_gap=None, max_read_mb=64, queue_depth=1):
+    """
+    Gathers snippets of data (e.g. spike waveforms) from a binary file of shape (n_samples_file, n_channels).
+
+    Snippets are read in time order: snippets closer than max_gap samples from each other
+    are coalesced into a single sequential read (of at most max_read_mb),
+    then sliced at once with a precomputed (n_snippets, n_samples) index grid.
+    Each read is a positioned read straight into a preallocated array
+    (faster than page faults of a memory map on data absent from the page cache),
+    and up to queue_depth reads are issued concurrently (see iter_preads).
+
+    Arguments:
+    - fname: str, path to binary file
+    - t_starts: (n_snippets,) array of first samples of snippets (any order)
+    - n_samples: int, number of samples per snippet
+    - n_channels: int, number of channels of binary file
+    - dtype: str, datatype of binary data
+    - channels: array/slice of channels to return (default: all channels)
+    - max_gap: int, maximum number of samples between two snippets for them to be read together
+               (default: n_samples)
+    - max_read_mb: float, maximum size of a single read (MB)
+    - queue_depth: int, maximum number of concurrent reads (default 1: serial reads).
+                   Only worth increasing on storage serving concurrent requests (NVMe drives, parallel filesystems).
+
+    Returns:
+    - snippets: (n_snippets, n_samples, n_channels) array of dtype dtype, in the order of t_starts.
+    """
+    n_channels_out = len(np.arange(n_channels)[slice(None) if channels is None else channels])
+    snippets = np.empty((len(np.ravel(t_starts)), n_samples, n_channels_out), dtype=dtype)
+    for ids, snips in iter_snippets(fname, t_starts, n_samples, n_channels, dtype, channels,
+                                    max_gap, max_read_mb, queue_depth):
+        snippets[ids] = snips
+
+    return snippets
+
+def iter_snippets(fname, t_starts, n_samples, n_channels, dtype='int16', channels=None,
+                  max_gap=None, max_read_mb=64, queue_depth=1):
+    """
+    Generator streaming through a binary file once, in time order,
+    to read snippets of data (see read_snippets for details and arguments).
+
+    Yields, for each read:
+    - ids: (n_read,) array of indices (in t_starts) of the snippets read
+    - snippets: (n_read, n_samples, n_channels) array of dtype dtype, in the order of ids.
+    """
+    dtype = np.dtype(dtype)
+    t_starts = np.asarray(t_starts, dtype=np.int64).ravel()
+    max_gap = n_samples if max_gap is None else max_gap
+    sample_bytes = n_channels * dtype.itemsize
+    filesize_samples = os.path.getsize(fname) // sample_bytes
+    assert np.all(t_starts >= 0) and np.all(t_starts + n_samples <= filesize_samples),\
+        "Some snippets go beyond the limits of the binary file!"
+    all_channels = channels is None
+    channels = slice(None) if all_channels else channels
+    if len(t_starts) == 0:
+        return
+
+    order = np.argsort(t_starts, kind='stable')
+    t_sorted = t_starts[order]
+    grid = np.arange(n_samples)
+
+    # split snippets in groups read at once: a new group starts after a gap larger than max_gap,
+    # or every max_read_samples (to bound memory)
+    max_read_samples = max(int(max_read_mb * 2**20 // sample_bytes), 2 * n_samples)
+    read_end = np.maximum.accumulate(t_sorted + n_samples)
+    new_group = np.ones(len(t_sorted), dtype=bool)
+    new_group[1:] = ((t_sorted[1:] - read_end[:-1]) > max_gap) |\
+                    ((t_sorted[1:] // max_read_samples) != (t_sorted[:-1] // max_read_samples))
+    bounds = np.append(np.nonzero(new_group)[0], len(t_sorted))
+
+    def reads():
+        for b1, b2 in zip(bounds[:-1], bounds[1:]):
+            # isolated snippets are read in place, groups of snippets as a single chunk
+            shape = (1, n_samples, n_channels) if b2 - b1 == 1 else (read_end[b2-1] - t_sorted[b1], n_channels)
+            yield int(t_sorted[b1]) * sample_bytes, np.empty(shape, dtype=dtype)
+
+    groups = zip(bounds[:-1], bounds[1:])
+    for (b1, b2), chunk in zip(groups, iter_preads(fname, reads(), queue_depth, 4 * max_read_mb)):
+        if b2 - b1 == 1:
+            yield order[b1:b2], chunk if all_channels else chunk[:, :, channels]
+            continue
+        yield order[b1:b2], chunk[(t_sorted[b1:b2] - t_sorted[b1])[:, None] + grid][:, :, channels]
+
+def iter_preads(fname, reads, queue_depth=1, max_inflight_mb=256):
+    """
+    Generator reading a binary file at arbitrary positions with concurrent positioned reads:
+    up to queue_depth os.pread calls (which release the GIL) are in flight in a pool of threads,
+    which keeps fast storage (NVMe drives, parallel filesystems) busy.
+    Falls back to serial reads if queue_depth is 1 or if os.pread is unavailable (e.g. Windows).
+
+    Arguments:
+    - fname: str, path to binary file
+    - reads: iterable of (offset, out), with offset in bytes and out a preallocated C-contiguous array
+             filled with the out.nbytes bytes starting at offset
+    - queue_depth: int, maximum number of concurrent reads (default 1: serial reads)
+    - max_inflight_mb: float, maximum size of the reads in flight (MB), to bound memory (at least one read is in flight)
+
+    Yields:
+    - out: the arrays of reads, filled, in the order of reads.
+    """
+    if queue_depth <= 1 or not hasattr(os, 'pread'):
+        with open(fname, 'rb', buffering=0) as f:
+            for offset, out in reads:
+                f.seek(offset)
+                assert f.readinto(out) == out.nbytes, f"Tried to read beyond the end of {fname}!"
+                yield out
+        return
+
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(queue_depth) as pool:
+            inflight, inflight_bytes = deque(), 0
+            for offset, out in reads:
+                while inflight and (len(inflight) >= queue_depth or inflight_bytes + out.nbytes > max_inflight_mb * 2**20):
+                    done = inflight.popleft().result()
+                    inflight_bytes -= done.nbytes
+                    yield done
+                inflight.append(pool.submit(_pread_into, fd, out, offset))
+                inflight_bytes += out.nbytes
+            while inflight:
+                yield inflight.popleft().result()
+    finally:
+        os.close(fd)
+
+def pread_array(fname, offset, out, queue_depth=1, block_mb=4):
+    """
+    Fills array out with the out.nbytes bytes of binary file fname starting at offset,
+    split in blocks of block_mb read concurrently (see iter_preads).
+    """
+    buf = out.reshape(-1).view(np.uint8)
+    block = max(int(block_mb * 2**20), 1)
+    reads = ((offset + b, buf[b:b+block]) for b in range(0, len(buf), block))
+    for _ in iter_preads(fname, reads, queue_depth):
+        pass
+    return out
+
+def _pread_into(fd, out, offset):
+    """
+    Fills array out with positioned reads (which can return fewer bytes than requested),
+    straight into out with os.preadv if available.
+    """
+    buf = memoryview(out).cast('B')
+    n = 0
+    while n < len(buf):
+        if hasattr(os, 'preadv'):
+            n_read = os.preadv(fd, [buf[n:]], offset + n)
+        else:
+            data = os.pread(fd, len(buf) - n, offset + n)
+            n_read = len(data)
+            buf[n:n+n_read] = data
+        assert n_read > 0, "Tried to read beyond the end of the binary file!"
+        n += n_read
+    return out
+
 def assert_chan_in_dataset(dp, channels, ignore_ks_chanfilt=False):
     channels = np.array(channels)
     if ignore_ks_chanfilt:
@@ -1263,7 +1424,7 @@ def paq_read(file_path):
 class ImplementationError(Exception):
     pass
 
-from npyx.gl import assert_multi, get_ds_table, get_npyx_memory
+from npyx.gl import assert_multi, get_dataset_handle, get_ds_table, get_npyx_memory
 from npyx.preprocess import (
     adc_realign,
     approximated_whitening_matrix,
@@ -1218,7 +1218,7 @@ def plot_raw_trials(dp, window, trials, channel=None, units=None,
                     whiten=False, nRangeWhiten=None, med_sub=True, nRangeMedSub=None, hpfilt=0, hpfiltf=300,
                     filter_forward=False, filter_backward=False, ignore_ks_chanfilt=0,
                     yticks_jump=None, plot_ylabels=True,
-                    again=False, ax=None):
+                    again=False, ax=None, queue_depth=1):
     f'''
     Plot raw traces on a given channel across trials
     eventually with colored overlaid spike times of specified units.
@@ -1266,6 +1266,7 @@ def plot_raw_trials(dp, window, trials, channel=None, units=None,
         
         - again: bool, whether to recompute data rather than loading it from disc
         - ax: matplotlib axes, where plot will be plotted if provided
+        - queue_depth: int, number of blocks of each trial read concurrently (see npyx.inout.extract_rawChunk). Default 1: serial reads.
     '''
 
     # Define channel of interest
@@ -1287,7 +1288,7 @@ def plot_raw_trials(dp, window, trials, channel=None, units=None,
         rc = extract_rawChunk(dp, times, channel, 'highpass', False,
                         whiten, med_sub, hpfilt, hpfiltf, filter_forward, filter_backward,
                         nRangeWhiten, nRangeMedSub, False,
-                        ignore_ks_chanfilt, True, 0, 1, again)
+                        ignore_ks_chanfilt, True, 0, 1, again, queue_depth=queue_depth)
         traces.append(rc.ravel())
     traces = np.array(traces)
     traces = traces[::-1, :] # first trial up
@@ -3,17 +3,18 @@
 2018-07-20
 @author: Maxime Beau, Neural Computations Lab, University College London
 """
+import os
 import os.path as op
 
 from IPython.core.debugger import set_trace as breakpoint
 
 opj=op.join
-from pathlib import Path, PosixPath, WindowsPath
+from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from npyx.gl import check_periods, get_npyx_memory, get_units
+from npyx.gl import check_periods, get_npyx_memory, get_units, get_spike_index, get_unit_spike_ids, get_memmap
 from npyx.inout import read_metadata
 from npyx.utils import (
     assert_float,
@@ -25,6 +26,7 @@ from npyx.utils import (
     thresh_consec,
 )
 from scipy.optimize import curve_fit
+from scipy.sparse import csr_matrix
 from scipy.stats import iqr, norm
 
 
@@ -85,8 +87,7 @@ def ids(dp, unit, sav=True, verbose=False, periods='all',
     #         indices = np.nonzero(spike_clusters==unt)[0].ravel()
     # else:
 
-    spike_clusters = np.load(dp/"spike_clusters.npy", mmap_mode='r')
-    indices = np.nonzero(spike_clusters==unit)[0].ravel()
+    indices = get_unit_spike_ids(dp, unit)
 
     # DEPRECATED now caching with cachecache
     # # Save it
@@ -123,7 +124,7 @@ def load_amplitudes(dp, unit, verbose=False,
     dp = Path(dp)
     unit_ids = ids(dp, unit, True, verbose, periods, again, enforced_rp,
                    cache_results=cache_results, cache_path=cache_path)
-    return np.load(dp/'amplitudes.npy')[unit_ids]
+    return get_memmap(dp, 'amplitudes.npy')[unit_ids]
 
 @npyx_cacher
 def trn(dp, unit, sav=True, verbose=False,
@@ -175,9 +176,8 @@ def trn(dp, unit, sav=True, verbose=False,
         except AssertionError:
             assert unit in get_units(dp, again=True), err_mess
 
-        spike_clusters = np.load(Path(dp,"spike_clusters.npy"), mmap_mode='r')
-        spike_samples = np.load(Path(dp,'spike_times.npy'), mmap_mode='r')
-        train = spike_samples[spike_clusters==unit].ravel()
+        spike_samples = get_memmap(dp, 'spike_times.npy')
+        train = spike_samples[get_unit_spike_ids(dp, unit)].ravel()
 
         # Filter out spike duplicates (spikes following an ISI shorter than enforced_rp)
         # by default, only pure duplicates (yeah they happen!!)
@@ -201,6 +201,96 @@ def trn(dp, unit, sav=True, verbose=False,
 
     return train.astype(np.int64)
 
+def trn_many(dp, units=None, periods='all', enforced_rp=0,
+             return_ids=False, return_amplitudes=False, again=False):
+    '''
+    Computes the spike trains of many units at once, in samples
+    (from a single read of spike_times.npy and of the spike index, see npyx.gl.get_spike_index).
+
+    Equivalent to [trn(dp, u, periods=periods, enforced_rp=enforced_rp) for u in units],
+    without the per-unit overhead (metadata reading, units validation, caching).
+
+    Arguments:
+    - dp (string): DataPath to the Neuropixels dataset.
+    - units: list/array of units, or None for all units in spike_clusters.npy.
+    - periods: list [[t1,t2], [t3,t4],...] (in seconds) or 'all' for all periods.
+    - enforced_rp: float, enforced refractory period (ms)- if 2 spikes are separated by less than enforced_rp ms, the first one only is kept.
+                   By default 0, only removed pure duplicates (like trn). Use -1 to keep all spikes (like ids).
+    - return_ids: bool, whether to also return the spike indices of each unit (as ids).
+    - return_amplitudes: bool, whether to also return the amplitudes of each unit (as load_amplitudes).
+    - again: bool, whether to rebuild the spike index from spike_clusters.npy.
+
+    Returns:
+        - trains: list of int64 arrays, spike trains of units (in samples)
+        - (optional) ids: list of int64 arrays, spike indices of units
+        - (optional) amplitudes: list of arrays, amplitudes of units
+    '''
+    dp = Path(dp)
+    order, index_units, offsets = get_spike_index(dp, again)
+    if units is None:
+        units = index_units
+    units = npa([units]).ravel()
+    if len(units)==0:
+        empty = [[] for _ in range(1+return_ids+return_amplitudes)]
+        return tuple(empty) if (return_ids or return_amplitudes) else empty[0]
+
+    # units validation, once for all
+    units_m = np.isin(units, get_units(dp))
+    if not np.all(units_m):
+        units_m = np.isin(units, get_units(dp, again=True))
+    assert np.all(units_m), f'WARNING units {units[~units_m]} not found in dataset {dp}!'
+
+    # one sampling rate per unit (merged datasets can gather probes with different sampling rates)
+    fs_dic = {}
+    fs_units = np.zeros(len(units))
+    for iu, u in enumerate(units):
+        dp_source = npyx.merger.get_source_dp_u(dp, u)[0]
+        if str(dp_source) not in fs_dic:
+            fs_dic[str(dp_source)] = read_metadata(dp_source)['highpass']['sampling_rate']
+        fs_units[iu] = fs_dic[str(dp_source)]
+
+    # concatenated spike indices of all units, sorted in time for each unit
+    i_units = np.searchsorted(index_units, units)
+    assert np.all((i_units < len(index_units))) and np.all(index_units[i_units] == units),\
+        f'units {units} not found in spike_clusters.npy - probably a merger bug.'
+    counts = offsets[i_units+1] - offsets[i_units]
+    assert np.all(counts != 0), f'units {units[counts==0]} not found in spike_clusters.npy - probably a merger bug.'
+    spike_ids = np.concatenate([order[offsets[i]:offsets[i+1]] for i in i_units])
+    spike_samples = get_memmap(dp, 'spike_times.npy').ravel()
+    spikes = spike_samples[spike_ids].astype(np.int64)
+    fs_spikes = np.repeat(fs_units, counts)
+
+    # Filter out spike duplicates (spikes following an ISI shorter than enforced_rp)
+    # the first spike of each unit is never a duplicate
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    duplicates_m = np.append([False], np.diff(spikes)<=enforced_rp*fs_spikes[1:]/1000)
+    duplicates_m[starts] = False
+    keep_m = ~duplicates_m
+
+    # Optional selection of a section of the recording
+    periods = check_periods(periods)
+    if not isinstance(periods, str): # check_periods ensures that it should be 'all' if it is a string
+        sec_bool = np.zeros(len(spikes)).astype(bool)
+        for section in periods:
+            sec_bool = sec_bool|(spikes>=section[0]*fs_spikes)&(spikes<=section[1]*fs_spikes)
+        keep_m = keep_m&sec_bool
+
+    kept_counts = np.add.reduceat(keep_m, starts) if len(starts)>0 else counts
+    splits = np.cumsum(kept_counts)[:-1]
+    trains = np.split(spikes[keep_m], splits)
+    if not (return_ids or return_amplitudes):
+        return trains
+
+    ret = [trains]
+    spike_ids = spike_ids[keep_m]
+    if return_ids:
+        ret.append(np.split(spike_ids, splits))
+    if return_amplitudes:
+        amplitudes = get_memmap(dp, 'amplitudes.npy').ravel()
+        ret.append(np.split(np.asarray(amplitudes[spike_ids]), splits))
+
+    return tuple(ret)
+
 def duplicates_mask(t, enforced_rp=0, fs=30000):
     '''
     - t: in samples, sampled at fs Hz
@@ -336,8 +426,8 @@ def mfr(dp=None, U=None, exclusion_quantile=0.005, enforced_rp=0,
 
     U=npa([U]).flatten()
     MFR=[]
-    for u in U:
-        t=trn(dp, u, periods=periods, again=again, enforced_rp=enforced_rp, cache_results=False)
+    trains=trn_many(dp, U, periods=periods, enforced_rp=enforced_rp, again=again)
+    for u, t in zip(U, trains):
         dp_source = npyx.merger.get_source_dp_u(dp, u)[0]
         fs=read_metadata(dp_source)['highpass']['sampling_rate']
         MFR.append(mean_firing_rate(t, exclusion_quantile, fs))
@@ -396,6 +486,94 @@ def trnb(dp, u, b, periods='all',
     t_end = np.load(Path(dp,'spike_times.npy'), mmap_mode='r').ravel()[-1]
     return binarize(t, b, fs, t_end)
 
+def binarize_sparse(trains, bin_size, fs, rec_len=None):
+    '''Function to turn several spike trains (arrays of time stamps)
+       into a sparse population matrix of spike counts (CSR, units x bins),
+       binned as binarize would (bins of bin_size from 0 to rec_len, trailing partial bin dropped).
+       - trains: list of spike trains (arrays of time stamps, in samples sampled at fs Hertz)
+       - bin_size: size of binarized spike train bins, in milliseconds.
+       - fs: sampling frequency, in Hertz.
+       - rec_len: length of the recording, in SAMPLES. If not provided, time of the last spike.'''
+
+    # Process bin_size
+    bin_size = int(np.ceil(fs*bin_size/1000))  # Conversion ms->samples
+
+    # Process rec_len
+    if rec_len is None:
+        rec_len=max([t[-1] for t in trains if len(t)>0])
+
+    # same bins as np.histogram(t, bins=np.arange(0, rec_len, bin_size))
+    edges_end = np.arange(0, rec_len, bin_size)[-1]
+    n_bins = int(edges_end//bin_size)
+    rows = np.concatenate([np.full(len(t), i, dtype=np.int64) for i, t in enumerate(trains)])
+    t = np.concatenate([np.asarray(t, dtype=np.int64) for t in trains])
+    cols = t//bin_size
+    cols[t == edges_end] = n_bins-1 # last histogram bin is right-inclusive
+    m = (t >= 0) & (t <= edges_end)
+
+    return csr_matrix((np.ones(np.sum(m), dtype=np.int32), (rows[m], cols[m])),
+                      shape=(len(trains), n_bins), dtype=np.int32)
+
+def rebin_sparse(M, factor):
+    '''Rebins a sparse population matrix (CSR, units x bins) by an integer factor,
+       by summing groups of factor consecutive bins (trailing partial bin dropped).
+       - M: csr matrix, units x bins
+       - factor: int, number of bins of M per new bin'''
+    assert int(factor)==factor and factor>=1, 'Rebinning factor must be a positive integer!'
+    factor = int(factor)
+    n_bins = M.shape[1]//factor
+    coo = M.tocoo()
+    m = coo.col < n_bins*factor
+
+    return csr_matrix((coo.data[m], (coo.row[m], coo.col[m]//factor)),
+                      shape=(M.shape[0], n_bins), dtype=M.dtype)
+
+@npyx_cacher
+def trnb_sparse(dp, U, b, periods='all', enforced_rp=1,
+                again=False, cache_results=True, cache_path=None):
+    '''
+    ********
+    Computes the binarized spike trains of units U
+    as a sparse population matrix (CSR, Nunits x Nbins) - int32
+    ********
+
+    Row i is equivalent to trnb(dp, U[i], b, periods), but the population
+    is never densified (at 1ms bins over 2 hours, a dense train is 7.2M entries per unit).
+
+    - dp (string): DataPath to the Neuropixels dataset.
+    - U (list of ints): units indices
+    - b: float or list of floats, size of binarized spike train bins, in milliseconds.
+         If a list, the matrix of the finest bin size is computed
+         and the others are rebinned from it (must be integer multiples of the finest bin, in samples).
+    - periods: 'all' or [[t1,t2], [t3,t4]...] (seconds)
+    - enforced_rp: float, enforced refractory period (ms)
+    - again: bool, whether to recompute results rather than loading them from cache.
+    - cache_results: bool, whether to cache results at local_cache_memory.
+    - cache_path: None|str, where to cache results.
+                    If None, dp/.NeuroPyxels will be used.
+    Returns:
+    - M: csr matrix (Nunits x Nbins), or list of csr matrices if b is a list
+    '''
+    U = npa(U).ravel()
+    dp_source = npyx.merger.get_source_dp_u(dp, U[0])[0]
+    fs=read_metadata(dp_source)['highpass']['sampling_rate']
+    t_end = np.load(Path(dp,'spike_times.npy'), mmap_mode='r').ravel()[-1]
+
+    if not isinstance(b, (list, tuple, np.ndarray)):
+        assert b>=1000/fs
+        trains = trn_many(dp, U, periods=periods, enforced_rp=enforced_rp, again=again)
+        return binarize_sparse(trains, b, fs, t_end)
+
+    # multi bin sizes: integer rebinning of the finest matrix
+    b_samples = npa([int(np.ceil(fs*b_/1000)) for b_ in b])
+    factors = b_samples/b_samples.min()
+    assert np.all(factors == factors.astype(int)), \
+        f'All bin sizes must be integer multiples of the finest one ({np.min(b)}ms)!'
+    M_finest = trnb_sparse(dp, U, b[np.argmin(b_samples)], periods, enforced_rp,
+                           again=again, cache_results=cache_results, cache_path=cache_path)
+
+    return [rebin_sparse(M_finest, f) for f in factors.astype(int)]
+
 @npyx_cacher
 def get_firing_periods(dp, u, b=1, sd=1000, th=0.02,
                        again=False, train=None, fs=None, t_end=None,
@@ -640,6 +818,8 @@ def train_quality(dp, unit, period_m=[0,20],
         - good_fn_start_end: list of [start, end] of chunks with low enough fn rate (in seconds).
     """
     
+    assert isinstance(dp, (str, os.PathLike)),\
+        'Provide a string, a pathlib object or a dataset handle as the source directory'
     dp = Path(dp)
 
     # Hard-coded parameters
@@ -652,8 +832,6 @@ def train_quality(dp, unit, period_m=[0,20],
 
 
     # check that the passed values make sense
-    assert isinstance(dp, (str, PosixPath, WindowsPath)),\
-        'Provide a string or a pathlib object as the source directory'
     assert assert_int(unit), 'Unit provided should be an int'
     assert assert_int(fp_chunk_span), 'fp_chunk_span provided should be an int'
     assert assert_int(fp_chunk_size), 'fp_chunk_size provided should be an int'
@@ -6,6 +6,7 @@
 
 import multiprocessing
 import os
+import time
 from collections.abc import Iterable
 from pathlib import Path
 import psutil
@@ -22,9 +23,9 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from npyx.gl import get_npyx_memory, get_units
-from npyx.inout import chan_map, get_binary_file_path, read_metadata
+from npyx.inout import chan_map, get_binary_file_path, read_metadata, read_snippets, iter_snippets
 from npyx.preprocess import apply_filter, bandpass_filter, med_substract, whitening
-from npyx.utils import npyx_cacher, npa, split, xcorr_1d_loop
+from npyx.utils import npyx_cacher, npa, split, xcorr_1d_loop, xcorr_1d_batch
 
 
 @npyx_cacher
@@ -33,7 +34,7 @@ def wvf(dp, u=None, n_waveforms=100, t_waveforms=82, selection='regular', period
         save=True, verbose=False, again=False,
         whiten=False, med_sub=False, hpfilt=False, hpfiltf=300,
         nRangeWhiten=None, nRangeMedSub=None, ignore_ks_chanfilt=True,
-        return_corrupt_mask=False,
+        return_corrupt_mask=False, channels=None, queue_depth=1,
         cache_results=True, cache_path=None):
     '''
     ********
@@ -66,6 +67,11 @@ def wvf(dp, u=None, n_waveforms=100, t_waveforms=82, selection='regular', period
         - nRangeMedSub:       int, number of channels to use to compute the local median. | Default None
         - ignore_ks_chanfilt: bool, whether to ignore kilosort channel filtering
                                     (if False, output shape will always be n_waveforms x t_waveforms x 384) | Default False
+        - channels:           None|list/array of channel indices, subset of channels to extract (e.g. peak channel +/- 8 channels).
+                                    Only these channels (and the channels needed to compute their local median) are read and preprocessed,
+                                    the common median (med_sub without nRangeMedSub) is still computed across all channels.
+                                    Whitening is computed across the subset only. | Default None (all channels)
+        - queue_depth:        int, maximum number of concurrent reads of the binary file (see inout.read_snippets). | Default 1 (serial reads)
         - again: bool, whether to recompute results rather than loading them from cache.
         - cache_results: bool, whether to cache results at local_cache_memory.
         - cache_path: None|str, where to cache results.
@@ -101,7 +107,7 @@ def wvf(dp, u=None, n_waveforms=100, t_waveforms=82, selection='regular', period
                  selection, periods, spike_ids, wvf_batch_size, ignore_nwvf,
                  whiten, med_sub, hpfilt, hpfiltf, nRangeWhiten, nRangeMedSub,
                  ignore_ks_chanfilt, verbose,
-                 True, return_corrupt_mask, again,
+                 True, return_corrupt_mask, again, channels, queue_depth,
                  cache_results=cache_results, cache_path=cache_path)
 
     if return_corrupt_mask:
@@ -132,30 +138,16 @@ def get_waveforms(dp, u, n_waveforms=100, t_waveforms=82, selection='regular', p
                   whiten=0, med_sub=0, hpfilt=0, hpfiltf=300,
                   nRangeWhiten=None, nRangeMedSub=None, ignore_ks_chanfilt=True, verbose=False,
                   med_sub_in_time=True, return_corrupt_mask=False, again=False,
-                  cache_results=True, cache_path=None):
+                  channels=None, queue_depth=1, cache_results=True, cache_path=None):
     f"{wvf.__doc__}"
 
     # Extract and process metadata
     dp             = Path(dp)
-    meta           = read_metadata(dp)
-    dat_path       = get_binary_file_path(dp, 'ap')
-
     dp_source      = get_source_dp_u(dp, u)[0]
-    meta           = read_metadata(dp_source)
+    dat_path, meta, n_samples_dat = binary_file_params(dp_source)
     dtype          = np.dtype(meta['highpass']['datatype'])
     n_channels_dat = meta['highpass']['n_channels_binaryfile']
     n_channels_rec = n_channels_dat-1 if meta['acquisition_software']=='SpikeGLX' else n_channels_dat
-    sample_rate    = meta['highpass']['sampling_rate']
-    item_size      = dtype.itemsize
-    fileSizeBytes  = meta['highpass']['binary_byte_size']
-    assert not isinstance(fileSizeBytes, str), f"It seems like there isn't any binary file at {dp}."
-    if meta['acquisition_software']=='SpikeGLX':
-        if meta['highpass']['fileSizeBytes'] != fileSizeBytes:
-            print((f"\033[91;1mMismatch between ap.meta and ap.bin file size"
-            "(assumed encoding is {str(dtype)} and Nchannels is {n_channels_dat})!! "
-            f"Probably wrong meta file - just edit fileSizeBytes in the .ap.meta file at {dp} "
-            f"(replace {int(meta['highpass']['fileSizeBytes'])} with {fileSizeBytes}) "
-            "and be aware that something went wrong in your data management...\033[0m"))
 
     # Select subset of spikes
     spike_samples = np.load(Path(dp, 'spike_times.npy'), mmap_mode='r').squeeze()
@@ -167,68 +159,322 @@ def get_waveforms(dp, u, n_waveforms=100, t_waveforms=82, selection='regular', p
     else:
         assert isinstance(spike_ids, Iterable), "WARNING spike_ids must be a list/array of ids!"
         spike_ids_subset = np.array(spike_ids)
-    n_spikes = len(spike_ids_subset)
 
-    # Get waveforms times in bytes
+    # Get waveforms first samples
     # and check that, for this waveform width,
     # they no not go beyond file limits
     waveforms_t  = spike_samples[spike_ids_subset].astype(np.int64)
-    waveforms_t1 = (waveforms_t-t_waveforms//2)*n_channels_dat*item_size
-    waveforms_t2 = (waveforms_t+t_waveforms//2)*n_channels_dat*item_size
-    wcheck_m=(0<=waveforms_t1)&(waveforms_t2<fileSizeBytes)
+    waveforms_t1 = waveforms_t-t_waveforms//2
+    wcheck_m=(0<=waveforms_t1)&(waveforms_t1+t_waveforms<=n_samples_dat)
     if not np.all(wcheck_m):
         print(f"Invalid times: {waveforms_t[~wcheck_m]}")
-        waveforms_t1 = waveforms_t1[wcheck_m]
-        waveforms_t2 = waveforms_t2[wcheck_m]
-
-    # Iterate over waveforms
-    waveforms = np.zeros((n_spikes, t_waveforms, n_channels_rec), dtype=np.float32)
+    corrupt_mask = ~wcheck_m
+    waveforms_t1 = waveforms_t1[wcheck_m]
+    n_spikes = len(waveforms_t1)
+
+    # Gather waveforms from binary file
+    # (nearby waveforms are read together, see read_snippets)
+    # and preprocess them
+    channels, load_channels, block_size = waveforms_channels(channels, n_channels_rec, med_sub, nRangeMedSub, t_waveforms)
     if verbose: print(f'Loading waveforms of unit {u} ({n_spikes})...')
-    with open(dat_path, "rb") as f:
-        for i,t1 in enumerate(waveforms_t1):
-            if n_spikes>10:
-                if i%(n_spikes//10)==0 and verbose: print(f'{round((i/n_spikes)*100)}%...', end=' ')
-            f.seek(t1, 0) # 0 for absolute file positioning
-            try:
-                wave = f.read(n_channels_dat*t_waveforms*item_size)
-                wave = np.frombuffer(wave, dtype=dtype).reshape((t_waveforms,n_channels_dat))
-                # get rid of sync channel
-                waveforms[i,:,:] = wave[:,:-1] if meta['acquisition_software']=='SpikeGLX' else wave
-            except:
-                print(f"WARNING it seems the binary file at {dp} is corrupted. Waveform {i} (at byte {t1}, {t1/n_channels_dat/item_size/sample_rate}s) could not be loaded.")
-                waveforms[i,:,:] = np.nan
-    corrupt_mask = np.isnan(waveforms[:,0,0])
-    waveforms = waveforms[~corrupt_mask,:,:]
-    n_spikes -= np.sum(corrupt_mask)
-    if med_sub_in_time:
-        medians = np.median(waveforms, axis = 1)
-        waveforms = waveforms - medians[:,np.newaxis,:]
+    read_raw = lambda i, j: read_snippets(dat_path, waveforms_t1[i:j], t_waveforms, n_channels_dat, dtype,
+                                          channels=load_channels if channels is not None else slice(0, n_channels_rec),
+                                          queue_depth=queue_depth)
+    waveforms = preprocess_waveforms(read_raw, n_spikes, t_waveforms, block_size, dp, meta, channels, load_channels,
+                                     whiten, med_sub, hpfilt, hpfiltf, nRangeWhiten, nRangeMedSub,
+                                     ignore_ks_chanfilt, med_sub_in_time)
     if verbose: print('\n')
 
-    # Preprocess waveforms
-    if hpfilt|med_sub|whiten:
-        waveforms     = waveforms.reshape((n_spikes*t_waveforms, n_channels_rec))
-        if hpfilt:
-            waveforms = apply_filter(waveforms, bandpass_filter(rate=sample_rate, low=None, high=hpfiltf, order=3), axis=0)
-        if med_sub:
-            waveforms = med_substract(waveforms, axis=1, nRange=nRangeMedSub)
-        if whiten:
-            waveforms = whitening(waveforms.T, nRange=nRangeWhiten).T # whitens across channels so gotta transpose
-        waveforms     = waveforms.reshape((n_spikes,t_waveforms, n_channels_rec))
+    if return_corrupt_mask:
+        return waveforms, corrupt_mask
+    
+    return waveforms.astype(np.float32)
+
+def wvf_units(dp, units, n_waveforms=100, t_waveforms=82, selection='regular', periods='all',
+              wvf_batch_size=10, ignore_nwvf=True,
+              whiten=False, med_sub=False, hpfilt=False, hpfiltf=300,
+              nRangeWhiten=None, nRangeMedSub=None, ignore_ks_chanfilt=True,
+              med_sub_in_time=True, return_corrupt_mask=False, channels=None,
+              memmap_dir=None, queue_depth=1, verbose=False, again=False,
+              cache_results=True, cache_path=None):
+    '''
+    ********
+    Extracts samples of waveforms of several units in a single pass through the raw data file.
+    ********
+
+    The waveforms of all units are merged into one time-sorted read schedule,
+    and snippets are dispatched to per-unit arrays as the binary file is streamed through (see inout.iter_snippets)
+    - sequential reads instead of one batch of random reads per unit.
+    The waveforms of each unit are then preprocessed exactly like with wvf(dp, u, spike_ids=units[u], ...).
+
+    Arguments:
+        - dp:                 str or PosixPath, path to kilosorted dataset.
+        - units:              list of units, or dict {unit: spike_ids} with spike_ids absolute indices of spikes
+                                    in the unit's (source) dataset. If spike_ids is None (or units is a list),
+                                    n_waveforms are selected according to selection and periods (see wvf).
+        - channels:           None|list/array of channel indices, channel subset extracted for all units (see wvf).
+        - memmap_dir:         None|str, if provided, raw snippets are dispatched to memory-mapped .npy files in this directory,
+                                    and the preprocessed waveforms of each unit are saved there as waveforms_{unit}.npy
+                                    and returned as read-only memory maps (to extract more waveforms than fits in RAM).
+                                    | Default None
+        - queue_depth:        int, maximum number of concurrent reads of the binary file (see inout.iter_snippets). | Default 1 (serial reads)
+        - see wvf for other arguments.
+
+    Returns:
+        - waveforms:          dict {unit: (n_waveforms, t_waveforms, n_channels) array}
+        - corrupt_masks:      (if return_corrupt_mask) dict {unit: (n_spikes,) boolean array of waveforms beyond file limits}
+    '''
+    dp = Path(dp)
+    if not isinstance(units, dict):
+        units = {u: None for u in units}
+    if memmap_dir is not None:
+        Path(memmap_dir).mkdir(parents=True, exist_ok=True)
+    kwargs = dict(n_waveforms=n_waveforms, t_waveforms=t_waveforms, selection=selection, periods=periods,
+                  wvf_batch_size=wvf_batch_size, ignore_nwvf=ignore_nwvf,
+                  whiten=whiten, med_sub=med_sub, hpfilt=hpfilt, hpfiltf=hpfiltf,
+                  nRangeWhiten=nRangeWhiten, nRangeMedSub=nRangeMedSub, ignore_ks_chanfilt=ignore_ks_chanfilt,
+                  med_sub_in_time=med_sub_in_time, return_corrupt_mask=True, channels=channels,
+                  queue_depth=queue_depth, verbose=verbose, again=again, cache_results=cache_results, cache_path=cache_path)
+
+    # merged datasets: one pass per source dataset
+    if assert_multi(dp):
+        sources = {}
+        for u, spike_ids in units.items():
+            dp_source, u_source = get_source_dp_u(dp, u)
+            sources.setdefault(dp_source, {})[u] = (u_source, spike_ids)
+        waveforms, corrupt_masks = {}, {}
+        for i, (dp_source, source_units) in enumerate(sources.items()):
+            source_memmap_dir = None if memmap_dir is None else Path(memmap_dir, str(i))
+            w, m = wvf_units(dp_source, dict(source_units.values()), memmap_dir=source_memmap_dir, **kwargs)
+            for u, (u_source, _) in source_units.items():
+                waveforms[u], corrupt_masks[u] = w[u_source], m[u_source]
+        if return_corrupt_mask:
+            return waveforms, corrupt_masks
+        return waveforms
+
+    # Extract and process metadata
+    dat_path, meta, n_samples_dat = binary_file_params(dp)
+    dtype          = np.dtype(meta['highpass']['datatype'])
+    n_channels_dat = meta['highpass']['n_channels_binaryfile']
+    n_channels_rec = n_channels_dat-1 if meta['acquisition_software']=='SpikeGLX' else n_channels_dat
+    channels, load_channels, block_size = waveforms_channels(channels, n_channels_rec, med_sub, nRangeMedSub, t_waveforms)
+
+    # Get waveforms first samples of every unit
+    spike_samples = np.load(Path(dp, 'spike_times.npy'), mmap_mode='r').squeeze()
+    waveforms_t1, corrupt_masks = {}, {}
+    for u, spike_ids in units.items():
+        if spike_ids is None:
+            spike_ids = get_ids_subset(dp, u,
+                                       n_waveforms, wvf_batch_size, selection, periods,
+                                       ignore_nwvf, verbose,
+                                       again, cache_results=cache_results, cache_path=cache_path)
+        waveforms_t = spike_samples[np.array(spike_ids, dtype=np.int64)].astype(np.int64)
+        t1 = waveforms_t-t_waveforms//2
+        wcheck_m = (0<=t1)&(t1+t_waveforms<=n_samples_dat)
+        if not np.all(wcheck_m):
+            print(f"Invalid times of unit {u}: {waveforms_t[~wcheck_m]}")
+        corrupt_masks[u] = ~wcheck_m
+        waveforms_t1[u]  = t1[wcheck_m]
+
+    # Merge them in a single read schedule:
+    # snippet i belongs to unit units[unit_i[i]], at position unit_pos[i] of this unit's waveforms
+    units    = list(waveforms_t1.keys())
+    n_spikes = np.array([len(waveforms_t1[u]) for u in units], dtype=np.int64)
+    t1_all   = np.concatenate([waveforms_t1[u] for u in units]+[np.zeros(0, dtype=np.int64)])
+    unit_i   = np.repeat(np.arange(len(units)), n_spikes)
+    unit_pos = np.arange(len(t1_all))-np.repeat(np.cumsum(n_spikes)-n_spikes, n_spikes)
+
+    # Stream through the binary file once, dispatching snippets to per-unit arrays
+    raw_waveforms = {}
+    for u, n in zip(units, n_spikes):
+        shape = (n, t_waveforms, len(load_channels))
+        if memmap_dir is None:
+            raw_waveforms[u] = np.empty(shape, dtype=dtype)
+        else:
+            raw_waveforms[u] = np.lib.format.open_memmap(Path(memmap_dir, f'raw_waveforms_{u}.npy'),
+                                                         mode='w+', dtype=dtype, shape=shape)
+    if verbose: print(f'Loading waveforms of {len(units)} units ({len(t1_all)})...')
+    for ids, snippets in iter_snippets(dat_path, t1_all, t_waveforms, n_channels_dat, dtype,
+                                       channels=load_channels if channels is not None else slice(0, n_channels_rec),
+                                       queue_depth=queue_depth):
+        ids_units = unit_i[ids]
+        for i in np.unique(ids_units):
+            m = ids_units==i
+            raw_waveforms[units[i]][unit_pos[ids[m]]] = snippets[m]
+
+    # Preprocess waveforms of every unit
+    waveforms = {}
+    for u in units:
+        raw = raw_waveforms.pop(u)
+        w = preprocess_waveforms(lambda i, j: raw[i:j], len(raw), t_waveforms, block_size,
+                                 dp, meta, channels, load_channels,
+                                 whiten, med_sub, hpfilt, hpfiltf, nRangeWhiten, nRangeMedSub,
+                                 ignore_ks_chanfilt, med_sub_in_time).astype(np.float32)
+        if memmap_dir is not None:
+            del raw
+            os.remove(Path(memmap_dir, f'raw_waveforms_{u}.npy'))
+            np.save(Path(memmap_dir, f'waveforms_{u}.npy'), w)
+            w = np.load(Path(memmap_dir, f'waveforms_{u}.npy'), mmap_mode='r')
+        waveforms[u] = w
+
+    if return_corrupt_mask:
+        return waveforms, corrupt_masks
+
+    return waveforms
+
+def binary_file_params(dp):
+    """
+    Returns the path to the binary file of dataset dp, its metadata (see read_metadata)
+    and its number of samples, after checking the consistency of metadata and file size.
+    """
+    dp             = Path(dp)
+    dat_path       = get_binary_file_path(dp, 'ap')
+    meta           = read_metadata(dp)
+    dtype          = np.dtype(meta['highpass']['datatype'])
+    n_channels_dat = meta['highpass']['n_channels_binaryfile']
+    item_size      = dtype.itemsize
+    fileSizeBytes  = meta['highpass']['binary_byte_size']
+    assert not isinstance(fileSizeBytes, str), f"It seems like there isn't any binary file at {dp}."
+    if meta['acquisition_software']=='SpikeGLX':
+        if meta['highpass']['fileSizeBytes'] != fileSizeBytes:
+            print((f"\033[91;1mMismatch between ap.meta and ap.bin file size"
+            "(assumed encoding is {str(dtype)} and Nchannels is {n_channels_dat})!! "
+            f"Probably wrong meta file - just edit fileSizeBytes in the .ap.meta file at {dp} "
+            f"(replace {int(meta['highpass']['fileSizeBytes'])} with {fileSizeBytes}) "
+            "and be aware that something went wrong in your data management...\033[0m"))
+    n_samples_dat = fileSizeBytes//(n_channels_dat*item_size)
+
+    return dat_path, meta, n_samples_dat
+
+def waveforms_channels(channels, n_channels_rec, med_sub, nRangeMedSub, t_waveforms):
+    """
+    Returns the channels to load from the binary file to extract and preprocess waveforms on channels
+    (see get_waveforms), and the number of waveforms to preprocess at once.
+    Returns:
+        - channels: None or (n_channels,) int64 array of requested channels
+        - load_channels: sorted array of channels to load - all channels (without sync channel),
+                         or requested channels and the channels required to compute their local median
+        - block_size: int, number of waveforms preprocessed at once
+    """
+    if channels is None:
+        return None, np.arange(n_channels_rec), np.iinfo(np.int64).max
+
+    channels = npa(channels).astype(np.int64).ravel()
+    assert np.all((0<=channels)&(channels<n_channels_rec)), f"channels must be between 0 and {n_channels_rec-1}!"
+    if med_sub and nRangeMedSub is None:
+        # the common median needs all channels: if only some channels are requested,
+        # waveforms are loaded and preprocessed on all channels in blocks, and only the requested channels are kept
+        return channels, np.arange(n_channels_rec), max(1, 2**28//(t_waveforms*n_channels_rec*4))
+    load_channels = np.unique(channels)
+    if med_sub:
+        load_channels = np.unique(np.concatenate(local_median_channels(load_channels, n_channels_rec, nRangeMedSub)))
+
+    return channels, load_channels, np.iinfo(np.int64).max
+
+def preprocess_waveforms(read_raw, n_waveforms, t_waveforms, block_size, dp, meta, channels, load_channels,
+                         whiten=0, med_sub=0, hpfilt=0, hpfiltf=300,
+                         nRangeWhiten=None, nRangeMedSub=None, ignore_ks_chanfilt=True,
+                         med_sub_in_time=True):
+    """
+    Preprocesses raw waveforms loaded on load_channels (see waveforms_channels),
+    by blocks of block_size waveforms, and returns them in uV on the requested channels (see get_waveforms).
+    Arguments:
+        - read_raw: function, read_raw(i, j) returns raw waveforms i to j, of shape (j-i, t_waveforms, len(load_channels))
+        - n_waveforms: int, number of waveforms
+        - see get_waveforms for other arguments.
+    Returns:
+        - waveforms: (n_waveforms, t_waveforms, n_channels) array
+    """
+    sample_rate    = meta['highpass']['sampling_rate']
+    n_channels_dat = meta['highpass']['n_channels_binaryfile']
+    n_channels_rec = n_channels_dat-1 if meta['acquisition_software']=='SpikeGLX' else n_channels_dat
+    proc_channels  = load_channels if channels is None else np.unique(channels)
+    common_median  = med_sub and nRangeMedSub is None and channels is not None
+
+    # the high-pass filter runs over concatenated waveforms:
+    # blocks are extended with enough neighbouring waveforms
+    # for the filter transients at their edges to decay below 1e-10, then trimmed
+    overlap = 0
+    if hpfilt:
+        filt = bandpass_filter(rate=sample_rate, low=None, high=hpfiltf, order=3)
+        if block_size < n_waveforms:
+            decay_samples = np.log(1e-10)/np.log(np.max(np.abs(np.roots(filt[1]))))
+            overlap = int(np.ceil(decay_samples/t_waveforms))
+
+    waveforms = []
+    for b in range(0, max(n_waveforms, 1), block_size):
+        b0, b1 = max(0, b-overlap), min(n_waveforms, b+block_size+overlap)
+        w = read_raw(b0, b1).astype(np.float32)
+        n_w = w.shape[0]
+        if med_sub_in_time:
+            medians = np.median(w, axis = 1)
+            w = w - medians[:,np.newaxis,:]
+
+        # Preprocess waveforms
+        if hpfilt|med_sub:
+            w     = w.reshape((n_w*t_waveforms, len(load_channels)))
+            if hpfilt:
+                w = apply_filter(w, filt, axis=0)
+            if med_sub:
+                if channels is None:
+                    w = med_substract(w, axis=1, nRange=nRangeMedSub)
+                elif common_median:
+                    w = (w-np.median(w, axis=1)[:,np.newaxis])[:,proc_channels]
+                else:
+                    w = med_substract_channels(w, load_channels, proc_channels, nRangeMedSub, n_channels_rec)
+            w     = w.reshape((n_w, t_waveforms, -1))
+        if channels is not None and w.shape[2]!=len(proc_channels):
+            w = w[:,:,np.isin(load_channels, proc_channels)]
+        waveforms.append(w[b-b0:b-b0+min(block_size, n_waveforms-b)])
+    waveforms = np.concatenate(waveforms, axis=0)
+    n_spikes, t_waveforms = waveforms.shape[:2]
+
+    if whiten:
+        waveforms = waveforms.reshape((n_spikes*t_waveforms, len(proc_channels)))
+        waveforms = whitening(waveforms.T, nRange=nRangeWhiten).T # whitens across channels so gotta transpose
+        waveforms = waveforms.reshape((n_spikes,t_waveforms, len(proc_channels)))
 
     # Filter channels ignored by kilosort if necesssary
+    if channels is not None:
+        waveforms      = waveforms[:,:,np.searchsorted(proc_channels, channels)] # requested order
     if not ignore_ks_chanfilt:
         channel_ids_ks = np.load(Path(dp, 'channel_map.npy'), mmap_mode='r').squeeze()
         channel_ids_ks = channel_ids_ks[channel_ids_ks!=384]
-        waveforms      = waveforms[:,:,channel_ids_ks] # only AFTER processing, filter out channels
+        if channels is None:
+            waveforms      = waveforms[:,:,channel_ids_ks] # only AFTER processing, filter out channels
+        else:
+            waveforms      = waveforms[:,:,np.isin(channels, channel_ids_ks)]
 
     # Correct voltage scaling
     waveforms *= meta['bit_uV_conv_factor']
 
-    if return_corrupt_mask:
-        return waveforms, corrupt_mask
-    
-    return waveforms.astype(np.float32)
+    return waveforms
+
+def local_median_channels(channels, n_channels, nRange):
+    '''
+    Returns the list of the nRange+1 closest channels of each channel in channels
+    amongst n_channels channels, used to compute local medians (see preprocess.med_substract).
+    '''
+    points=np.arange(n_channels)
+    return [np.sort(points[np.argsort(np.abs(points-c))[:nRange+1]]) for c in channels]
+
+def med_substract_channels(x, x_channels, channels, nRange, n_channels):
+    '''
+    Local median subtraction across a subset of channels, equivalent to
+    preprocess.med_substract(x_all, axis=1, nRange=nRange)[:, channels] on all n_channels channels.
+    Arguments:
+        - x: (n_samples, len(x_channels)) array
+        - x_channels: sorted array of channels of x, including all channels of local_median_channels(channels, ...)
+        - channels: sorted array of channels to median subtract (subset of x_channels)
+        - nRange: int, number of closest channels used to compute the local median
+        - n_channels: int, total number of channels
+    Returns:
+        - (n_samples, len(channels)) array
+    '''
+    x_local_med=np.zeros((x.shape[0], len(channels)))
+    for ci, closest in enumerate(local_median_channels(channels, n_channels, nRange)):
+        x_local_med[:,ci]=np.median(x[:, np.searchsorted(x_channels, closest)], axis=1)
+    return x[:, np.searchsorted(x_channels, channels)]-x_local_med
 
 @npyx_cacher
 def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
@@ -238,7 +484,7 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
                 n_waves_used_for_matching = 5000, peakchan_allowed_range=6,
                 use_average_peakchan = False, max_allowed_amplitude = 3000, max_allowed_shift=3,
                 n_waves_to_average=800, plot_debug=False, do_shift_match=True, n_waveforms_per_batch=10,
-                subselect_max_template=False, amp_max_percentile=0.95,
+                subselect_max_template=False, amp_max_percentile=0.95, channels=None, queue_depth=1,
                 cache_results=True, cache_path=None):
     """
     ********
@@ -313,6 +559,9 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
         - subselect_max_template: bool, whether to only use the kilosort template with the largest amount of spikes to compute the waveform
                                   (less likely to average together waveforms looking different)
         - amp_max_percentile: float, percentile of the amplitude distribution to use as the maximum amplitude for X-Y drift matching
+        - channels: None|list/array of contiguous channel indices, subset of channels to extract and match waveforms on
+                    (e.g. peak channel +/- 8 channels, see wvf). Must include the peak channel. | Default None (all channels)
+        - queue_depth: int, maximum number of concurrent reads of the binary file (see inout.read_snippets). | Default 1 (serial reads)
 
         - again: bool, whether to recompute results rather than loading them from cache.
         - cache_results: bool, whether to cache results at local_cache_memory.
@@ -321,7 +570,8 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
 
     Returns:
         - peak_dsmatched_waveform: (n_samples,) array (t_waveforms samples) storing the peak channel waveform
-        - dsmatched_waveform: (n_samples, n_channels) array storing the drift-shift-matched waveform across channels (384 for Neuropixels 1.0)
+        - dsmatched_waveform: (n_samples, n_channels) array storing the drift-shift-matched waveform across channels
+                              (384 for Neuropixels 1.0, or len(channels) if channels is provided)
         - spike_ids: (n_spikes,) array of absolute ids (w/r all spikes in recording)
                      of spikes subset selected to compute the final drift-shift-matched waveform
         - peak_channel: (1,) array storing the channel used to select the subset of waveforms during drift matching (de facto, peak channel)
@@ -351,6 +601,9 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
     #         fig = quickplot_n_waves(drift_shift_matched_mean, f'blue: 100 random waveforms\norange: dsmatched_waveforms (unit {u})', fig=fig)
     #     return np.load(Path(dpnm,fn)),drift_shift_matched_mean,np.load(Path(dpnm,fn_spike_id)), np.load(Path(dpnm,fn_peakchan))
 
+    # time stamps of every stage, to report where time goes (verbose)
+    t_stages = [('start', time.perf_counter())]
+
     ## Extract spike ids so we can extract consecutive waveforms
     spike_ids_all = ids(dp, u, periods=periods, again=again, cache_results=cache_results, cache_path=cache_path)
     # make sure to only select waveforms from 1 cluster if there was a merge
@@ -373,7 +626,7 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
     ## Subsample waveforms based on available RAM
     vmem=dict(psutil.virtual_memory()._asdict())
     available_RAM = vmem['available']
-    single_w_size = wvf(dp, None, t_waveforms=t_waveforms, spike_ids=[0],
+    single_w_size = wvf(dp, None, t_waveforms=t_waveforms, spike_ids=[0], channels=channels,
                         cache_results=cache_results, cache_path=cache_path).nbytes
     max_n_waveforms = available_RAM//single_w_size-100 # -100 to be safe
     n_waves_used_for_matching = min(n_waves_used_for_matching, max_n_waveforms)
@@ -388,6 +641,7 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
     else:
         spike_ids_split=spike_ids_split_all
     # spike_ids_split_indices = np.arange(0,spike_ids_split.shape[0],1)
+    t_stages.append(('spike ids selection', time.perf_counter()))
 
     ## Extract the waveforms using the wvf function in blocks of 10 (n_waveforms_per_batch).
     # After waves have been extracted, put the index of the channel with the
@@ -401,8 +655,10 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
                     whiten = whiten, med_sub = med_sub,
                     hpfilt = hpfilt, hpfiltf = hpfiltf, nRangeWhiten=nRangeWhiten,
                     nRangeMedSub=nRangeMedSub, ignore_ks_chanfilt=True,
-                    return_corrupt_mask=True,
+                    return_corrupt_mask=True, channels=channels, queue_depth=queue_depth,
                     cache_results=cache_results, cache_path=cache_path)
+    chan_ids = np.arange(raw_waves.shape[2]) if channels is None else npa(channels).ravel()
+    t_stages.append(('waveforms loading', time.perf_counter()))
     
     # Remove waveforms and spike_ids of batches with corrupt waveforms
     spike_ids_split = spike_ids_split.reshape(-1,n_waveforms_per_batch)
@@ -418,21 +674,24 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
     # Compute mean waveforms, batch-wise
     raw_waves = raw_waves.reshape(spike_ids_split.shape[0], n_waveforms_per_batch, t_waveforms, -1)
     mean_waves = np.mean(raw_waves, axis = 1)
+    t_stages.append(('batch averaging', time.perf_counter()))
     
     ## Find peak channel (and store amplitude) of every batch
     # only consider amplitudes on channels around original peak channel
     original_peak_chan = get_peak_chan(dp, u, again=again,
                                        cache_results=cache_results, cache_path=cache_path)
-    c_left, c_right = max(0, original_peak_chan-peakchan_allowed_range), min(original_peak_chan+peakchan_allowed_range, mean_waves.shape[2])
+    c_left, c_right = max(0, original_peak_chan-peakchan_allowed_range), original_peak_chan+peakchan_allowed_range
+    c_m = (chan_ids>=c_left)&(chan_ids<c_right)
+    assert np.any(c_m), f"None of the provided channels is within {peakchan_allowed_range} channels of the peak channel {original_peak_chan}!"
     # calculate amplitudes ("peak-to-peak"), but ONLY using 2ms (-30,30) in the middle
     amp_t_span = 20 #samples
     t1, t2 = max(0,mean_waves.shape[1]//2-amp_t_span), min(mean_waves.shape[1]//2+amp_t_span, mean_waves.shape[1])
-    amplitudes = np.ptp(mean_waves[:,t1:t2,c_left:c_right], axis=1)
+    amplitudes = np.ptp(mean_waves[:,t1:t2,c_m], axis=1)
     
     spike_ids_split_indices = np.arange(0, spike_ids_split.shape[0], 1)
     batch_peak_channels = np.zeros(shape=(spike_ids_split_indices.shape[0], 3))
     batch_peak_channels[:,0] = spike_ids_split_indices # store batch indices (batch = averaged 10 spikes)
-    batch_peak_channels[:,1] = c_left+np.argmax(amplitudes, axis = 1) # store peak channel of each batch
+    batch_peak_channels[:,1] = chan_ids[c_m][np.argmax(amplitudes, axis = 1)] # store peak channel of each batch
     batch_peak_channels[:,2] = np.max(amplitudes, axis = 1) # store peak channel amplitude
     
     # Filter out batches with too large amplitude (probably artefactual)
@@ -446,6 +705,8 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
         # use mode of peak channel distribution across spikes
         chans, count = np.unique(batch_peak_channels[:,1], return_counts = True)
         peak_channel = int(chans[np.argmax(count)])
+    assert peak_channel in chan_ids, f"Peak channel {peak_channel} is not part of the provided channels!"
+    peak_i = np.nonzero(chan_ids==peak_channel)[0][0] # index of peak channel in waveforms
 
     if plot_debug:
         fig = hist_MB(batch_peak_channels[:,1], a=peak_channel-20, b=peak_channel+20, s=1,
@@ -494,22 +755,30 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
     dsmatch_batch_ids = batch_peak_channels[:,0].astype(np.int64)
     drift_matched_waves = raw_waves[dsmatch_batch_ids]#.reshape(-1, t_waveforms, raw_waves.shape[-1])
     drift_matched_batches = np.mean(drift_matched_waves, axis=1)
+    t_stages.append(('drift matching', time.perf_counter()))
 
     # shift waves using simple negative peak matching
     recenter_spikes = False
     if do_shift_match:
-        drift_shift_matched_batches = shift_match(drift_matched_batches, peak_channel, max_allowed_shift, recenter_spikes, plot_debug)
+        drift_shift_matched_batches = shift_match(drift_matched_batches, peak_i, max_allowed_shift, recenter_spikes, plot_debug)
     else:
         drift_shift_matched_batches = drift_matched_batches
+    t_stages.append(('shift matching', time.perf_counter()))
     # Get the median of the drift and shift matched waves (not sensitive to outliers)
     drift_shift_matched_mean = np.median(drift_shift_matched_batches, axis=0)
-    drift_shift_matched_mean_peak = drift_shift_matched_mean[:,peak_channel]
+    drift_shift_matched_mean_peak = drift_shift_matched_mean[:,peak_i]
 
     # recenter spike absolute maximum
     if do_shift_match:
         shift = (np.argmax(np.abs(drift_shift_matched_mean_peak)) - drift_shift_matched_mean_peak.shape[0]//2)%drift_shift_matched_mean_peak.shape[0]
         drift_shift_matched_mean = np.concatenate([drift_shift_matched_mean[shift:], drift_shift_matched_mean[:shift]], axis=0)
         drift_shift_matched_mean_peak = np.concatenate([drift_shift_matched_mean_peak[shift:], drift_shift_matched_mean_peak[:shift]], axis=0)
+    t_stages.append(('median and recentering', time.perf_counter()))
+    if verbose:
+        t_total = t_stages[-1][1]-t_stages[0][1]
+        print(f"wvf_dsmatch of unit {u} computed in {t_total:.2f}s:")
+        for (_, t1), (stage, t2) in zip(t_stages[:-1], t_stages[1:]):
+            print(f"    - {stage}: {t2-t1:.3f}s ({100*(t2-t1)/t_total:.0f}%)")
 
     # DEPRECATED - now caching with cachecache
     # if save:
@@ -520,11 +789,11 @@ def wvf_dsmatch(dp, u, n_waveforms=100, t_waveforms=82, periods='all',
 
     if plot_debug:
         if verbose: print(f'Total averaged waveform batches ({n_waveforms_per_batch}/batch) after drift-shift matching: {batch_peak_channels.shape[0]}')
-        wave_baseline_toplot = wvf(dp, u, t_waveforms=t_waveforms, cache_results=cache_results, cache_path=cache_path)
+        wave_baseline_toplot = wvf(dp, u, t_waveforms=t_waveforms, channels=channels, cache_results=cache_results, cache_path=cache_path)
         # mean_waves[np.random.randint(0, mean_waves.shape[0], batch_peak_channels.shape[0]),:,:]
-        fig = quickplot_n_waves(np.mean(wave_baseline_toplot, axis=0), '', peak_channel, color='k')
-        fig = quickplot_n_waves(np.mean(drift_matched_batches, axis=0), '', peak_channel, fig=fig, color='darkgreen')
-        fig = quickplot_n_waves(drift_shift_matched_mean, 'raw:black\ndrift-matched:green\ndrift-shift-matched:red', peak_channel, fig=fig, color='red')
+        fig = quickplot_n_waves(np.mean(wave_baseline_toplot, axis=0), '', peak_i, color='k')
+        fig = quickplot_n_waves(np.mean(drift_matched_batches, axis=0), '', peak_i, fig=fig, color='darkgreen')
+        fig = quickplot_n_waves(drift_shift_matched_mean, 'raw:black\ndrift-matched:green\ndrift-shift-matched:red', peak_i, fig=fig, color='red')
         #breakpoint()
 
     return drift_shift_matched_mean_peak, drift_shift_matched_mean, drift_matched_spike_ids, peak_channel
@@ -534,13 +803,14 @@ def shift_match(waves, alignment_channel,
                 plot_debug=False, dynamic_template=False,
                 max_shift_allowed = 5):
     """
-    Iterate through waveforms to align them to each other
-    by maximizing their convolution.
+    Aligns waveforms to a template (median of the 50 waveforms of highest amplitude)
+    by maximizing their crosscorrelation with it, around the alignment channel.
+    The crosscorrelations of all waveforms are computed at once with ffts (see utils.xcorr_1d_batch),
+    and all waveforms are shifted with a single gather.
 
-    In order to have a time complexity O(n),
-    starts by aligning waves[1] to waves[0],
-    then waves[2] to mean(waves[[0], aligned waves[1]])...
-    So every wave will be aligned to the first wave.
+    With dynamic_template, iterates through waveforms instead:
+    starts by aligning waves[1] to the template,
+    then waves[2] to mean(template, aligned waves[1])...
 
     When shifting a wave, fills the gap
     with the bit clipped from the other end.
@@ -575,10 +845,49 @@ def shift_match(waves, alignment_channel,
         template = np.concatenate([template[shift:], template[:shift]], axis=0)# shift template to center maximum
         if plot_debug: plt.plot(template[:,alignment_channel])
 
-    # initialize array
-    aligned_waves = np.zeros(waves_sort.shape)
     chan_min, chan_max = max(0,alignment_channel-chan_range), min(alignment_channel+chan_range, template.shape[1])
     template = template[:,chan_min:chan_max] # defined across 10 closest channels
+    n_waves, n_samples = waves_sort.shape[:2]
+    if not dynamic_template:
+        # crosscorrelate all waves with the template at once,
+        # average xcorr across channels to find the optimal alignment
+        # using information from all channels around peak!
+        xcorr_w_template = xcorr_1d_batch(template, waves_sort[:,:,chan_min:chan_max])
+        xcorr_max = np.argmax(np.mean(xcorr_w_template, axis=2), axis=1)
+        shift = (xcorr_max-n_samples//2)%n_samples
+        shifts = (shift+n_samples//2)%n_samples-n_samples//2
+        # circular shift of every wave with a single gather
+        # (fills the gap with the bit clipped from the other end)
+        samples_i = (np.arange(n_samples)[np.newaxis,:]-shift[:,np.newaxis])%n_samples
+        aligned_waves = waves_sort[np.arange(n_waves)[:,np.newaxis], samples_i].astype(np.float64)
+        aligned_waves[np.abs(shifts)>max_shift_allowed] = np.nan
+    else:
+        aligned_waves, shifts = shift_match_dynamic(waves_sort, template, chan_min, chan_max, max_shift_allowed)
+
+    # discard nans (beyond max_shift_allowed) and re-sort waves properly
+    aligned_waves = aligned_waves[np.arange(aligned_waves.shape[0])[amplitudes_i[::-1]],:,:]
+    nan_m = np.isnan(aligned_waves[:,0,0])
+    aligned_waves = aligned_waves[~nan_m,:,:]
+
+    if plot_debug:
+        #fig = imshow_cbar(template.T)
+        a = np.max(np.abs(shifts))
+        a += 10-a%10
+        fig = hist_MB(shifts, s=1, a=-a, b=a, color='darkgreen', alpha=1,
+        title=(f'Shift matching:\ndistribution of shifts w/r template across spike batches'))
+        ylim = fig.get_axes()[0].get_ylim()
+        fig.get_axes()[0].plot([max_shift_allowed,max_shift_allowed], ylim, color='red', ls='--')
+        fig.get_axes()[0].plot([-max_shift_allowed,-max_shift_allowed], ylim, color='red', ls='--')
+        fig.get_axes()[0].set_ylim(ylim)
+
+    return aligned_waves
+
+def shift_match_dynamic(waves_sort, template, chan_min, chan_max, max_shift_allowed):
+    """
+    Sequential version of shift_match, where the template is updated
+    by averaging it with every aligned spike (see shift_match, dynamic_template=True).
+    """
+    aligned_waves = np.zeros(waves_sort.shape)
     shifts = []
     for i, w in enumerate(waves_sort):
         w_closestchannels = w[:,chan_min:chan_max]
@@ -599,35 +908,18 @@ def shift_match(waves, alignment_channel,
         # store realigned_wave in array
         aligned_waves[i,:,:] = realigned_w
 
-        # optionnally update template by averaging with realigned waveform
+        # update template by averaging with realigned waveform
         # didn't work very well - better to keep a relatively 'focused' template
-        if dynamic_template:
-            template = np.mean(np.stack(
-                            [template,
-                            realigned_w[:,chan_min:chan_max]],
-                            axis=2), axis=2)
+        template = np.mean(np.stack(
+                        [template,
+                        realigned_w[:,chan_min:chan_max]],
+                        axis=2), axis=2)
 
-    # discard nans (beyond max_shift_allowed) and re-sort waves properly
-    aligned_waves = aligned_waves[np.arange(aligned_waves.shape[0])[amplitudes_i[::-1]],:,:]
-    nan_m = np.isnan(aligned_waves[:,0,0])
-    aligned_waves = aligned_waves[~nan_m,:,:]
-
-    if plot_debug:
-        #fig = imshow_cbar(template.T)
-        a = np.max(np.abs(shifts))
-        a += 10-a%10
-        fig = hist_MB(shifts, s=1, a=-a, b=a, color='darkgreen', alpha=1,
-        title=(f'Shift matching:\ndistribution of shifts w/r template across spike batches'))
-        ylim = fig.get_axes()[0].get_ylim()
-        fig.get_axes()[0].plot([max_shift_allowed,max_shift_allowed], ylim, color='red', ls='--')
-        fig.get_axes()[0].plot([-max_shift_allowed,-max_shift_allowed], ylim, color='red', ls='--')
-        fig.get_axes()[0].set_ylim(ylim)
-
-    return aligned_waves
+    return aligned_waves, shifts
 
 def across_channels_SNR(dp, u, n_waveforms=500, t_waveforms=90,
                         periods='all', spike_ids=None,
-                        c = 1, chan_range = 3, return_distributions = False,
+                        c = 1, chan_range = 3, return_distributions = False, queue_depth=1,
                         again=False, cache_results=True, cache_path=None):
     
     dp = Path(dp)
@@ -641,7 +933,7 @@ def across_channels_SNR(dp, u, n_waveforms=500, t_waveforms=90,
     # get waveforms
     waves = get_waveforms(dp, u, n_waveforms, t_waveforms, 'regular',
                           periods, spike_ids, ignore_ks_chanfilt=True,
-                          again=again)
+                          again=again, queue_depth=queue_depth)
     
     # get random selection of voltage snippets in the vicinity of the waveforms
     meta           = read_metadata(dp)
@@ -664,12 +956,8 @@ def across_channels_SNR(dp, u, n_waveforms=500, t_waveforms=90,
         T2   = T2[wcheck_m]
 
     noise = np.zeros((n_spikes, t_waveforms, n_channels_rec), dtype=np.float32)
-    with open(dat_path, "rb") as f:
-        for i,t1 in enumerate(T1):
-            f.seek(t1, 0) # 0 for absolute file positioning
-            snip = f.read(n_channels_dat*t_waveforms*item_size)
-            snip = np.frombuffer(snip, dtype=dtype).reshape((t_waveforms, n_channels_dat))
-            noise[i,:,:]     = snip[:,:-1] if meta['acquisition_software']=='SpikeGLX' else snip
+    noise[:len(T1)] = read_snippets(dat_path, T1//(n_channels_dat*item_size), t_waveforms, n_channels_dat, dtype,
+                                    channels=slice(0, n_channels_rec), queue_depth=queue_depth) # (get rid of sync channel)
     # center on 0 like original waveform
     medians = np.median(noise, axis = 1)
     noise = noise - medians[:,np.newaxis,:]
@@ -821,8 +1109,8 @@ def get_depthSort_peakChans(dp, units=[], quality='all',
     for iu, u in enumerate(units):
         if verbose: print("Getting peak channel of unit {}...".format(u))
         peak_chans[iu,0] = u
-        peak_chans[iu,1] = np.array([get_peak_chan(dp, u, use_template,
-                                       cache_results=cache_results, cache_path=cache_path)]).astype(dt)
+        peak_chans[iu,1] = get_peak_chan(dp, u, use_template,
+                                         cache_results=cache_results, cache_path=cache_path)
     if assert_multi(dp):
         depth_ids = np.lexsort((-peak_chans[:,1], get_ds_ids(peak_chans[:,0])))
     else:
@@ -1,13 +1,14 @@
 import traceback
 
 import numpy as np
+import numba as nb
 
 import npyx
 from npyx.inout import get_npix_sync
 from npyx.gl import get_units, read_metadata
-from npyx.spk_t import ids, trn, trn_filtered
-from npyx.spk_wvf import wvf, wvf_dsmatch, get_peak_chan, templates
-from npyx.corr import ccg
+from npyx.spk_t import ids, trn, trn_filtered, trn_many
+from npyx.spk_wvf import wvf, wvf_dsmatch, get_peak_chan, templates, get_waveforms
+from npyx.corr import ccg, ccg_2d
 from npyx.plot import plot_acg, plot_ccg, plot_wvf, plot_raw
 
 prefix = "\033[34;1m--- "
@@ -42,10 +43,14 @@ def test_npyx(dp, raise_error=False):
 
     test_function(trn_filtered, raise_error, dp=dp, unit=u, plot_debug=True, again=1)
 
+    test_trn_many(dp, [u, u1], raise_error)
+
     test_function(wvf, raise_error, dp=dp, u=u, again=1)
 
     test_function(wvf_dsmatch, raise_error, dp=dp, u=u, plot_debug=True, again=1, verbose=True)
 
+    test_waveforms_queue_depth(dp, u, raise_error=raise_error)
+
     test_function(get_peak_chan, raise_error, dp=dp, unit=u, again=1)
 
     test_function(templates, raise_error, dp=dp, u=u)
@@ -61,6 +66,136 @@ def test_npyx(dp, raise_error=False):
     test_function(plot_raw, raise_error, dp=dp, times=[0.1,0.15], channels=list(range(50)), again=1)
 
 
+def test_ccg_2d(n_trials=5, n_spikes=3000, seed=0, raise_error=False):
+    """
+    Equivalence test harness of npyx.corr.ccg_2d:
+    compares its parallel dense, sparse and summed outputs,
+    and its dense output ran on a single thread,
+    to a serial reference on synthetic spike trains.
+
+    Arguments:
+    - n_trials: int, number of pairs of synthetic trains (random rates, bin and window sizes)
+    - n_spikes: int, maximum number of spikes per train
+    - seed: int, random seed
+    - raise_error: bool, whether to raise an error when a comparison fails
+
+    Returns:
+    - bool, whether all comparisons passed
+    """
+    print(f"{prefix}ccg_2d equivalence testing initiated, on {n_trials} pairs of synthetic trains...{suffix}")
+    rng = np.random.default_rng(seed)
+    n_threads = nb.get_num_threads()
+    passed = True
+    for trial in range(n_trials):
+        rec_len = int(rng.integers(1, 60)*30000)
+        t1 = np.unique(rng.integers(0, rec_len, rng.integers(1, n_spikes)))
+        t2 = np.unique(rng.integers(0, rec_len, rng.integers(1, n_spikes)))
+        if trial % 2 == 1: # synchronous spikes
+            t2 = np.unique(np.concatenate([t2, t1[::3]]))
+        binsize = int(rng.integers(1, 60))
+        windowsize = int(binsize*2*rng.integers(1, 100))
+
+        ref = ccg_2d_serial(t1, t2, binsize, windowsize)
+        dense = ccg_2d(t1, t2, binsize, windowsize, output='dense', cache_results=False)
+        sparse = ccg_2d(t1, t2, binsize, windowsize, output='sparse', cache_results=False)
+        summed = ccg_2d(t1, t2, binsize, windowsize, output='sum', cache_results=False)
+        nb.set_num_threads(1)
+        try:
+            single = ccg_2d(t1, t2, binsize, windowsize, output='dense', cache_results=False)
+        finally:
+            nb.set_num_threads(n_threads)
+
+        comparisons = {'parallel dense': np.array_equal(dense, ref),
+                       'single thread dense': np.array_equal(single, ref),
+                       'sparse': np.array_equal(sparse.toarray(), ref),
+                       'sum': np.array_equal(summed, ref.sum(0))}
+        for output, equal in comparisons.items():
+            if not equal:
+                passed = False
+                print((f"{red_prefix}ccg_2d {output} output differs from serial reference "
+                       f"(trial {trial}, binsize {binsize}, windowsize {windowsize}).{suffix}"))
+                if raise_error:
+                    raise FailedNpyxTest(f"ccg_2d {output} output differs from serial reference.")
+
+    if passed:
+        print(f"{prefix}Parallel and serial ccg_2d outputs are identical.{suffix}")
+    return passed
+
+def test_trn_many(dp, units, raise_error=False):
+    """
+    Equivalence test of npyx.spk_t.trn_many:
+    compares its trains to npyx.spk_t.trn ran unit by unit,
+    and its spike ids to npyx.spk_t.ids,
+    and checks that an empty list of units returns empty trains and ids.
+
+    Arguments:
+    - dp: path to Neuropixels data directory
+    - units: list of units to load
+    - raise_error: bool, whether to raise an error when a comparison fails
+
+    Returns:
+    - bool, whether all comparisons passed
+    """
+    trains, train_ids = trn_many(dp, units, return_ids=True)
+    comparisons = {'trains': all(np.array_equal(t, trn(dp, u)) for t, u in zip(trains, units)),
+                   'spike ids': all(np.array_equal(i, ids(dp, u, enforced_rp=0)) for i, u in zip(train_ids, units)),
+                   'empty units': trn_many(dp, []) == [] and trn_many(dp, [], return_ids=True) == ([], [])}
+    passed = True
+    for output, equal in comparisons.items():
+        if not equal:
+            passed = False
+            print(f"{red_prefix}trn_many {output} differ from expected output.{suffix}")
+            if raise_error:
+                raise FailedNpyxTest(f"trn_many {output} differ from expected output.")
+    return passed
+
+def test_waveforms_queue_depth(dp, u, queue_depth=4, raise_error=False):
+    """
+    Equivalence test of concurrent reads of the binary file:
+    compares the waveforms of npyx.spk_wvf.get_waveforms read with queue_depth concurrent reads
+    to the waveforms read serially (queue_depth=1).
+
+    Arguments:
+    - dp: path to Neuropixels data directory
+    - u: unit to load the waveforms of
+    - queue_depth: int, number of concurrent reads (>1)
+    - raise_error: bool, whether to raise an error when the comparison fails
+
+    Returns:
+    - bool, whether waveforms are identical
+    """
+    serial = get_waveforms(dp, u, hpfilt=True, queue_depth=1, cache_results=False)
+    concurrent = get_waveforms(dp, u, hpfilt=True, queue_depth=queue_depth, cache_results=False)
+    passed = np.array_equal(serial, concurrent)
+    if not passed:
+        print(f"{red_prefix}Waveforms read with queue_depth={queue_depth} differ from serially read waveforms.{suffix}")
+        if raise_error:
+            raise FailedNpyxTest(f"Waveforms read with queue_depth={queue_depth} differ from serially read waveforms.")
+    return passed
+
+def ccg_2d_serial(t1, t2, binsize, windowsize):
+    """
+    Serial reference of npyx.corr.ccg_2d_numba (single cursor sweeping t2).
+    t1 and t2 must be sorted, in samples.
+    """
+    t1, t2 = np.asarray(t1, dtype=np.int64), np.asarray(t2, dtype=np.int64)
+    n_bins = 2 * int(.5 * windowsize / binsize) + 1
+    half_window = windowsize // 2
+    C = np.zeros((len(t1), n_bins), dtype=np.int64)
+    left_cursor = 0
+    for i, t in enumerate(t1):
+        win_left = t - half_window
+        win_right = t + half_window + binsize
+        while left_cursor < len(t2) and t2[left_cursor] < win_left:
+            left_cursor += 1
+        right_cursor = left_cursor
+        while right_cursor < len(t2) and t2[right_cursor] < win_right:
+            right_cursor += 1
+        b = (t2[left_cursor:right_cursor] - win_left) // binsize
+        C[i] = np.bincount(b[b < n_bins], minlength=n_bins)
+    return C
+
+
 def test_function(fun, raise_error=False, ret=False, **kwargs):
     """
     Function to test a function with rich printed information.
@@ -87,4 +222,4 @@ def test_function(fun, raise_error=False, ret=False, **kwargs):
             raise FailedNpyxTest().with_traceback(err.__traceback__) from err
 
 class FailedNpyxTest(Exception):
-    pass
\ No newline at end of file
+    pass
@@ -3,6 +3,8 @@
 import os
 from pathlib import Path
 import logging
+import functools
+import inspect
 from ast import literal_eval as ale
 from typing import Union
 import shutil
@@ -21,7 +23,7 @@ from math import pi, log
 import numpy as np
 from numpy.fft import rfft, irfft
 
-from scipy.fft import fft, ifft
+from scipy.fft import fft, ifft, next_fast_len
 from scipy.optimize import curve_fit
 from scipy.signal import cspline1d_eval, cspline1d
 import scipy.stats as stt
@@ -34,7 +36,31 @@ from cachecache import Cacher, distributed_cacher
 global_npyx_cacher = Cacher(__cachedir__)
 # arguments of decorated functions altering caching behavior:
 # again, cache_results, cache_path
-npyx_cacher = distributed_cacher('dp', '.NeuroPyxels', global_npyx_cacher)
+npyx_distributed_cacher = distributed_cacher('dp', '.NeuroPyxels', global_npyx_cacher)
+
+def npyx_cacher(func):
+    '''
+    Caches results of func at dp/.NeuroPyxels (see cachecache.distributed_cacher).
+    Dataset handles (os.PathLike, see npyx.gl.DatasetHandle) passed as dp
+    are replaced by their path, so that results are cached at the same place, with the same keys.
+    '''
+    cached_func = npyx_distributed_cacher(func)
+    func_args = list(inspect.signature(func).parameters)
+    dp_i = func_args.index('dp') if 'dp' in func_args else None
+
+    @functools.wraps(func)
+    def handle_compatible_func(*args, **kwargs):
+        if dp_i is not None:
+            if dp_i < len(args) and _is_path_handle(args[dp_i]):
+                args = args[:dp_i] + (Path(args[dp_i]),) + args[dp_i+1:]
+            elif _is_path_handle(kwargs.get('dp', None)):
+                kwargs['dp'] = Path(kwargs['dp'])
+        return cached_func(*args, **kwargs)
+
+    return handle_compatible_func
+
+def _is_path_handle(dp):
+    return isinstance(dp, os.PathLike) and not isinstance(dp, Path)
 
 
 #%% function decoration utilities
@@ -483,6 +509,49 @@ def thresh_consec(arr, th, sgn=1, n_consec=0,
 
     return crosses
 
+def thresh_consec_rows(arr, th, sgn=1, n_consec=0):
+    '''
+    Finds threshold crosses lasting >=n_consec consecutive samples in every row of a 2D array at once.
+    Vectorized equivalent of npyx.utils.thresh_consecutive(row, th, sgn, n_consec, exclude_edges=True)
+    (crosses starting or ending at the edges of rows are excluded).
+    Arguments:
+        - arr: 2d numpy array (n_rows, n_samples), thresholded along its last axis
+        - th: float, threshold
+        - sgn: 1 or -1, positive (arr>=th) or negative (arr<=th) threshold crosses
+        - n_consec: optional int, minimum number of consecutive elements beyond threshold | Defult 0 (any cross)
+    Returns:
+        - rows: 1d array, row of every cross
+        - starts: 1d array, index of the first sample of every cross
+        - ends: 1d array, index of the last sample of every cross (included)
+        (sorted by row, then by start)
+    '''
+    arr = np.asarray(arr)
+    assert arr.ndim == 2
+    assert sgn in [-1, 1]
+    if sgn == 1:
+        beyond, within = (arr >= th), (arr < th)
+    else:
+        beyond, within = (arr <= th), (arr > th)
+
+    # entering crosses (sample beyond, previous sample within)
+    # and exiting crosses (sample beyond, next sample within)
+    r_in, i_in = np.nonzero(beyond[:, 1:] & within[:, :-1])
+    r_out, i_out = np.nonzero(beyond[:, :-1] & within[:, 1:])
+    i_in = i_in + 1
+
+    # pair every entering cross with the next exiting cross of the same row
+    rows = np.concatenate([r_in, r_out])
+    idx = np.concatenate([i_in, i_out])
+    is_in = np.concatenate([np.ones(len(r_in), dtype=bool), np.zeros(len(r_out), dtype=bool)])
+    order = np.lexsort((~is_in, idx, rows)) # at equal index, entering first (1 sample long crosses)
+    rows, idx, is_in = rows[order], idx[order], is_in[order]
+    paired = is_in[:-1] & ~is_in[1:] & (rows[:-1] == rows[1:])
+    k = np.nonzero(paired)[0]
+    rows, starts, ends = rows[k], idx[k], idx[k+1]
+
+    long_enough = (ends + 1 - starts) >= n_consec
+    return rows[long_enough], starts[long_enough], ends[long_enough]
+
 #%% Extract timestamps from windows
 
 def get_timestamps_in_windows_sorted(T, P):
@@ -715,6 +784,29 @@ def xcorr_1d_loop(w1, w2):
     c[np.isnan(c)]=0 # replace nans with 0 correlation
     return c
 
+def xcorr_1d_batch(w, waves):
+    """
+    Cross-correlations along axis 0 between a 2D array and a stack of 2D arrays,
+    all computed at once with zero-padded ffts along the samples axis.
+    Typically to match many waveforms (n_waves x 82 samples x 10 channels) to a single waveform template (82 x 10).
+
+    Equivalent to np.stack([xcorr_1d_loop(w, w2) for w2 in waves]) (up to floating point precision).
+
+    w: (n_samples, n_channels) array
+    waves: (n_waves, n_samples, n_channels) array
+    Returns: (n_waves, n_samples, n_channels) array
+    """
+    n = w.shape[0]
+    L = next_fast_len(2*n-1) # zero-padding: linear rather than circular crosscorrelation
+    with np.errstate(divide='ignore', invalid='ignore'): # flat channels: 0 correlation, like xcorr_1d_loop
+        w_n = np.nan_to_num(normalize(w, 0))
+        waves_n = np.nan_to_num((waves-waves.mean(1, keepdims=True))/waves.std(1, keepdims=True))
+    w_f = rfft(w_n, L, axis=0)
+    waves_f = rfft(waves_n, L, axis=1)
+    c = irfft(w_f[np.newaxis]*np.conj(waves_f), L, axis=1)
+    # lags of np.correlate(mode='same'), from -n//2, wrapped around
+    return c[:, (np.arange(n)-n//2)%L, :]
+
 def xcorr_2d(w1, w2):
     """
     Cross-correlation along ALL axis between two Nd arrays.